@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class AppConfig(AppConfig):
     name = 'app'
+
+    def ready(self):
+        from bot.api import configure_api_url, configure_pool
+
+        configure_pool()
+        if settings.TELEGRAM_API_URL:
+            configure_api_url(settings.TELEGRAM_API_URL)
@@ -0,0 +1,120 @@
+# common
+import logging
+import random
+
+# django
+from django.conf import settings
+
+# other
+import redis
+
+# my
+from app import metrics
+from app.common import get_redis
+
+
+class AudioIndex(object):
+    """
+    Redis sets of uploaded telegram audio ids per category for O(1) random picks instead of ORDER BY RANDOM().
+
+    Sets are kept in sync by Audio signals and rebuilt from database when the index is missing (e.g. after redis
+    flush). Last picked tracks of every user are kept in a short list so they are not repeated.
+    """
+    READY_KEY = 'audio:indexed'
+
+    def __init__(self, no_repeat=None):
+        self.no_repeat = settings.AUDIO_NO_REPEAT if no_repeat is None else no_repeat
+
+    @staticmethod
+    def _key(category):
+        return 'audio:ids:{}'.format(category)
+
+    @staticmethod
+    def _recent_key(user_id):
+        return 'audio:recent:{}'.format(user_id)
+
+    @staticmethod
+    def _categories():
+        from app.models import Audio
+        return [c[0] for c in Audio.CATEGORIES]
+
+    def rebuild(self):
+        from app.models import Audio
+
+        pipe = get_redis().pipeline()
+        pipe.delete(*[self._key(c) for c in self._categories()])
+        rows = Audio.objects.exclude(audio_id__isnull=True).exclude(audio_id='').values_list('category', 'audio_id')
+        for category, audio_id in rows:
+            pipe.sadd(self._key(category), audio_id)
+        pipe.set(self.READY_KEY, 1)
+        pipe.execute()
+        metrics.incr('audio_index.rebuilds')
+
+    def add(self, audio, previous_audio_id=None):
+        stale = [a for a in (audio.audio_id, previous_audio_id) if a]
+        pipe = get_redis().pipeline()
+        if stale:
+            for category in self._categories():
+                pipe.srem(self._key(category), *stale)
+        if audio.audio_id:
+            pipe.sadd(self._key(audio.category), audio.audio_id)
+        pipe.execute()
+
+    def remove(self, audio):
+        if audio.audio_id:
+            get_redis().srem(self._key(audio.category), audio.audio_id)
+
+    def _sizes(self, categories):
+        pipe = get_redis().pipeline()
+        pipe.exists(self.READY_KEY)
+        for category in categories:
+            pipe.scard(self._key(category))
+        ready, *sizes = pipe.execute()
+        if not ready:
+            self.rebuild()
+            return self._sizes(categories)
+        return sizes
+
+    def pick(self, user_id=None, categories=None, weights=None):
+        """
+        Random (category, audio_id) or None. Category is chosen by `weights` ({category: weight}) scaled by its
+        size, so without weights every track is equally likely.
+        """
+        categories = categories or self._categories()
+        client = get_redis()
+
+        try:
+            sizes = self._sizes(categories)
+            weighted = [(c, size * (weights or {}).get(c, 1)) for c, size in zip(categories, sizes) if size]
+            if not weighted:
+                return None
+
+            point = random.uniform(0, sum(w for _, w in weighted))
+            for category, weight in weighted:
+                point -= weight
+                if point <= 0:
+                    break
+
+            recent = []
+            if user_id is not None and self.no_repeat:
+                recent = [a.decode('utf8') for a in client.lrange(self._recent_key(user_id), 0, -1)]
+
+            # SRANDMEMBER with positive count returns distinct members, one of them is not recent
+            candidates = [a.decode('utf8') for a in client.srandmember(self._key(category), len(recent) + 1)]
+            fresh = [a for a in candidates if a not in recent]
+            audio_id = fresh[0] if fresh else candidates[0]
+
+            if user_id is not None and self.no_repeat:
+                pipe = client.pipeline()
+                pipe.lpush(self._recent_key(user_id), audio_id)
+                pipe.ltrim(self._recent_key(user_id), 0, self.no_repeat - 1)
+                pipe.execute()
+        except redis.RedisError:
+            logging.exception('Can not pick audio from index')
+            return None
+
+        metrics.incr('audio_index.picks')
+        return category, audio_id
+
+
+audio_index = AudioIndex()
@@ -0,0 +1,123 @@
+# common
+import logging
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+# django
+from django.conf import settings
+
+# other
+import redis
+
+# my
+from app import metrics
+from app.common import get_redis
+
+
+class TelegramUserCache(object):
+    """
+    Write-through cache of TelegramUser rows keyed by chat id (TelegramUser.user_id).
+
+    Redis keeps pickled field values together with version stamp which is changed on every save. In process tier
+    keeps the same pair and is validated with a single GET of the version, so it never serves a row saved by other
+    worker. Related objects are not cached.
+    """
+
+    def __init__(self, ttl=None, local_size=None):
+        self.ttl = ttl or settings.TELEGRAM_USER_CACHE_TTL
+        self.local_size = local_size or settings.TELEGRAM_USER_CACHE_LOCAL_SIZE
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _data_key(user_id):
+        return 'telegram_user:{}'.format(user_id)
+
+    @staticmethod
+    def _version_key(user_id):
+        return 'telegram_user:{}:version'.format(user_id)
+
+    def _set_local(self, user_id, version, data):
+        with self._lock:
+            self._local[user_id] = (version, data)
+            self._local.move_to_end(user_id)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    @staticmethod
+    def _build(data):
+        from app.models import TelegramUser
+
+        user = TelegramUser(**pickle.loads(data))
+        user._state.adding = False
+        user._state.db = 'default'
+        return user
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        client = get_redis()
+
+        try:
+            local = self._local.get(user_id)
+            if local is not None:
+                version = client.get(self._version_key(user_id))
+                if version is not None and version.decode('utf8') == local[0]:
+                    metrics.incr('user_cache.local_hit')
+                    return self._build(local[1])
+
+            cached = client.get(self._data_key(user_id))
+        except redis.RedisError:
+            logging.exception('Can not read user %s from cache', user_id)
+            return None
+
+        if cached is None:
+            metrics.incr('user_cache.miss')
+            return None
+
+        version, data = pickle.loads(cached)
+        self._set_local(user_id, version, data)
+        metrics.incr('user_cache.redis_hit')
+        return self._build(data)
+
+    def store(self, user):
+        user_id = str(user.user_id)
+        values = {f.attname: getattr(user, f.attname) for f in user._meta.concrete_fields}
+        data = pickle.dumps(values)
+        version = uuid.uuid4().hex
+
+        try:
+            pipe = get_redis().pipeline()
+            pipe.set(self._data_key(user_id), pickle.dumps((version, data)), ex=self.ttl)
+            pipe.set(self._version_key(user_id), version, ex=self.ttl)
+            pipe.execute()
+        except redis.RedisError:
+            logging.exception('Can not store user %s in cache', user_id)
+            with self._lock:
+                self._local.pop(user_id, None)
+            return
+
+        self._set_local(user_id, version, data)
+
+    def invalidate(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            self._local.pop(user_id, None)
+        try:
+            get_redis().delete(self._data_key(user_id), self._version_key(user_id))
+        except redis.RedisError:
+            logging.exception('Can not invalidate user %s in cache', user_id)
+
+    def invalidate_many(self, user_ids):
+        user_ids = [str(user_id) for user_id in user_ids]
+        if not user_ids:
+            return
+        with self._lock:
+            for user_id in user_ids:
+                self._local.pop(user_id, None)
+        get_redis().delete(*[key for user_id in user_ids
+                             for key in (self._data_key(user_id), self._version_key(user_id))])
+
+
+user_cache = TelegramUserCache()
@@ -3,8 +3,15 @@ import calendar
 import datetime
 
 # django
+from django.conf import settings
 from django.contrib.auth import get_user_model
 
+# other
+import redis
+
+
+_redis = None
+
 
 def chunker(seq, size):
     if len(seq) == 0:
@@ -21,3 +28,10 @@ def get_admin_emails():
     admins = get_user_model().objects.filter(is_superuser=True)
     recipients = [u.email for u in admins if u.email]
     return recipients
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.REDIS_APP_URL)
+    return _redis
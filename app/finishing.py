@@ -0,0 +1,212 @@
+# common
+import json
+import logging
+import time
+from collections import defaultdict
+
+# django
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+# my
+from app import metrics
+from app import timers
+from app.common import get_redis
+from app.mixins.state import JSONFieldStateStore, get_state_store_class
+
+
+STATE_KEYS = {
+    'pomodoro': 'current_pomodoro_id',
+    'rest': 'current_rest_id',
+}
+
+FIRST_POMODORO_OPTION = 'first_pomodoro'
+
+# finish started activities which are still current in users json state and clear it in the same statement,
+# returns user pk, chat id and whether it was first pomodoro of the user
+_json_finish_sql = """
+    WITH due AS (
+        SELECT a.id, a.telegram_user_id, coalesce(u.state, '{{}}')::jsonb AS state
+        FROM {activity} a JOIN {user} u ON u.id = a.telegram_user_id
+        WHERE a.id = ANY(%s) AND a.status = 'started'
+          AND coalesce(u.state, '{{}}')::jsonb ->> %s::text = a.id::text
+        FOR UPDATE OF a, u
+    ), finished AS (
+        UPDATE {activity} a SET status = 'finished', end_date = %s, update_date = %s
+        FROM due WHERE a.id = due.id
+    )
+    UPDATE {user} u SET state = ({state})::text, state_version = u.state_version + 1, update_date = %s
+    FROM due WHERE u.id = due.telegram_user_id
+    RETURNING u.id, u.user_id, {first}
+"""
+
+_has_first_option = "coalesce(due.state -> 'options', '[]') @> '[\"{}\"]'".format(FIRST_POMODORO_OPTION)
+
+_json_state = {
+    'pomodoro': """
+        CASE WHEN {has_first} THEN due.state - %s::text
+        ELSE jsonb_set(due.state - %s::text, '{{options}}', coalesce(due.state -> 'options', '[]') || '["{option}"]')
+        END
+    """.format(has_first=_has_first_option, option=FIRST_POMODORO_OPTION),
+    'rest': 'due.state - %s::text',
+}
+
+_json_first = {
+    'pomodoro': 'NOT ' + _has_first_option,
+    'rest': 'false',
+}
+
+_finish_sql = """
+    UPDATE {activity} SET status = 'finished', end_date = %s, update_date = %s
+    WHERE id = ANY(%s) AND status = 'started'
+    RETURNING telegram_user_id
+"""
+
+
+def _models(kind):
+    from app.models import Pomodoro, Rest, TelegramUser
+    return (Pomodoro if kind == 'pomodoro' else Rest), TelegramUser
+
+
+def _finish_json(kind, ids, now):
+    activity_model, user_model = _models(kind)
+    qn = connection.ops.quote_name
+    sql = _json_finish_sql.format(
+        activity=qn(activity_model._meta.db_table),
+        user=qn(user_model._meta.db_table),
+        state=_json_state[kind],
+        first=_json_first[kind],
+    )
+    key = STATE_KEYS[kind]
+    params = [ids, key, now, now] + [key] * _json_state[kind].count('%s') + [now]
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    # rows were changed behind the cache, same as a save of TelegramUser would do
+    from app.cache import user_cache
+    user_cache.invalidate_many([chat_id for _, chat_id, _ in rows])
+
+    return [(user_pk, first) for user_pk, _, first in rows]
+
+
+def _finish_redis(kind, ids, now):
+    activity_model, _ = _models(kind)
+    key = STATE_KEYS[kind]
+    client = get_redis()
+
+    candidates = list(activity_model.objects.filter(id__in=ids, status='started')
+                      .values_list('id', 'telegram_user_id'))
+
+    pipe = client.pipeline(transaction=False)
+    for _, user_pk in candidates:
+        pipe.hmget('state:{}'.format(user_pk), key, 'options')
+    states = pipe.execute()
+
+    current = {}
+    for (activity_id, user_pk), (value, options) in zip(candidates, states):
+        if value is not None and json.loads(value.decode('utf8')) == activity_id:
+            current[activity_id] = (user_pk, json.loads(options.decode('utf8')) if options else [])
+
+    if not current:
+        return []
+
+    sql = _finish_sql.format(activity=connection.ops.quote_name(activity_model._meta.db_table))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [now, now, list(current)])
+        finished = {row[0] for row in cursor.fetchall()}
+
+    result = []
+    pipe = client.pipeline(transaction=False)
+    for user_pk, options in current.values():
+        if user_pk not in finished:
+            continue
+        pipe.hdel('state:{}'.format(user_pk), key)
+        first = kind == 'pomodoro' and FIRST_POMODORO_OPTION not in options
+        if first:
+            pipe.hset('state:{}'.format(user_pk), 'options', json.dumps(options + [FIRST_POMODORO_OPTION]))
+        result.append((user_pk, first))
+    pipe.execute()
+    return result
+
+
+def notify(finished):
+    """
+    Send finish messages of (kind, user pk, first pomodoro) in one pass, through outbound queue when it is enabled.
+    """
+    from app.models import TelegramUser
+    from bot import helper, messages, outbound
+    from bot.sender import merge_messages
+
+    # menu of the main state shows current project
+    users = TelegramUser.objects.select_related('current_project').in_bulk({user_pk for _, user_pk, _ in finished})
+
+    items = []
+    for kind, user_pk, first in finished:
+        telegram_user = users.get(user_pk)
+        if telegram_user is None:
+            continue
+
+        if kind == 'pomodoro':
+            texts = ([messages.first_pomodoro_message] if first else []) + [messages.pomodoro_ended_message]
+        else:
+            texts = [messages.pomodoro_rest_ended_message]
+        for text, _ in merge_messages([(t, None) for t in texts]):
+            items.append((telegram_user, text))
+
+    if settings.TELEGRAM_OUTBOUND_QUEUE:
+        outbound.enqueue_many([(u.user_id, text, helper.get_menu(u), 'timer') for u, text in items])
+        return
+
+    by_text = defaultdict(list)
+    for telegram_user, text in items:
+        by_text[text].append(telegram_user)
+    for text, telegram_users in by_text.items():
+        helper.send_message_to_users(telegram_users, text)
+
+
+def finish_batch(members):
+    """
+    Finish due pomodoros and rests of timer members ('<kind>:<user pk>:<activity id>') in bulk: cancelled timers
+    are dropped by tombstones, activities are finished with one UPDATE ... RETURNING per kind, state is cleared
+    in the same statement (json store) or one redis pipeline, notifications are sent in one pass.
+    Returns number of finished activities.
+    """
+    started = time.time()
+    parsed = [timers.parse_member(member) for member in members]
+    if not parsed:
+        return 0
+
+    pipe = get_redis().pipeline(transaction=False)
+    for kind, _, activity_id in parsed:
+        pipe.exists(timers.tombstone_key(kind, activity_id))
+    cancelled = pipe.execute()
+
+    ids = defaultdict(list)
+    for (kind, _, activity_id), is_cancelled in zip(parsed, cancelled):
+        if is_cancelled:
+            metrics.incr('timers.tombstone_hits.' + kind)
+        else:
+            ids[kind].append(activity_id)
+
+    json_store = issubclass(get_state_store_class(), JSONFieldStateStore)
+    now = timezone.now()
+
+    finished = []
+    for kind in timers.KINDS:
+        if not ids[kind]:
+            continue
+        finish = _finish_json if json_store else _finish_redis
+        finished.extend((kind, user_pk, first) for user_pk, first in finish(kind, ids[kind], now))
+
+    if finished:
+        try:
+            notify(finished)
+        except Exception:
+            logging.exception('Can not notify users of finished activities')
+
+    metrics.incr('timers.finished', len(finished))
+    metrics.timing('timers.finish_batch', time.time() - started)
+    return len(finished)
@@ -0,0 +1,58 @@
+# common
+import timeit
+
+# django
+from django.core.management.base import BaseCommand
+
+# my
+from bot.router import Router
+
+
+def handler(bot, message):
+    pass
+
+
+def build_chain(count):
+    texts = ['command {}'.format(i) for i in range(count)]
+    prefixes = ['prefix {}:'.format(i) for i in range(count)]
+
+    # emulation of old if/elif chain: compare message against every command in turn
+    def chain(message):
+        for text in texts:
+            if message == text:
+                return handler
+        for prefix in prefixes:
+            if message.startswith(prefix):
+                return handler
+        return handler
+    return chain
+
+
+def build_router(count):
+    router = Router()
+    for i in range(count):
+        router.route('state', texts=['command {}'.format(i)], prefixes=['prefix {}:'.format(i)])(handler)
+    router.fallback('state')(handler)
+    return router
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark of message dispatch: if/elif chain vs Router for growing number of commands'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        number = options['number']
+        self.stdout.write('{:>10} {:>18} {:>18}'.format('commands', 'chain, us/msg', 'router, us/msg'))
+
+        for count in (10, 100, 1000):
+            # worst case for the chain: last registered prefix
+            message = 'prefix {}: value'.format(count - 1)
+            chain = build_chain(count)
+            router = build_router(count)
+
+            chain_time = timeit.timeit(lambda: chain(message), number=number)
+            router_time = timeit.timeit(lambda: router.dispatch(None, 'state', message), number=number)
+            self.stdout.write('{:>10} {:>18.3f} {:>18.3f}'.format(
+                count, chain_time / number * 1e6, router_time / number * 1e6))
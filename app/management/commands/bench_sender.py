@@ -0,0 +1,40 @@
+# common
+import time
+
+# django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# my
+from bot.api import get_bot
+from bot.transport import send_concurrently
+
+
+class Command(BaseCommand):
+    help = 'Compare sequential and concurrent sendMessage throughput, run against manage.py fake_bot_api'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=settings.TELEGRAM_SEND_CONCURRENCY)
+
+    def handle(self, *args, **options):
+        if not settings.TELEGRAM_API_URL:
+            raise CommandError('Set TELEGRAM_API_URL to fake Bot API server, real one will ban for such traffic')
+
+        count = options['count']
+        calls = [('sendMessage', (100000 + i, 'benchmark {}'.format(i)), {}) for i in range(count)]
+
+        bot = get_bot()
+        start = time.perf_counter()
+        for method, args, kwargs in calls:
+            getattr(bot, method)(*args, **kwargs)
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = send_concurrently(calls, concurrency=options['concurrency'])
+        concurrent = time.perf_counter() - start
+
+        errors = len([r for r in results if isinstance(r, Exception)])
+        self.stdout.write('sequential: {:.1f} msg/s'.format(count / sequential))
+        self.stdout.write('concurrent ({}): {:.1f} msg/s, errors: {}'.format(
+            options['concurrency'], count / concurrent, errors))
@@ -0,0 +1,21 @@
+# django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# my
+from bot.lanes import consume_lane
+from bot.telegram import process_update
+
+
+class Command(BaseCommand):
+    help = 'Process telegram updates of one lane in order (TELEGRAM_UPDATE_MODE = "lanes"), run one per lane'
+
+    def add_arguments(self, parser):
+        parser.add_argument('lane', type=int)
+
+    def handle(self, *args, **options):
+        lane = options['lane']
+        if not 0 <= lane < settings.TELEGRAM_UPDATE_LANES:
+            raise CommandError('Lane should be in range 0..{}'.format(settings.TELEGRAM_UPDATE_LANES - 1))
+
+        consume_lane(lane, process_update)
@@ -0,0 +1,131 @@
+# common
+import cgi
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# django
+from django.core.management.base import BaseCommand
+
+# my
+from bot import helper
+
+
+class FakeBotApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency, updates, chats):
+        super().__init__(address, FakeBotApiHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+
+        texts = [helper.START_TEXT, helper.STOP_TEXT, helper.STATS_TEXT, helper.STATS_DAY_TEXT, helper.BACK_TEXT]
+        self.updates = []
+        for update_id in range(1, updates + 1):
+            chat_id = 100000 + update_id % chats
+            self.updates.append({
+                'update_id': update_id,
+                'message': {
+                    'message_id': update_id,
+                    'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Fake', 'last_name': str(chat_id)},
+                    'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Fake', 'last_name': str(chat_id)},
+                    'text': texts[update_id % len(texts)],
+                },
+            })
+
+    def get_updates(self, offset, limit):
+        return [u for u in self.updates if u['update_id'] >= offset][:limit]
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    path_re = re.compile(r'^/bot(?P<token>[^/]+)/(?P<method>\w+)$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        if self.command != 'POST':
+            return {}
+
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers['Content-Type']})
+        return {key: form.getfirst(key) for key in form.keys()}
+
+    def _reply(self, code, data):
+        body = json.dumps(data).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        match = self.path_re.match(self.path)
+        if not match:
+            self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+
+        method = match.group('method')
+        params = self._params()
+        server = self.server
+        with server.lock:
+            server.calls[method] += 1
+
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            limit = int(params.get('limit') or 100)
+            updates = server.get_updates(offset, limit)
+            if not updates:
+                # synthetic updates never grow, long polling just waits out the timeout
+                time.sleep(int(params.get('timeout') or 0))
+            self._reply(200, {'ok': True, 'result': updates})
+            return
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if method in ('sendMessage', 'sendAudio', 'sendPhoto', 'editMessageText'):
+            result = {
+                'message_id': next(server.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+                'text': params.get('text'),
+            }
+            if method == 'sendAudio':
+                result['audio'] = {'file_id': 'fake-audio-{}'.format(result['message_id'])}
+        else:
+            result = True
+        self._reply(200, {'ok': True, 'result': result})
+
+    do_GET = do_POST
+
+
+class Command(BaseCommand):
+    help = 'Run local fake telegram Bot API server for offline runs and benchmarks (see TELEGRAM_API_URL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8081)
+        parser.add_argument('--latency', type=float, default=0, help='Emulated network latency, seconds')
+        parser.add_argument('--updates', type=int, default=0, help='Synthetic updates served by getUpdates')
+        parser.add_argument('--chats', type=int, default=10, help='Number of chats in synthetic updates')
+
+    def handle(self, *args, **options):
+        server = FakeBotApiServer((options['host'], options['port']), options['latency'],
+                                  options['updates'], options['chats'])
+        self.stdout.write('Fake Bot API on http://{host}:{port}'.format(**options))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for method, count in sorted(server.calls.items()):
+                self.stdout.write('{:<30} {}'.format(method, count))
@@ -0,0 +1,34 @@
+# django
+from django.core.management.base import BaseCommand, CommandError
+
+# my
+from app.models import TelegramUser
+from app.mixins.state import get_state_store_class
+
+
+STORES = {
+    'json': 'app.mixins.state.JSONFieldStateStore',
+    'redis': 'app.mixins.state.RedisStateStore',
+}
+
+
+class Command(BaseCommand):
+    help = 'Copy conversational state of all users between state stores, run before switching STATE_STORE_BACKEND'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', choices=STORES.keys())
+        parser.add_argument('target', choices=STORES.keys())
+
+    def handle(self, *args, **options):
+        if options['source'] == options['target']:
+            raise CommandError('Source and target stores are the same')
+
+        source_class = get_state_store_class(STORES[options['source']])
+        target_class = get_state_store_class(STORES[options['target']])
+
+        count = 0
+        for telegram_user in TelegramUser.objects.iterator():
+            target_class(telegram_user).load(source_class(telegram_user).dump())
+            count += 1
+
+        self.stdout.write('State of {} users copied'.format(count))
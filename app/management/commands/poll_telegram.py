@@ -0,0 +1,66 @@
+# common
+import json
+import logging
+import time
+
+# django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+# my
+from app import metrics
+from app.common import get_redis
+from bot.api import get_bot
+from bot.telegram import submit_update
+
+
+class Command(BaseCommand):
+    help = 'Pull telegram updates with getUpdates long polling instead of webhook'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=settings.TELEGRAM_POLL_LIMIT,
+                            help='Max updates in one batch (1-100)')
+        parser.add_argument('--timeout', type=int, default=settings.TELEGRAM_POLL_TIMEOUT,
+                            help='Long polling timeout, seconds')
+        parser.add_argument('--delete-webhook', action='store_true',
+                            help='Remove webhook first, telegram refuses getUpdates while it is set')
+        parser.add_argument('--once', action='store_true', help='Process one batch and exit')
+
+    def handle(self, *args, **options):
+        token = settings.TELEGRAM_BOT_TOKEN
+        bot = get_bot(token)
+        offset_key = 'telegram:poll_offset:{}'.format(token.split(':')[0])
+
+        if options['delete_webhook']:
+            bot.deleteWebhook()
+
+        client = get_redis()
+        offset = client.get(offset_key)
+        offset = int(offset) if offset else None
+
+        errors = 0
+        while True:
+            close_old_connections()
+            try:
+                updates = bot.getUpdates(offset=offset, limit=options['limit'], timeout=options['timeout'])
+
+                if updates:
+                    with metrics.timer('poll.batch'):
+                        for update in updates:
+                            submit_update(json.dumps(update), token)
+                    metrics.incr('poll.updates', len(updates))
+
+                    # commit offset only after whole batch is processed, telegram confirms updates
+                    # below offset on next call. Updates processed twice after crash are skipped by dedup
+                    offset = updates[-1]['update_id'] + 1
+                    client.set(offset_key, offset)
+                errors = 0
+            except Exception:
+                logging.exception('Can not get telegram updates')
+                errors += 1
+                time.sleep(min(2 ** errors, 60))
+                continue
+
+            if options['once']:
+                break
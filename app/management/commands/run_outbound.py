@@ -0,0 +1,12 @@
+# django
+from django.core.management.base import BaseCommand
+
+# my
+from bot import outbound
+
+
+class Command(BaseCommand):
+    help = 'Send queued outbound messages within telegram global and per chat rate limits, can run several'
+
+    def handle(self, *args, **options):
+        outbound.run()
@@ -0,0 +1,12 @@
+# django
+from django.core.management.base import BaseCommand
+
+# my
+from app import wheel
+
+
+class Command(BaseCommand):
+    help = 'Fire pomodoro and rest timers from in memory timing wheel (TIMER_BACKEND = "wheel"), run only one'
+
+    def handle(self, *args, **options):
+        wheel.run()
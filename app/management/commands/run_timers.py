@@ -0,0 +1,16 @@
+# django
+from django.core.management.base import BaseCommand
+
+# my
+from app import timers
+
+
+class Command(BaseCommand):
+    help = 'Fire due pomodoro and rest timers (TIMER_BACKEND = "redis")'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=100)
+        parser.add_argument('--interval', type=float, default=0.5)
+
+    def handle(self, *args, **options):
+        timers.run(options['batch'], options['interval'])
@@ -0,0 +1,21 @@
+# django
+from django.core.management.base import BaseCommand
+
+# my
+from app import metrics
+
+
+class Command(BaseCommand):
+    help = 'Show bot metrics collected in redis'
+
+    def add_arguments(self, parser):
+        parser.add_argument('prefix', nargs='?', default='')
+        parser.add_argument('--reset', action='store_true', help='Reset metrics after showing')
+
+    def handle(self, *args, **options):
+        stats = metrics.get_stats(options['prefix'])
+        for name in sorted(stats):
+            self.stdout.write('{:<60} {}'.format(name, stats[name]))
+
+        if options['reset']:
+            metrics.reset(options['prefix'])
@@ -0,0 +1,135 @@
+# common
+import logging
+import threading
+import time
+from collections import defaultdict
+
+# django
+from django.conf import settings
+
+# other
+import redis
+
+# my
+from app.common import get_redis
+
+
+METRICS_KEY = 'metrics'
+METRICS_MAX_KEY = 'metrics:max'
+METRICS_GAUGE_KEY = 'metrics:gauge'
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_maximums = {}
+_gauges = {}
+_last_flush = time.time()
+
+# HSET only if value is greater than stored one
+_max_script = """
+for i = 1, #ARGV, 2 do
+    local current = tonumber(redis.call('HGET', KEYS[1], ARGV[i]) or '-1')
+    if tonumber(ARGV[i + 1]) > current then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+"""
+
+
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+    _maybe_flush()
+
+
+def timing(name, seconds):
+    ms = int(seconds * 1000)
+    with _lock:
+        _counters[name + '.count'] += 1
+        _counters[name + '.total_ms'] += ms
+        if ms > _maximums.get(name + '.max_ms', -1):
+            _maximums[name + '.max_ms'] = ms
+    _maybe_flush()
+
+
+def gauge(name, value, track_max=False):
+    """
+    Last reported value, e.g. current queue depth. With track_max maximum is kept as <name>.max as well.
+    """
+    with _lock:
+        _gauges[name] = value
+        if track_max and value > _maximums.get(name + '.max', -1):
+            _maximums[name + '.max'] = value
+    _maybe_flush()
+
+
+class timer(object):
+    """
+    Context manager reporting duration of the block: with metrics.timer('bot.dispatch'): ...
+    """
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        timing(self.name, time.perf_counter() - self.start)
+
+
+def _maybe_flush():
+    if time.time() - _last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    global _last_flush
+
+    with _lock:
+        counters = dict(_counters)
+        maximums = dict(_maximums)
+        gauges = dict(_gauges)
+        _counters.clear()
+        _maximums.clear()
+        _gauges.clear()
+        _last_flush = time.time()
+
+    if not counters and not maximums and not gauges:
+        return
+
+    try:
+        client = get_redis()
+        pipe = client.pipeline(transaction=False)
+        for name, value in counters.items():
+            pipe.hincrby(METRICS_KEY, name, value)
+        if gauges:
+            pipe.hmset(METRICS_GAUGE_KEY, gauges)
+        pipe.execute()
+
+        if maximums:
+            args = [v for item in maximums.items() for v in item]
+            client.eval(_max_script, 1, METRICS_MAX_KEY, *args)
+    except redis.RedisError:
+        logging.exception('Can not flush metrics')
+
+
+def get_stats(prefix=''):
+    flush()
+
+    client = get_redis()
+    stats = {}
+    for key in (METRICS_KEY, METRICS_MAX_KEY, METRICS_GAUGE_KEY):
+        for name, value in client.hgetall(key).items():
+            name = name.decode('utf8')
+            if name.startswith(prefix):
+                stats[name] = int(value)
+    return stats
+
+
+def reset(prefix=''):
+    client = get_redis()
+    for key in (METRICS_KEY, METRICS_MAX_KEY, METRICS_GAUGE_KEY):
+        names = [n for n in client.hkeys(key) if n.decode('utf8').startswith(prefix)]
+        if names:
+            client.hdel(key, *names)
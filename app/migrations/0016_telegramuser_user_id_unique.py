@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def merge_duplicated_users(apps, schema_editor):
+    TelegramUser = apps.get_model('app', 'TelegramUser')
+    Project = apps.get_model('app', 'Project')
+    Pomodoro = apps.get_model('app', 'Pomodoro')
+    Rest = apps.get_model('app', 'Rest')
+    Contact = apps.get_model('app', 'Contact')
+
+    duplicated = TelegramUser.objects.values('user_id').annotate(count=models.Count('id')).filter(count__gt=1)
+    for item in duplicated:
+        keeper, *others = TelegramUser.objects.filter(user_id=item['user_id']).order_by('id')
+        for user in others:
+            for project in Project.objects.filter(telegram_user=user):
+                existing = Project.objects.filter(telegram_user=keeper, name=project.name).first()
+                if existing:
+                    Pomodoro.objects.filter(project=project).update(project=existing)
+                    Rest.objects.filter(project=project).update(project=existing)
+                    Project.objects.filter(id=existing.id).update(
+                        total_pomodoros=models.F('total_pomodoros') + project.total_pomodoros,
+                        total_rest=models.F('total_rest') + project.total_rest,
+                    )
+                    TelegramUser.objects.filter(current_project=project).update(current_project=existing)
+                    project.delete()
+                else:
+                    project.telegram_user = keeper
+                    project.save()
+
+            Pomodoro.objects.filter(telegram_user=user).update(telegram_user=keeper)
+            Rest.objects.filter(telegram_user=user).update(telegram_user=keeper)
+            Contact.objects.filter(telegram_user=user).update(telegram_user=keeper)
+            user.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_auto_20171019_0934'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicated_users, migrations.RunPython.noop),
+        # merge leaves deferred FK checks pending, postgres refuses ALTER TABLE of the same transaction otherwise
+        migrations.RunSQL('SET CONSTRAINTS ALL IMMEDIATE', migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='telegramuser',
+            name='user_id',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0016_telegramuser_user_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telegramuser',
+            name='state_version',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+    ]
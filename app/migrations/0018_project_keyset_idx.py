@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0017_telegramuser_state_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='project',
+            index=models.Index(fields=['telegram_user', '-total_pomodoros', '-id'], name='app_project_keyset_idx'),
+        ),
+        # name LIKE 'prefix%' search of projects menu, default btree index can not be used for LIKE
+        # unless database collation is C
+        migrations.RunSQL(
+            'CREATE INDEX app_project_name_prefix_idx ON app_project (telegram_user_id, name varchar_pattern_ops)',
+            'DROP INDEX app_project_name_prefix_idx',
+        ),
+    ]
@@ -1,14 +1,175 @@
+# common
+import json
+import logging
+
 # django
 from django.db import models
+from django.conf import settings
+from django.utils.module_loading import import_string
 
 # other
 from jsonfield import JSONField
 
 
+STATE_KEY = 'state'
+
+
+class StateConflictError(Exception):
+    pass
+
+
+class JSONFieldStateStore(object):
+    """
+    Keeps state in `state` JSONField of the row, every change saves the row. Changes are also recorded as
+    operations, StateMixin replays them over fresh state if row was changed concurrently.
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+
+    def _apply(self, operation):
+        result = operation(self.instance.state)
+        self.instance._state_operations.append(operation)
+        self.instance.save()
+        return result
+
+    def get(self, key, default=None):
+        return self.instance.state.get(key, default)
+
+    def set(self, key, value):
+        def operation(state):
+            state[key] = value
+        self._apply(operation)
+
+    def remove(self, key):
+        if key in self.instance.state:
+            self._apply(lambda state: state.pop(key, None))
+
+    def push(self, value):
+        self._apply(lambda state: state.setdefault(STATE_KEY, []).append(value))
+
+    def pop(self):
+        if not self.get(STATE_KEY):
+            raise IndexError('pop from empty state machine')
+
+        def operation(state):
+            stack = state.get(STATE_KEY)
+            return stack.pop() if stack else None
+        return self._apply(operation)
+
+    def clear_stack(self):
+        self.set(STATE_KEY, [])
+
+    def top(self):
+        stack = self.get(STATE_KEY, [])
+        return stack[-1] if stack else None
+
+    def dump(self):
+        return dict(self.instance.state)
+
+    def load(self, data):
+        self.instance.state = dict(data)
+        self.instance.save()
+
+
+class RedisStateStore(object):
+    """
+    Keeps state in redis hash `state:<pk>` with json encoded values, state machine stack is kept in list
+    `state:<pk>:machine`. Postgres is not touched. Stack expires after STATE_MACHINE_TTL seconds of inactivity
+    so stale menus fall back to main one.
+    """
+
+    def __init__(self, instance):
+        from app.common import get_redis
+
+        self.instance = instance
+        self.client = get_redis()
+        self.key = 'state:{}'.format(instance.pk)
+        self.machine_key = 'state:{}:machine'.format(instance.pk)
+
+    def _touch_machine(self, pipe):
+        if settings.STATE_MACHINE_TTL:
+            pipe.expire(self.machine_key, settings.STATE_MACHINE_TTL)
+
+    def get(self, key, default=None):
+        if key == STATE_KEY:
+            return [v.decode('utf8') for v in self.client.lrange(self.machine_key, 0, -1)]
+
+        value = self.client.hget(self.key, key)
+        return json.loads(value.decode('utf8')) if value is not None else default
+
+    def set(self, key, value):
+        if key == STATE_KEY:
+            self.load_stack(value)
+        else:
+            self.client.hset(self.key, key, json.dumps(value))
+
+    def remove(self, key):
+        if key == STATE_KEY:
+            self.client.delete(self.machine_key)
+        else:
+            self.client.hdel(self.key, key)
+
+    def push(self, value):
+        pipe = self.client.pipeline()
+        pipe.rpush(self.machine_key, value)
+        self._touch_machine(pipe)
+        pipe.execute()
+
+    def pop(self):
+        value = self.client.rpop(self.machine_key)
+        if value is None:
+            raise IndexError('pop from empty state machine')
+        return value.decode('utf8')
+
+    def clear_stack(self):
+        self.client.delete(self.machine_key)
+
+    def top(self):
+        value = self.client.lindex(self.machine_key, -1)
+        return value.decode('utf8') if value is not None else None
+
+    def load_stack(self, stack):
+        pipe = self.client.pipeline()
+        pipe.delete(self.machine_key)
+        if stack:
+            pipe.rpush(self.machine_key, *stack)
+            self._touch_machine(pipe)
+        pipe.execute()
+
+    def dump(self):
+        data = {k.decode('utf8'): json.loads(v.decode('utf8')) for k, v in self.client.hgetall(self.key).items()}
+        data[STATE_KEY] = self.get(STATE_KEY)
+        return data
+
+    def load(self, data):
+        data = dict(data)
+        stack = data.pop(STATE_KEY, [])
+
+        pipe = self.client.pipeline()
+        pipe.delete(self.key, self.machine_key)
+        if data:
+            pipe.hmset(self.key, {k: json.dumps(v) for k, v in data.items()})
+        if stack:
+            pipe.rpush(self.machine_key, *stack)
+            self._touch_machine(pipe)
+        pipe.execute()
+
+
+def get_state_store_class(path=None):
+    return import_string(path or settings.STATE_STORE_BACKEND)
+
+
 class StateMixin(models.Model):
-    STATE_KEY = 'state'
+    """
+    Saves which write `state` are compare-and-set on `state_version`: UPDATE ... WHERE state_version = n.
+    If row was changed meanwhile, fresh state is loaded, own state operations are replayed over it and update is
+    retried up to STATE_CAS_RETRIES times, no row locks are taken.
+    """
+    STATE_KEY = STATE_KEY
 
     state = JSONField(null=True, blank=True)
+    state_version = models.IntegerField(default=0, editable=False)
 
     class Meta(object):
         abstract = True
@@ -17,33 +178,75 @@ class StateMixin(models.Model):
         super().__init__(*args, **kwargs)
         if not self.state:
             self.state = {}
+        self._state_store = None
+        self._state_operations = []
+        # in memory counter of state changes made through this instance
+        self.state_revision = 0
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        from app import metrics
+
+        state_field = self._meta.get_field('state')
+        version_field = self._meta.get_field('state_version')
+        if not any(field is state_field for field, _, _ in values):
+            return super()._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+        values = [v for v in values if v[0] is not version_field]
+        for attempt in range(settings.STATE_CAS_RETRIES + 1):
+            version = self.state_version
+            attempt_values = [(f, m, self.state if f is state_field else v) for f, m, v in values]
+            attempt_values.append((version_field, None, version + 1))
+
+            filtered = base_qs.filter(state_version=version)
+            if super()._do_update(filtered, using, pk_val, attempt_values, update_fields, forced_update):
+                self.state_version = version + 1
+                self._state_operations = []
+                metrics.incr('state.cas_write')
+                return True
+
+            fresh = base_qs.filter(pk=pk_val).values_list('state', 'state_version').first()
+            if fresh is None:
+                return False
+
+            metrics.incr('state.cas_conflict')
+            logging.debug('State of %s %s changed concurrently, retry %s', type(self).__name__, pk_val, attempt + 1)
+            # jsonfield decodes only on model instances, values_list returns the stored text
+            state = json.loads(fresh[0]) if isinstance(fresh[0], str) else fresh[0]
+            self.state, self.state_version = (state or {}), fresh[1]
+            for operation in self._state_operations:
+                operation(self.state)
+
+        metrics.incr('state.cas_exhausted')
+        raise StateConflictError('Can not save state of {} {}'.format(type(self).__name__, pk_val))
+
+    @property
+    def state_store(self):
+        if self._state_store is None:
+            self._state_store = get_state_store_class()(self)
+        return self._state_store
 
     def set_state(self, key, value):
-        self.state[key] = value
-        self.save()
+        self.state_revision += 1
+        self.state_store.set(key, value)
 
     def get_state(self, key, default=None):
-        return self.state.get(key, default)
+        return self.state_store.get(key, default)
 
     def remove_state(self, key):
-        if key in self.state:
-            del self.state[key]
-            self.save()
+        self.state_revision += 1
+        self.state_store.remove(key)
 
     def push_state_machine(self, new_state):
-        state = self.get_state(StateMixin.STATE_KEY, [])
-        state.append(new_state)
-        self.set_state(StateMixin.STATE_KEY, state)
+        self.state_revision += 1
+        self.state_store.push(new_state)
 
     def pop_state_machine(self):
-        state = self.get_state(StateMixin.STATE_KEY, [])
-        res = state.pop()
-        self.set_state(StateMixin.STATE_KEY, state)
-        return res
+        self.state_revision += 1
+        return self.state_store.pop()
 
     def clear_state_machine(self):
-        self.set_state(StateMixin.STATE_KEY, [])
+        self.state_revision += 1
+        self.state_store.clear_stack()
 
     def get_state_machine(self):
-        state = self.get_state(StateMixin.STATE_KEY, [])
-        return state[-1] if state else None
+        return self.state_store.top()
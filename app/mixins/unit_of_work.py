@@ -0,0 +1,76 @@
+# common
+import copy
+import logging
+from contextlib import contextmanager
+
+# django
+from django.db import models
+
+# my
+from app import metrics
+
+
+class UnitOfWorkMixin(models.Model):
+    """
+    Plain save() calls made inside `with instance.unit_of_work():` are collected and flushed once at the end
+    as single UPDATE of changed columns only.
+    """
+
+    class Meta(object):
+        abstract = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._uow_depth = 0
+        self._uow_snapshot = None
+        self._uow_saves = 0
+
+    def _uow_values(self):
+        return {f.attname: copy.deepcopy(getattr(self, f.attname))
+                for f in self._meta.concrete_fields if not f.primary_key}
+
+    @contextmanager
+    def unit_of_work(self):
+        if self._uow_depth == 0:
+            self._uow_snapshot = self._uow_values()
+            self._uow_saves = 0
+
+        self._uow_depth += 1
+        try:
+            yield self
+        finally:
+            self._uow_depth -= 1
+            if self._uow_depth == 0:
+                self.flush()
+
+    def save(self, *args, **kwargs):
+        if self._uow_depth and self.pk and not args and not kwargs:
+            self._uow_saves += 1
+            return
+
+        super().save(*args, **kwargs)
+
+        if self._uow_depth:
+            # explicitly saved columns are not dirty anymore
+            saved = kwargs.get('update_fields')
+            values = self._uow_values()
+            for name in (saved or values.keys()):
+                field = self._meta.get_field(name)
+                self._uow_snapshot[field.attname] = values[field.attname]
+
+    def flush(self):
+        values = self._uow_values()
+        auto_now = [f.attname for f in self._meta.concrete_fields if getattr(f, 'auto_now', False)]
+        changed = [name for name, value in values.items()
+                   if name not in auto_now and value != self._uow_snapshot.get(name)]
+
+        metrics.incr('uow.flushes')
+        metrics.incr('uow.saves_requested', self._uow_saves)
+        if changed:
+            super().save(update_fields=changed + auto_now)
+            metrics.incr('uow.writes')
+
+        logging.debug('%s %s: %s saves flushed as %s update of %s', type(self).__name__, self.pk,
+                      self._uow_saves, 1 if changed else 0, changed)
+        self._uow_snapshot = None
+        self._uow_saves = 0
@@ -2,7 +2,7 @@
 import datetime
 
 # django
-from django.db import models
+from django.db import models, connection
 from django.utils import timezone
 from django.dispatch import receiver
 from django.conf import settings
@@ -14,6 +14,7 @@ from model_utils import FieldTracker
 
 # my
 from app.mixins.state import StateMixin
+from app.mixins.unit_of_work import UnitOfWorkMixin
 from app import common
 
 
@@ -35,18 +36,67 @@ class Project(BaseModel):
 
     class Meta(object):
         unique_together = ('telegram_user', 'name')
+        indexes = [
+            # keyset pagination of projects menu
+            models.Index(fields=['telegram_user', '-total_pomodoros', '-id'], name='app_project_keyset_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
 
-class TelegramUser(StateMixin, BaseModel):
+class TelegramUserManager(models.Manager):
+
+    def upsert(self, user_id, first_name, last_name):
+        """
+        Create user or refresh his name with single INSERT ... ON CONFLICT statement, returns actual row.
+        Row is not rewritten if name is not changed.
+        """
+        user = self.model(user_id=str(user_id), first_name=first_name, last_name=last_name)
+        fields = [f for f in self.model._meta.concrete_fields if not f.primary_key]
+        values = [f.get_db_prep_save(f.pre_save(user, True), connection) for f in fields]
+
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        sql = """
+            WITH upsert AS (
+                INSERT INTO {table} ({columns}) VALUES ({placeholders})
+                ON CONFLICT ({user_id}) DO UPDATE
+                    SET {first_name} = EXCLUDED.{first_name},
+                        {last_name} = EXCLUDED.{last_name},
+                        {update_date} = EXCLUDED.{update_date}
+                    WHERE {table}.{first_name} IS DISTINCT FROM EXCLUDED.{first_name}
+                       OR {table}.{last_name} IS DISTINCT FROM EXCLUDED.{last_name}
+                RETURNING *
+            )
+            SELECT * FROM upsert
+            UNION ALL
+            SELECT * FROM {table} WHERE {user_id} = %s AND NOT EXISTS (SELECT 1 FROM upsert)
+        """.format(
+            table=table,
+            columns=', '.join(qn(f.column) for f in fields),
+            placeholders=', '.join(['%s'] * len(fields)),
+            user_id=qn('user_id'),
+            first_name=qn('first_name'),
+            last_name=qn('last_name'),
+            update_date=qn('update_date'),
+        )
+
+        rows = list(self.raw(sql, values + [user.user_id]))
+        if rows:
+            return rows[0]
+
+        # row was inserted by concurrent transaction after statement snapshot
+        return self.get(user_id=user.user_id)
+
+
+class TelegramUser(UnitOfWorkMixin, StateMixin, BaseModel):
     USER_STATUSES = (
         ('active', 'Active'),
         ('banned', 'Banned'),
     )
 
-    user_id = models.CharField(max_length=100, db_index=True)
+    user_id = models.CharField(max_length=100, unique=True)
     first_name = models.CharField(max_length=256, null=True, blank=True)
     last_name = models.CharField(max_length=256, null=True, blank=True)
     pomodoro_duration = models.DurationField(default=datetime.timedelta(minutes=25))
@@ -56,6 +106,8 @@ class TelegramUser(StateMixin, BaseModel):
     current_project = models.ForeignKey(Project, null=True, blank=True, on_delete=models.CASCADE)
     status = models.CharField(max_length=255, default=USER_STATUSES[0][0], db_index=True)
 
+    objects = TelegramUserManager()
+
     def __str__(self):
         parts = []
         if self.first_name:
@@ -227,6 +279,22 @@ def delete_project_pomodoro_count(sender, instance, **kwargs):
         pass
 
 
+@receiver(models.signals.post_save, sender=TelegramUser)
+def store_cached_user(sender, instance, update_fields=None, **kwargs):
+    from app.cache import user_cache
+    # other columns of the instance may be stale, only full save can be cached as is
+    if update_fields:
+        user_cache.invalidate(instance.user_id)
+    else:
+        user_cache.store(instance)
+
+
+@receiver(models.signals.post_delete, sender=TelegramUser)
+def invalidate_cached_user(sender, instance, **kwargs):
+    from app.cache import user_cache
+    user_cache.invalidate(instance.user_id)
+
+
 @receiver(models.signals.post_save, sender=Contact)
 def send_email_to_admin_question(sender, instance, created, **kwargs):
     if created:
@@ -265,3 +333,12 @@ def upload_file(sender, instance, created, **kwargs):
         from app.tasks import upload_telegram_audio_task
         eta = timezone.now() + datetime.timedelta(seconds=5)
         upload_telegram_audio_task.apply_async((instance.id, ), eta=eta)
+    if instance.tracker.has_changed('audio_id') or instance.tracker.has_changed('category'):
+        from app.audio import audio_index
+        audio_index.add(instance, instance.tracker.previous('audio_id'))
+
+
+@receiver(models.signals.post_delete, sender=Audio)
+def remove_indexed_audio(sender, instance, **kwargs):
+    from app.audio import audio_index
+    audio_index.remove(instance)
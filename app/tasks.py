@@ -6,16 +6,18 @@ from post_office import mail
 from www.celery import app
 from django.core.management import call_command
 from admin_logs.decorators import log
-import telepot
 
 # django
 from django.conf import settings
 from django.utils import timezone
 
 # my
+from app import timers
 from app.models import Pomodoro, Rest, TelegramUser, MessageSender, Audio
 from bot import helper
 from bot import messages
+from bot.api import get_bot
+from bot.sender import merge_messages
 
 
 @app.task(ignore_result=True)
@@ -23,10 +25,19 @@ def send_regular_emails_task():
     mail.send_queued()
 
 
+@app.task(ignore_result=True)
+def process_telegram_update_task(raw, token):
+    from bot.telegram import process_update
+    process_update(raw, token)
+
+
 @app.task(ignore_result=True)
 def finish_pomodoro(user_id, pomodoro_id):
     logging.debug('Finish pomodoro user %s, pomodoro %s', user_id, pomodoro_id)
 
+    if timers.is_cancelled('pomodoro', pomodoro_id):
+        return
+
     try:
         telegram_user = TelegramUser.objects.get(id=user_id)
     except TelegramUser.DoesNotExist:
@@ -36,6 +47,11 @@ def finish_pomodoro(user_id, pomodoro_id):
     if current_pomodoro_id != pomodoro_id:
         return
 
+    with telegram_user.unit_of_work():
+        _finish_pomodoro(telegram_user, current_pomodoro_id)
+
+
+def _finish_pomodoro(telegram_user, current_pomodoro_id):
     try:
         current_pomodoro = Pomodoro.objects.get(id=current_pomodoro_id)
         current_pomodoro.status = 'finished'
@@ -45,13 +61,16 @@ def finish_pomodoro(user_id, pomodoro_id):
         telegram_user.remove_state('current_pomodoro_id')
 
         # first pomodoro? ask user to provide feed back
+        texts = []
         options = telegram_user.get_state('options') or []
         if 'first_pomodoro' not in options:
             options.append('first_pomodoro')
             telegram_user.set_state('options', options)
-            helper.send_message_to_user(telegram_user, messages.first_pomodoro_message)
+            texts.append(messages.first_pomodoro_message)
 
-        helper.send_message_to_user(telegram_user, messages.pomodoro_ended_message)
+        texts.append(messages.pomodoro_ended_message)
+        for text, _ in merge_messages([(t, None) for t in texts]):
+            helper.send_message_to_user(telegram_user, text)
     except Pomodoro.DoesNotExist:
         pass
 
@@ -60,6 +79,9 @@ def finish_pomodoro(user_id, pomodoro_id):
 def finish_rest(user_id, rest_id):
     logging.debug('Finish rest user %s, rest %s', user_id, rest_id)
 
+    if timers.is_cancelled('rest', rest_id):
+        return
+
     try:
         telegram_user = TelegramUser.objects.get(id=user_id)
     except TelegramUser.DoesNotExist:
@@ -69,6 +91,11 @@ def finish_rest(user_id, rest_id):
     if current_rest_id != rest_id:
         return
 
+    with telegram_user.unit_of_work():
+        _finish_rest(telegram_user, current_rest_id)
+
+
+def _finish_rest(telegram_user, current_rest_id):
     try:
         current_rest = Rest.objects.get(id=current_rest_id)
         current_rest.status = 'finished'
@@ -88,22 +115,20 @@ def send_messages_task(sender_id):
 
     sender = MessageSender.objects.get(id=sender_id)
 
-    send_users = []
-
     if sender.category == 'all':
         query = TelegramUser.objects.all()
     else:
         raise Exception('Wring category {}'.format(sender.category))
 
-    for telegram_user in query:
-        if telegram_user.id in send_users:
-            continue
-        send_users.append(telegram_user.id)
+    batch = []
+    for telegram_user in query.iterator():
+        batch.append(telegram_user)
+        if len(batch) >= settings.TELEGRAM_BROADCAST_BATCH:
+            helper.send_message_to_users(batch, sender.message)
+            batch = []
 
-        try:
-            helper.send_message_to_user(telegram_user, sender.message)
-        except Exception:
-            logging.exception("Can not send message for user %s" % telegram_user.id)
+    if batch:
+        helper.send_message_to_users(batch, sender.message)
 
     sender.status = 'sent'
     sender.save()
@@ -114,7 +139,7 @@ def upload_telegram_audio_task(audio_id):
     try:
         audio = Audio.objects.get(id=audio_id)
 
-        bot = telepot.Bot(settings.TELEGRAM_BOT_TOKEN)
+        bot = get_bot()
 
         if not audio.audio:
             return
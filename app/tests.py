@@ -1,3 +1,1436 @@
-from django.test import TestCase
+# common
+import datetime
+import json
+import random
+import threading
+from collections import defaultdict
+from unittest import mock
 
-# Create your tests here.
+# django
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+# other
+import redis
+import telepot.exception
+import urllib3
+
+# my
+from app import tasks
+from app import timers
+from app import wheel
+from app.audio import AudioIndex
+from app.cache import user_cache
+from app.finishing import finish_batch
+from app.mixins.state import StateConflictError
+from app.models import Audio, Pomodoro, Project, Rest, TelegramUser
+from app.wheel import TimingWheel
+from bot import callback
+from bot import lanes
+from bot import messages
+from bot import outbound
+from bot.api import CircuitBreaker, CircuitOpenError, ProtectedBot
+from bot.dedup import UpdateDeduplicator
+from bot import helper
+from bot.router import ANY_STATE, PrefixTrie, Router
+from bot.sender import Button, Markup, Sender, merge_messages
+from bot.transport import send_concurrently
+
+
+@mock.patch('app.cache.user_cache.store')
+class StateCASTest(TestCase):
+
+    def setUp(self):
+        with mock.patch('app.cache.user_cache.store'):
+            self.pk = TelegramUser.objects.create(user_id='1').pk
+
+    def test_write_bumps_version(self, store):
+        user = TelegramUser.objects.get(pk=self.pk)
+        user.set_state('a', 1)
+
+        fresh = TelegramUser.objects.get(pk=self.pk)
+        self.assertEqual(fresh.state, {'a': 1})
+        self.assertEqual(fresh.state_version, 1)
+        self.assertEqual(user.state_version, 1)
+
+    def test_concurrent_write_is_replayed(self, store):
+        first = TelegramUser.objects.get(pk=self.pk)
+        second = TelegramUser.objects.get(pk=self.pk)
+
+        first.set_state('a', 1)
+        second.set_state('b', 2)
+
+        fresh = TelegramUser.objects.get(pk=self.pk)
+        self.assertEqual(fresh.state, {'a': 1, 'b': 2})
+        self.assertEqual(fresh.state_version, 2)
+        self.assertEqual(second.state, {'a': 1, 'b': 2})
+        self.assertEqual(second.state_version, 2)
+
+    def test_concurrent_stack_changes_keep_order(self, store):
+        first = TelegramUser.objects.get(pk=self.pk)
+        second = TelegramUser.objects.get(pk=self.pk)
+
+        first.push_state_machine('projects')
+        second.push_state_machine('settings')
+
+        fresh = TelegramUser.objects.get(pk=self.pk)
+        self.assertEqual(fresh.state['state'], ['projects', 'settings'])
+        self.assertEqual(fresh.get_state_machine(), 'settings')
+
+    @override_settings(STATE_CAS_RETRIES=0)
+    def test_conflict_without_retries(self, store):
+        first = TelegramUser.objects.get(pk=self.pk)
+        second = TelegramUser.objects.get(pk=self.pk)
+
+        first.set_state('a', 1)
+        with self.assertRaises(StateConflictError), transaction.atomic():
+            second.set_state('b', 2)
+
+        fresh = TelegramUser.objects.get(pk=self.pk)
+        self.assertEqual(fresh.state, {'a': 1})
+        self.assertEqual(fresh.state_version, 1)
+
+    def test_save_without_state_keeps_version(self, store):
+        user = TelegramUser.objects.get(pk=self.pk)
+        user.first_name = 'Name'
+        user.save(update_fields=['first_name'])
+
+        self.assertEqual(TelegramUser.objects.get(pk=self.pk).state_version, 0)
+
+
+class UpsertTest(TestCase):
+
+    def ctid(self, user_id):
+        # physical location of row, every UPDATE writes new row version
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT ctid FROM app_telegramuser WHERE user_id = %s', [user_id])
+            return cursor.fetchone()[0]
+
+    def test_new_user(self):
+        user = TelegramUser.objects.upsert(10, 'First', 'Last')
+
+        self.assertEqual(user.user_id, '10')
+        self.assertEqual((user.first_name, user.last_name), ('First', 'Last'))
+        self.assertEqual(TelegramUser.objects.get(user_id='10').pk, user.pk)
+
+    def test_same_name_is_not_written(self):
+        created = TelegramUser.objects.upsert(10, 'First', None)
+        ctid = self.ctid('10')
+
+        user = TelegramUser.objects.upsert(10, 'First', None)
+
+        self.assertEqual(user.pk, created.pk)
+        self.assertEqual(user.update_date, created.update_date)
+        self.assertEqual(self.ctid('10'), ctid)
+        self.assertEqual(TelegramUser.objects.count(), 1)
+
+    def test_changed_name(self):
+        created = TelegramUser.objects.upsert(10, 'First', 'Last')
+
+        user = TelegramUser.objects.upsert(10, 'Other', None)
+
+        self.assertEqual(user.pk, created.pk)
+        self.assertEqual((user.first_name, user.last_name), ('Other', None))
+        self.assertGreater(user.update_date, created.update_date)
+        fresh = TelegramUser.objects.get(pk=created.pk)
+        self.assertEqual((fresh.first_name, fresh.last_name), ('Other', None))
+
+
+@mock.patch('app.cache.user_cache.invalidate', mock.Mock())
+@override_settings(STATE_STORE_BACKEND='app.mixins.state.JSONFieldStateStore')
+class UnitOfWorkTest(TestCase):
+
+    def setUp(self):
+        with mock.patch('app.cache.user_cache.store'):
+            self.user = TelegramUser.objects.create(user_id='1', first_name='First')
+
+    def updates(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+
+    def test_saves_are_flushed_as_single_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            with self.user.unit_of_work():
+                self.user.first_name = 'Second'
+                self.user.save()
+                self.user.set_state('a', 1)
+                self.user.push_state_machine('menu')
+
+        updates = self.updates(queries.captured_queries)
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"first_name"', updates[0])
+        self.assertIn('"state"', updates[0])
+        self.assertNotIn('"last_name"', updates[0])
+        self.assertNotIn('"pomodoro_duration"', updates[0])
+
+        fresh = TelegramUser.objects.get(pk=self.user.pk)
+        self.assertEqual(fresh.first_name, 'Second')
+        self.assertEqual(fresh.state, {'a': 1, 'state': ['menu']})
+        self.assertEqual(fresh.state_version, 1)
+
+    def test_nothing_changed(self):
+        with CaptureQueriesContext(connection) as queries:
+            with self.user.unit_of_work():
+                self.user.save()
+                self.user.first_name = 'First'
+                self.user.save()
+
+        self.assertEqual(self.updates(queries.captured_queries), [])
+
+    def test_nested_flushed_by_outer(self):
+        with CaptureQueriesContext(connection) as queries:
+            with self.user.unit_of_work():
+                with self.user.unit_of_work():
+                    self.user.first_name = 'Second'
+                    self.user.save()
+                self.assertEqual(self.updates(queries.captured_queries), [])
+                self.user.last_name = 'Last'
+                self.user.save()
+
+        updates = self.updates(queries.captured_queries)
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"first_name"', updates[0])
+        self.assertIn('"last_name"', updates[0])
+
+    def test_explicit_update_fields_are_written_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            with self.user.unit_of_work():
+                self.user.first_name = 'Second'
+                self.user.save(update_fields=['first_name'])
+                self.user.last_name = 'Last'
+                self.user.save()
+
+        updates = self.updates(queries.captured_queries)
+        self.assertEqual(len(updates), 2)
+        self.assertNotIn('"first_name"', updates[1])
+        self.assertIn('"last_name"', updates[1])
+
+
+@mock.patch('app.cache.user_cache.store', mock.Mock())
+class ProjectsPageTest(TestCase):
+
+    def setUp(self):
+        self.user = TelegramUser.objects.create(user_id='1')
+        totals = {'a1': 5, 'a2': 3, 'b1': 3, 'b2': 3, 'a3': 0, 'b3': 0, 'a4': 7}
+        self.projects = {name: Project.objects.create(telegram_user=self.user, name=name, total_pomodoros=total)
+                         for name, total in totals.items()}
+        other = TelegramUser.objects.create(user_id='2')
+        Project.objects.create(telegram_user=other, name='a0', total_pomodoros=100)
+
+    def walk(self, prefix=None, page_size=2):
+        pages, cursor = [], None
+        while True:
+            rows = helper.get_projects_page(self.user, cursor, prefix, page_size)
+            pages.append([name for _, name, _ in rows[:page_size]])
+            if len(rows) <= page_size:
+                return pages
+            last_id, _, last_total = rows[page_size - 1]
+            cursor = (last_total, last_id)
+
+    def test_pages_follow_order(self):
+        expected = sorted(self.projects.values(), key=lambda p: (-p.total_pomodoros, -p.id))
+        pages = self.walk()
+
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+        self.assertEqual(sum(pages, []), [p.name for p in expected])
+
+    def test_prefix(self):
+        pages = self.walk(prefix='a')
+
+        self.assertEqual(sum(pages, []), ['a4', 'a1', 'a2', 'a3'])
+
+    def test_last_page_has_no_extra_row(self):
+        self.assertEqual(len(helper.get_projects_page(self.user, page_size=7)), 7)
+        self.assertEqual(len(helper.get_projects_page(self.user, page_size=6)), 7)
+
+    def test_menu_key(self):
+        self.user.push_state_machine('projects')
+        key = helper.get_menu_key(self.user, page_size=2)
+        self.assertEqual(key[2], ((self.projects['a4'].id, 'a4'), (self.projects['a1'].id, 'a1')))
+        self.assertEqual(key[3:], (False, True, False))
+
+        a1 = self.projects['a1']
+        self.user.set_state('projects_cursors', [[a1.total_pomodoros, a1.id]])
+        self.user.set_state('projects_prefix', 'a')
+        key = helper.get_menu_key(self.user, page_size=2)
+        self.assertEqual([name for _, name in key[2]], ['a2', 'a3'])
+        self.assertEqual(key[3:], (True, False, True))
+
+
+class PrefixTrieTest(SimpleTestCase):
+
+    def test_longest_match(self):
+        trie = PrefixTrie()
+        trie.add('ab', 'short')
+        trie.add('abcd', 'long')
+
+        self.assertEqual(trie.longest_match('abcdef'), 'long')
+        self.assertEqual(trie.longest_match('abc'), 'short')
+        self.assertIsNone(trie.longest_match('a'))
+        self.assertIsNone(trie.longest_match('x'))
+
+
+class RouterTest(SimpleTestCase):
+
+    def setUp(self):
+        self.router = Router()
+
+        def handler(name):
+            def handle(bot, message):
+                return name
+            handle.__name__ = name
+            return handle
+
+        self.router.route(ANY_STATE, texts=['back'])(handler('any_back'))
+        self.router.fallback(ANY_STATE)(handler('any_fallback'))
+        self.router.route('menu', texts=['back', 'exact'])(handler('menu_exact'))
+        self.router.route('menu', prefixes=['ex'])(handler('menu_prefix'))
+        self.router.fallback('menu')(handler('menu_fallback'))
+        self.router.route(None, texts=['start'])(handler('main_start'))
+
+    def resolve(self, state, message):
+        handler = self.router.resolve(state, message)
+        return handler.__name__ if handler else None
+
+    def test_any_state_first(self):
+        self.assertEqual(self.resolve('menu', 'back'), 'any_back')
+        self.assertEqual(self.resolve('other', 'back'), 'any_back')
+
+    def test_any_state_not_in_main(self):
+        self.assertIsNone(self.resolve(None, 'back'))
+
+    def test_exact_before_prefix(self):
+        self.assertEqual(self.resolve('menu', 'exact'), 'menu_exact')
+        self.assertEqual(self.resolve('menu', 'extra'), 'menu_prefix')
+
+    def test_fallbacks(self):
+        self.assertEqual(self.resolve('menu', 'unknown'), 'menu_fallback')
+        self.assertEqual(self.resolve('other', 'unknown'), 'any_fallback')
+        self.assertEqual(self.resolve(None, 'start'), 'main_start')
+        self.assertIsNone(self.resolve(None, 'unknown'))
+
+    def test_dispatch_calls_hooks(self):
+        hooked = []
+        self.router.add_hook(lambda name, seconds: hooked.append(name))
+
+        self.assertEqual(self.router.dispatch(None, 'menu', 'extra'), 'menu_prefix')
+        self.assertEqual(hooked, ['menu_prefix'])
+        with self.assertRaises(LookupError):
+            self.router.dispatch(None, None, 'unknown')
+
+
+class BotRouterTest(SimpleTestCase):
+    """
+    Resolution of the bot router matches the old if/elif chain of on_chat_message.
+    """
+
+    def assertResolves(self, state, message, name):
+        from bot.bot import router
+        self.assertEqual(router.resolve(state, message).__name__, name)
+
+    def test_main_menu(self):
+        self.assertResolves(None, '/start', 'handle_help')
+        self.assertResolves(None, helper.START_TEXT, 'handle_pomodoro_run_command')
+        self.assertResolves(None, helper.PROJECTS_TEXT + ' (default)', 'handle_projects_menu')
+        self.assertResolves(None, helper.BACK_TEXT, 'handle_main_bad_command')
+        self.assertResolves(None, helper.STATS_DAY_TEXT, 'handle_main_bad_command')
+
+    def test_any_state_before_state_handlers(self):
+        self.assertResolves('projects', helper.BACK_TEXT, 'handle_back')
+        self.assertResolves('new_project', helper.BACK_TEXT, 'handle_back')
+        self.assertResolves('settings', helper.STATS_DAY_TEXT, 'handle_stats_period')
+        self.assertResolves('contact', helper.ADMIN_STATS_TEXT, 'handle_admin_stats')
+
+    def test_state_handlers(self):
+        self.assertResolves('projects', helper.SET_PROJECT_TEXT + ' work', 'handle_set_project')
+        self.assertResolves('projects', helper.NEW_PROJECT_TEXT, 'handle_new_project')
+        self.assertResolves('projects', 'unknown', 'handle_bad_command')
+        self.assertResolves('settings', helper.SETTINGS_REST_LENGTH, 'handle_settings_rest_length')
+        self.assertResolves('settings', 'unknown', 'handle_bad_command')
+        self.assertResolves('new_project', 'work', 'handle_new_project_name')
+        self.assertResolves('settings_session_count', '4', 'handle_set_session_count')
+
+    def test_unknown_state(self):
+        self.assertResolves('removed_state', 'unknown', 'handle_unknown_state')
+
+
+class FakePipeline(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+            return self
+        return call
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class FakeRedis(object):
+    """
+    Dict backed subset of redis client used by tests, expiry is not emulated. Lua scripts are run by python
+    ports registered in `scripts` as {script: function(client, keys, args)}.
+    """
+    scripts = {}
+
+    def __init__(self):
+        self.data = {}
+        self.lists = defaultdict(list)
+        self.zsets = defaultdict(dict)
+        self.hashes = defaultdict(dict)
+        self.sets = defaultdict(set)
+
+    @staticmethod
+    def _bytes(value):
+        return value if isinstance(value, bytes) else str(value).encode('utf8')
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def eval(self, script, numkeys, *args):
+        keys = [str(a) for a in args[:numkeys]]
+        return self.scripts[script](self, keys, [str(a) for a in args[numkeys:]])
+
+    def exists(self, *keys):
+        return sum(1 for key in keys if key in self.data or self.lists.get(key) or self.zsets.get(key)
+                   or self.hashes.get(key) or self.sets.get(key))
+
+    def delete(self, *keys):
+        deleted = self.exists(*keys)
+        for key in keys:
+            for store in (self.data, self.lists, self.zsets, self.hashes, self.sets):
+                store.pop(key, None)
+        return deleted
+
+    def expire(self, key, seconds):
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = self._bytes(value)
+        return True
+
+    def setex(self, key, seconds, value):
+        return self.set(key, value)
+
+    def lpush(self, key, *values):
+        for value in values:
+            self.lists[key].insert(0, self._bytes(value))
+        return len(self.lists[key])
+
+    def rpush(self, key, *values):
+        self.lists[key].extend(self._bytes(v) for v in values)
+        return len(self.lists[key])
+
+    def lpop(self, key):
+        return self.lists[key].pop(0) if self.lists.get(key) else None
+
+    def rpop(self, key):
+        return self.lists[key].pop() if self.lists.get(key) else None
+
+    def brpop(self, keys, timeout=0):
+        for key in ([keys] if isinstance(keys, str) else keys):
+            if self.lists.get(key):
+                return self._bytes(key), self.lists[key].pop()
+        return None
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def lrange(self, key, start, end):
+        items = self.lists.get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lrange(key, start, end)
+        return True
+
+    def lrem(self, key, count, value):
+        value = self._bytes(value)
+        before = len(self.lists.get(key, []))
+        self.lists[key] = [item for item in self.lists.get(key, []) if item != value]
+        return before - len(self.lists[key])
+
+    def sadd(self, key, *members):
+        before = len(self.sets[key])
+        self.sets[key].update(self._bytes(m) for m in members)
+        return len(self.sets[key]) - before
+
+    def srem(self, key, *members):
+        before = len(self.sets.get(key, ()))
+        self.sets[key].difference_update(self._bytes(m) for m in members)
+        return before - len(self.sets[key])
+
+    def scard(self, key):
+        return len(self.sets.get(key, ()))
+
+    def srandmember(self, key, number):
+        members = sorted(self.sets.get(key, ()))
+        return random.sample(members, min(number, len(members)))
+
+    def zadd(self, key, *pairs):
+        for score, member in zip(pairs[::2], pairs[1::2]):
+            self.zsets[key][self._bytes(member)] = float(score)
+        return len(pairs) // 2
+
+    def zscore(self, key, member):
+        return self.zsets.get(key, {}).get(self._bytes(member))
+
+    def zrem(self, key, *members):
+        return sum(1 for m in members if self.zsets[key].pop(self._bytes(m), None) is not None)
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    def zrangebyscore(self, key, min, max, start=None, num=None, withscores=False):
+        items = sorted((score, member) for member, score in self.zsets.get(key, {}).items()
+                       if float(min) <= score <= float(max))
+        if start is not None:
+            items = items[start:start + num]
+        return [(member, score) for score, member in items] if withscores else [member for _, member in items]
+
+    def hmget(self, key, *fields):
+        return [self.hashes.get(key, {}).get(f) for f in fields]
+
+    def hmset(self, key, mapping):
+        for field, value in mapping.items():
+            self.hashes[key][field] = self._bytes(value)
+        return True
+
+
+class CallbackCodecTest(SimpleTestCase):
+    ACTION = 'test_action'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if cls.ACTION not in callback.ACTION_IDS:
+            callback.register_action(255, cls.ACTION)
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('bot.callback.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_empty(self):
+        data = callback.encode(self.ACTION)
+        self.assertEqual(callback.decode(data), (self.ACTION, None))
+
+    def test_ints_inline(self):
+        for payload in ([1, -2, 300], (0, 2 ** 62), []):
+            data = callback.encode(self.ACTION, payload)
+            self.assertLessEqual(len(data), 64)
+            self.assertEqual(callback.decode(data), (self.ACTION, list(payload)))
+        self.assertEqual(self.redis.data, {})
+
+    def test_long_ints_by_reference(self):
+        payload = list(range(1000, 1100))
+        data = callback.encode(self.ACTION, payload)
+
+        self.assertLessEqual(len(data), 64)
+        self.assertEqual(len(self.redis.data), 1)
+        self.assertEqual(callback.decode(data), (self.ACTION, payload))
+
+    def test_reference(self):
+        payload = {'project': 'work', 'page': [1, 2]}
+        data = callback.encode(self.ACTION, payload)
+
+        self.assertLessEqual(len(data), 64)
+        self.assertEqual(callback.decode(data), (self.ACTION, payload))
+
+    def test_expired_reference(self):
+        payload = {'project': 'work'}
+        data = callback.encode(self.ACTION, payload)
+
+        self.redis.data.clear()
+        self.assertIsNone(callback.decode(data))
+
+        # encoding again stores payload again under the same reference
+        self.assertEqual(callback.encode(self.ACTION, payload), data)
+        self.assertEqual(callback.decode(data), (self.ACTION, payload))
+
+    def test_invalid(self):
+        valid = callback.encode(self.ACTION, [1])
+        for data in (None, 1, 'x' * 65, '', '!!!', callback._b64(bytearray([254, callback.KIND_EMPTY])),
+                     callback._b64(bytearray([255, callback.KIND_EMPTY, 1])),
+                     callback._b64(bytearray([255, callback.KIND_REFERENCE, 1, 2])),
+                     callback._b64(bytearray([255, 2, 1])), valid[:2]):
+            self.assertIsNone(callback.decode(data), data)
+
+
+class MergeMessagesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.menu = Markup(buttons=[['menu']])
+        self.other_menu = Markup(buttons=[['other']])
+        self.inline = Markup(inline_buttons=[['inline']])
+
+    def test_plain_texts(self):
+        self.assertEqual(merge_messages([('a\n', None), ('b', None)]), [('a\nb', None)])
+
+    def test_last_reply_keyboard_wins(self):
+        merged = merge_messages([('a', self.menu), ('b', self.other_menu), ('c', None)])
+        self.assertEqual(merged, [('a\nb\nc', self.other_menu)])
+
+    def test_inline_keyboard_ends_text(self):
+        merged = merge_messages([('a', None), ('b', self.inline), ('c', self.menu), ('d', None)])
+        self.assertEqual(merged, [('a\nb', self.inline), ('c\nd', self.menu)])
+
+    def test_inline_keyboards_are_kept(self):
+        other_inline = Markup(inline_buttons=[['other']])
+        merged = merge_messages([('a', self.inline), ('b', other_inline)])
+        self.assertEqual(merged, [('a', self.inline), ('b', other_inline)])
+
+    def test_limit(self):
+        merged = merge_messages([('a' * 3, None), ('b' * 3, None), ('c' * 3, None)], limit=7)
+        self.assertEqual(merged, [('aaa\nbbb', None), ('ccc', None)])
+
+    def test_empty(self):
+        self.assertEqual(merge_messages([]), [])
+
+
+class CircuitBreakerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        for target, value in (('bot.api.time.time', lambda: self.now), ('bot.api.random.uniform', lambda a, b: a)):
+            patcher = mock.patch(target, side_effect=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.breaker = CircuitBreaker('test', failure_rate=0.5, min_calls=4, window=30, cooldown=5,
+                                      max_cooldown=15, consecutive_failures=10)
+
+    def call(self, success):
+        generation = self.breaker.before_call()
+        self.breaker.record(success, generation)
+
+    def open(self):
+        for _ in range(4):
+            self.call(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_stays_closed_below_rate(self):
+        for success in (True, False, True, False):
+            self.call(success)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_stays_closed_below_min_calls(self):
+        for _ in range(3):
+            self.call(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_old_calls_leave_window(self):
+        for _ in range(3):
+            self.call(False)
+        self.now += 31
+        self.call(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_rejects(self):
+        self.open()
+        with self.assertRaises(CircuitOpenError) as context:
+            self.breaker.before_call()
+        self.assertEqual(context.exception.retry_after, 5)
+
+    def test_half_open_success_closes(self):
+        self.open()
+        self.now += 5
+
+        generation = self.breaker.before_call()
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+        self.breaker.record(True, generation)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.cooldown, 5)
+
+    def test_half_open_failure_doubles_cooldown(self):
+        self.open()
+        self.now += 5
+        self.call(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.opened_until, self.now + 10)
+
+        self.now += 10
+        self.call(False)
+        self.now += 15
+        self.call(False)
+        # cooldown is capped by max_cooldown
+        self.assertEqual(self.breaker.opened_until, self.now + 15)
+
+    def test_calls_in_flight_when_opened_are_ignored(self):
+        in_flight = [self.breaker.before_call() for _ in range(3)]
+        self.open()
+        opened_until = self.breaker.opened_until
+
+        for generation in in_flight:
+            self.breaker.record(False, generation)
+        self.assertEqual(self.breaker.opened_until, opened_until)
+
+        self.now += 5
+        generation = self.breaker.before_call()
+        self.breaker.record(False, in_flight[0])
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+        self.breaker.record(True, generation)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+
+    def test_consecutive_failures(self):
+        self.breaker.consecutive_failures = 3
+        self.breaker.min_calls = 100
+        for success in (False, False, True, False, False):
+            self.call(success)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self.call(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_timeout_outage_of_single_threaded_worker(self):
+        def send_message(*args, **kwargs):
+            # every call hangs until read timeout, so window never has min_calls of them
+            self.now += 30
+            raise urllib3.exceptions.ReadTimeoutError(None, '/sendMessage', 'Read timed out.')
+
+        self.breaker.consecutive_failures = 3
+        bot = ProtectedBot(mock.Mock(sendMessage=send_message), self.breaker)
+        for _ in range(3):
+            with self.assertRaises(urllib3.exceptions.ReadTimeoutError):
+                bot.sendMessage(1, 'text')
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            bot.sendMessage(1, 'text')
+
+    def test_telegram_errors_are_not_outage(self):
+        def send_message(*args, **kwargs):
+            raise telepot.exception.TelegramError('Bad Request', 400, {})
+
+        bot = ProtectedBot(mock.Mock(sendMessage=send_message), self.breaker)
+        for _ in range(20):
+            with self.assertRaises(telepot.exception.TelegramError):
+                bot.sendMessage(1, 'text')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+class TimingWheelTest(SimpleTestCase):
+    START = 1000000
+
+    def setUp(self):
+        self.wheel = TimingWheel(now=self.START)
+
+    def assertFires(self, member, due):
+        self.assertEqual(self.wheel.advance(due - 1), [])
+        self.assertEqual(self.wheel.advance(due), [(member, due)])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_seconds(self):
+        self.wheel.insert('a', self.START + 10)
+        self.assertFires('a', self.START + 10)
+
+    def test_cascade_from_minutes(self):
+        self.wheel.insert('a', self.START + 125)
+        self.assertIn('a', self.wheel.minutes[(self.START + 125) // 60 % 60])
+        self.assertFires('a', self.START + 125)
+
+    def test_cascade_from_hours(self):
+        due = self.START + 2 * 3600 + 17
+        self.wheel.insert('a', due)
+        self.assertIn('a', self.wheel.hours[due // 3600 % 24])
+        self.assertFires('a', due)
+
+    def test_cascade_from_overflow(self):
+        due = self.START + 3 * 24 * 3600 + 5
+        self.wheel.insert('a', due)
+        self.assertIn('a', self.wheel.overflow)
+        self.assertFires('a', due)
+
+    def test_fractional_and_past_due(self):
+        self.wheel.insert('a', self.START + 1.5)
+        self.wheel.insert('b', self.START - 100)
+
+        self.assertEqual(self.wheel.advance(self.START), [('b', self.START - 100)])
+        self.assertEqual(self.wheel.advance(self.START + 1), [])
+        self.assertEqual(self.wheel.advance(self.START + 2), [('a', self.START + 1.5)])
+
+    def test_cancel_and_reinsert(self):
+        self.wheel.insert('a', self.START + 10)
+        self.wheel.insert('b', self.START + 10)
+        self.wheel.cancel('a')
+        self.wheel.insert('b', self.START + 200)
+        self.wheel.cancel('missing')
+
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.advance(self.START + 199), [])
+        self.assertEqual(self.wheel.advance(self.START + 200), [('b', self.START + 200)])
+
+    def test_same_slot_of_next_round(self):
+        self.wheel.insert('a', self.START + 5)
+        self.wheel.insert('b', self.START + 65)
+
+        self.assertEqual(self.wheel.advance(self.START + 5), [('a', self.START + 5)])
+        self.assertFires('b', self.START + 65)
+
+
+def _outbound_acquire(client, keys, args):
+    now = float(args[0])
+    global_rate, global_burst, chat_rate, chat_burst = [float(a) for a in args[1:5]]
+    if args[5] == '0' and client.llen(keys[2]) > 0:
+        return [b'0', b'-1']
+
+    def refill(key, rate, burst):
+        tokens, ts = client.hmget(key, 'tokens', 'ts')
+        tokens = float(tokens) if tokens is not None else burst
+        ts = float(ts) if ts is not None else now
+        return min(burst, tokens + max(0, now - ts) * rate)
+
+    global_tokens = refill(keys[0], global_rate, global_burst)
+    chat_tokens = refill(keys[1], chat_rate, chat_burst)
+    if global_tokens >= 1 and chat_tokens >= 1:
+        client.hmset(keys[0], {'tokens': global_tokens - 1, 'ts': now})
+        client.hmset(keys[1], {'tokens': chat_tokens - 1, 'ts': now})
+        return [b'0', b'0']
+
+    global_wait = (1 - global_tokens) / global_rate if global_tokens < 1 else 0
+    chat_wait = (1 - chat_tokens) / chat_rate if chat_tokens < 1 else 0
+    return [str(global_wait).encode(), str(chat_wait).encode()]
+
+
+def _outbound_defer(client, keys, args):
+    due, item, front, chat_id = float(args[0]), args[1], args[2] == '1', args[3]
+    (client.lpush if front else client.rpush)(keys[1], item)
+    current = client.zscore(keys[0], chat_id)
+    if current is None or front and due > current:
+        client.zadd(keys[0], due, chat_id)
+
+
+def _outbound_release(client, keys, args):
+    now, chat_id, gap = float(args[0]), args[1], float(args[2])
+    due = client.zscore(keys[0], chat_id)
+    if due is None or due > now:
+        return 0
+
+    item = client.lpop(keys[1])
+    if client.llen(keys[1]):
+        client.zadd(keys[0], now + gap, chat_id)
+    else:
+        client.zrem(keys[0], chat_id)
+    if item is None:
+        return 0
+
+    priority = json.loads(item.decode('utf8'))['priority']
+    client.rpush(keys[2 + args[3:].index(priority)], item)
+    return 1
+
+
+FakeRedis.scripts.update({
+    outbound._acquire_script: _outbound_acquire,
+    outbound._defer_script: _outbound_defer,
+    outbound._release_script: _outbound_release,
+})
+
+
+@override_settings(TELEGRAM_GLOBAL_RATE=30, TELEGRAM_GLOBAL_BURST=30, TELEGRAM_CHAT_RATE=1, TELEGRAM_CHAT_BURST=1)
+class OutboundTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.now = 1000.0
+        self.sent = []
+        for target, kwargs in (('bot.outbound.get_redis', {'return_value': self.redis}),
+                               ('bot.outbound.time.time', {'side_effect': lambda: self.now}),
+                               ('bot.outbound.send', {'side_effect': lambda m: self.sent.append(m['text'])})):
+            patcher = mock.patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def queued(self, priority):
+        return [json.loads(item.decode('utf8')) for item in self.redis.lrange(outbound.queue_key(priority), 0, -1)]
+
+    def drain(self):
+        while outbound.process_next(timeout=0):
+            pass
+
+    def test_enqueue(self):
+        outbound.enqueue(1, 'hello', Markup(remove_menu=True), 'timer')
+
+        message, = self.queued('timer')
+        self.assertEqual((message['chat_id'], message['text'], message['priority']), (1, 'hello', 'timer'))
+        self.assertEqual(json.loads(message['reply_markup']), {'remove_keyboard': True})
+        self.assertEqual(message['attempts'], 0)
+
+    def test_enqueue_many_in_priority_order(self):
+        outbound.enqueue_many([(1, 'broadcast', None, 'broadcast'), (2, 'reply', None, 'reply'),
+                               (3, 'first timer', None, 'timer'), (4, 'second timer', None, 'timer')])
+        self.assertEqual(len(self.queued('timer')), 2)
+
+        self.drain()
+        self.assertEqual(self.sent, ['first timer', 'second timer', 'reply', 'broadcast'])
+
+    def test_acquire(self):
+        message = {'chat_id': 1}
+        self.assertEqual(outbound.acquire(message), (0, 0))
+
+        global_wait, chat_wait = outbound.acquire(message)
+        self.assertEqual(global_wait, 0)
+        self.assertAlmostEqual(chat_wait, 1)
+
+        # other chats are not limited by this one
+        self.assertEqual(outbound.acquire({'chat_id': 2}), (0, 0))
+
+        self.now += 1
+        self.assertEqual(outbound.acquire(message), (0, 0))
+
+    def test_acquire_behind_held(self):
+        outbound.defer({'chat_id': 1, 'attempts': 0}, 10, 'test')
+        self.assertEqual(outbound.acquire({'chat_id': 1}), (0, -1))
+        self.assertEqual(outbound.acquire({'chat_id': 1, 'held': True}), (0, 0))
+
+    def test_defer_and_release(self):
+        outbound.defer(outbound._message(1, 'a', None, 'reply'), 5, 'test')
+        self.assertEqual(self.redis.zscore(outbound.DELAYED_KEY, 1), self.now + 5)
+
+        outbound.release()
+        self.assertEqual(self.queued('reply'), [])
+
+        self.now += 5
+        outbound.release()
+        message, = self.queued('reply')
+        self.assertEqual((message['text'], message['attempts'], message['held']), ('a', 1, True))
+        self.assertEqual(self.redis.zcard(outbound.DELAYED_KEY), 0)
+
+    def test_throttled_chat_keeps_order_and_does_not_block_others(self):
+        for text in ('a', 'b', 'c'):
+            outbound.enqueue(1, text)
+        outbound.enqueue(2, 'x')
+
+        self.drain()
+        self.assertEqual(self.sent, ['a', 'x'])
+        self.assertEqual(self.redis.llen(outbound.held_key(1)), 2)
+
+        self.now += 1
+        self.drain()
+        self.assertEqual(self.sent, ['a', 'x', 'b'])
+
+        outbound.enqueue(1, 'd')
+        self.now += 1
+        self.drain()
+        self.now += 1
+        self.drain()
+        self.assertEqual(self.sent, ['a', 'x', 'b', 'c', 'd'])
+        self.assertEqual(self.redis.zcard(outbound.DELAYED_KEY), 0)
+
+
+@override_settings(TELEGRAM_LANE_MAX_ATTEMPTS=3, TELEGRAM_LANE_RETRY_DELAY=1)
+class LanesTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.sleeps = []
+        for target, kwargs in (('bot.lanes.time.sleep', {'side_effect': self.sleeps.append}),
+                               ('bot.lanes.close_old_connections', {})):
+            patcher = mock.patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.item = json.dumps(['token', '{"update_id": 1}']).encode('utf8')
+        self.redis.lpush(lanes.processing_key(0), self.item)
+
+    def handler(self, failures):
+        calls = []
+
+        def handle(raw, token, replay=False):
+            calls.append((raw, token, replay))
+            if len(calls) <= failures:
+                raise ValueError('failure')
+        return handle, calls
+
+    def test_success(self):
+        handler, calls = self.handler(0)
+        lanes._process(self.redis, 0, self.item, handler, replay=True)
+
+        self.assertEqual(calls, [('{"update_id": 1}', 'token', True)])
+        self.assertEqual(self.redis.llen(lanes.processing_key(0)), 0)
+
+    def test_retried_in_place(self):
+        handler, calls = self.handler(2)
+        lanes._process(self.redis, 0, self.item, handler)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.sleeps, [1, 2])
+        self.assertEqual(self.redis.llen(lanes.processing_key(0)), 0)
+        self.assertEqual(self.redis.llen(lanes.dead_key(0)), 0)
+
+    def test_dead_letter(self):
+        handler, calls = self.handler(3)
+        lanes._process(self.redis, 0, self.item, handler)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self.redis.llen(lanes.processing_key(0)), 0)
+        self.assertEqual(self.redis.lrange(lanes.dead_key(0), 0, -1), [self.item])
+
+    def test_broken_item(self):
+        handler, calls = self.handler(0)
+        lanes._process(self.redis, 0, b'broken', handler)
+        self.assertEqual(calls, [])
+
+    def test_ring_is_stable(self):
+        ring = lanes.HashRing(8)
+        self.assertEqual([ring.get_lane(chat_id) for chat_id in range(100)],
+                         [lanes.HashRing(8).get_lane(chat_id) for chat_id in range(100)])
+        self.assertTrue(all(0 <= ring.get_lane(chat_id) < 8 for chat_id in range(100)))
+
+
+class UserCacheTest(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('app.cache.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = TelegramUser.objects.create(user_id='1', first_name='First')
+
+    def test_full_save_is_stored(self):
+        self.assertEqual(user_cache.get('1').first_name, 'First')
+
+        self.user.first_name = 'Second'
+        self.user.save()
+        cached = user_cache.get('1')
+        self.assertEqual((cached.pk, cached.first_name), (self.user.pk, 'Second'))
+
+    def test_partial_save_invalidates(self):
+        stale = TelegramUser.objects.get(pk=self.user.pk)
+        self.user.set_state('current_pomodoro_id', 1)
+
+        stale.first_name = 'Second'
+        stale.save(update_fields=['first_name'])
+        self.assertIsNone(user_cache.get('1'))
+
+    def test_unit_of_work_flush_invalidates(self):
+        with self.user.unit_of_work():
+            self.user.first_name = 'Second'
+            self.user.save()
+        self.assertIsNone(user_cache.get('1'))
+
+    def test_delete_invalidates(self):
+        self.user.delete()
+        self.assertIsNone(user_cache.get('1'))
+
+
+@override_settings(TELEGRAM_OUTBOUND_QUEUE=True)
+class FinishBatchTest(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        for target in ('app.finishing.get_redis', 'app.cache.get_redis', 'bot.outbound.get_redis'):
+            patcher = mock.patch(target, return_value=self.redis)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = TelegramUser.objects.create(user_id='100')
+        self.user.current_project = Project.objects.create(name='default', telegram_user=self.user)
+        self.user.save()
+
+    def start(self, model, state_key=None):
+        activity = model.objects.create(telegram_user=self.user, project=self.user.current_project,
+                                        start_date=timezone.now() - datetime.timedelta(minutes=30))
+        if state_key:
+            self.user.set_state(state_key, activity.id)
+        return activity
+
+    def member(self, kind, activity):
+        return timers.timer_member(kind, self.user.pk, activity.id)
+
+    def queued(self):
+        return [json.loads(item.decode('utf8')) for item in self.redis.lrange(outbound.queue_key('timer'), 0, -1)]
+
+    def test_finish_pomodoro(self):
+        pomodoro = self.start(Pomodoro, 'current_pomodoro_id')
+        version = TelegramUser.objects.get(pk=self.user.pk).state_version
+
+        self.assertEqual(finish_batch([self.member('pomodoro', pomodoro)]), 1)
+
+        pomodoro.refresh_from_db()
+        self.assertEqual(pomodoro.status, 'finished')
+        self.assertIsNotNone(pomodoro.end_date)
+
+        user = TelegramUser.objects.get(pk=self.user.pk)
+        self.assertIsNone(user.get_state('current_pomodoro_id'))
+        self.assertEqual(user.get_state('options'), ['first_pomodoro'])
+        self.assertEqual(user.state_version, version + 1)
+
+        message, = self.queued()
+        self.assertEqual(message['chat_id'], '100')
+        self.assertIn(messages.first_pomodoro_message.strip('\n'), message['text'])
+        self.assertIn(messages.pomodoro_ended_message.strip('\n'), message['text'])
+
+    def test_second_pomodoro_is_not_first(self):
+        self.user.set_state('options', ['first_pomodoro'])
+        pomodoro = self.start(Pomodoro, 'current_pomodoro_id')
+
+        finish_batch([self.member('pomodoro', pomodoro)])
+
+        self.assertEqual(TelegramUser.objects.get(pk=self.user.pk).get_state('options'), ['first_pomodoro'])
+        message, = self.queued()
+        self.assertEqual(message['text'], messages.pomodoro_ended_message.strip('\n'))
+
+    def test_finish_rest(self):
+        rest = self.start(Rest, 'current_rest_id')
+
+        self.assertEqual(finish_batch([self.member('rest', rest)]), 1)
+
+        rest.refresh_from_db()
+        self.assertEqual(rest.status, 'finished')
+        user = TelegramUser.objects.get(pk=self.user.pk)
+        self.assertIsNone(user.get_state('current_rest_id'))
+        self.assertIsNone(user.get_state('options'))
+        self.assertEqual(len(self.queued()), 1)
+
+    def test_skipped_activities(self):
+        # not current activity of the user, cancelled one and already finished one
+        stale = self.start(Pomodoro)
+        cancelled = self.start(Rest, 'current_rest_id')
+        self.redis.set(timers.tombstone_key('rest', cancelled.id), 1)
+        finished = self.start(Pomodoro, 'current_pomodoro_id')
+        Pomodoro.objects.filter(pk=finished.pk).update(status='finished')
+        version = TelegramUser.objects.get(pk=self.user.pk).state_version
+
+        members = [self.member('pomodoro', stale), self.member('rest', cancelled), self.member('pomodoro', finished)]
+        self.assertEqual(finish_batch(members), 0)
+
+        self.assertEqual(Pomodoro.objects.get(pk=stale.pk).status, 'started')
+        self.assertEqual(Rest.objects.get(pk=cancelled.pk).status, 'started')
+        self.assertEqual(TelegramUser.objects.get(pk=self.user.pk).state_version, version)
+        self.assertEqual(self.queued(), [])
+
+    def test_batch_of_users(self):
+        pomodoro = self.start(Pomodoro, 'current_pomodoro_id')
+        other = TelegramUser.objects.create(user_id='200')
+        other.current_project = Project.objects.create(name='default', telegram_user=other)
+        other.save()
+        rest = Rest.objects.create(telegram_user=other, start_date=timezone.now())
+        other.set_state('current_rest_id', rest.id)
+
+        members = [self.member('pomodoro', pomodoro), timers.timer_member('rest', other.pk, rest.id)]
+        self.assertEqual(finish_batch(members), 2)
+        self.assertEqual(sorted(m['chat_id'] for m in self.queued()), ['100', '200'])
+
+
+@mock.patch('bot.dedup.metrics', mock.Mock())
+class DedupTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('bot.dedup.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make(self):
+        return UpdateDeduplicator(ttl=3600, local_size=10, lease=60)
+
+    def test_duplicate_while_lease_is_held(self):
+        worker, other = self.make(), self.make()
+        self.assertFalse(worker.seen(1, 100))
+
+        self.assertTrue(worker.seen(1, 100))
+        self.assertTrue(other.seen(1, 100))
+        self.assertFalse(other.is_done(1, 100))
+
+    def test_duplicate_after_done(self):
+        worker, other = self.make(), self.make()
+        worker.seen(1, 100)
+        worker.done(1, 100)
+
+        self.assertTrue(worker.seen(1, 100))
+        self.assertTrue(other.seen(1, 100))
+        self.assertTrue(other.is_done(1, 100))
+
+    def test_forget_after_failure(self):
+        worker, other = self.make(), self.make()
+        worker.seen(1, 100)
+        worker.forget(1, 100)
+
+        self.assertFalse(other.seen(1, 100))
+        other.forget(1, 100)
+        self.assertFalse(worker.seen(1, 100))
+
+    def test_bots_are_separate(self):
+        worker = self.make()
+        worker.seen(1, 100)
+
+        self.assertFalse(worker.seen(2, 100))
+
+    def test_local_index_is_bounded(self):
+        worker = self.make()
+        for update_id in range(20):
+            worker.seen(1, update_id)
+
+        self.assertEqual(len(worker._local), 10)
+
+
+class AudioIndexTest(TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('app.audio.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.index = AudioIndex(no_repeat=2)
+        self.audios = [Audio.objects.create(name=str(i), category='programming', audio_id='audio{}'.format(i))
+                       for i in range(3)]
+
+    def indexed(self):
+        return {a.decode('utf8') for a in self.redis.sets[AudioIndex._key('programming')]}
+
+    def test_signals_keep_index(self):
+        self.assertEqual(self.indexed(), {'audio0', 'audio1', 'audio2'})
+
+        self.audios[0].audio_id = 'new'
+        self.audios[0].save()
+        self.audios[1].delete()
+        self.assertEqual(self.indexed(), {'new', 'audio2'})
+
+    def test_missing_index_is_rebuilt(self):
+        self.redis.delete(AudioIndex._key('programming'))
+
+        self.assertEqual(self.index.pick()[0], 'programming')
+        self.assertEqual(self.indexed(), {'audio0', 'audio1', 'audio2'})
+
+    def test_no_repeat(self):
+        self.redis.set(AudioIndex.READY_KEY, 1)
+        picks = [self.index.pick(user_id=1)[1] for _ in range(30)]
+
+        for i in range(2, len(picks)):
+            self.assertEqual(len(set(picks[i - 2:i + 1])), 3)
+        self.assertEqual(len(self.redis.lists[AudioIndex._recent_key(1)]), 2)
+
+    def test_empty(self):
+        Audio.objects.all().delete()
+
+        self.assertIsNone(self.index.pick())
+
+    def test_redis_error(self):
+        with mock.patch.object(self.redis, 'pipeline', side_effect=redis.RedisError):
+            self.assertIsNone(self.index.pick())
+
+
+def _timers_claim(client, keys, args):
+    due = client.zrangebyscore(keys[0], '-inf', args[0], start=0, num=int(args[1]), withscores=True)
+    for member, _ in due:
+        client.zrem(keys[0], member)
+        client.zadd(keys[1], args[0], member)
+    return [value for member, score in due for value in (member, str(score).encode())]
+
+
+def _timers_requeue(client, keys, args):
+    expired = client.zrangebyscore(keys[1], '-inf', args[1])
+    for member in expired:
+        client.zrem(keys[1], member)
+        client.zadd(keys[0], args[0], member)
+    return len(expired)
+
+
+FakeRedis.scripts.update({
+    timers._claim_script: _timers_claim,
+    timers._requeue_script: _timers_requeue,
+})
+
+
+@mock.patch('app.timers.metrics', mock.Mock())
+@override_settings(TIMER_BACKEND='redis', TIMER_CLAIM_LEASE=60)
+class RedisTimersTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.now = 1000.0
+        self.finished = []
+        for target, kwargs in (('app.timers.get_redis', {'return_value': self.redis}),
+                               ('app.timers.time.time', {'side_effect': lambda: self.now}),
+                               ('app.finishing.finish_batch', {'side_effect': self.finished.append})):
+            patcher = mock.patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def pending(self, key=timers.TIMERS_KEY):
+        return sorted(m.decode('utf8') for m in self.redis.zrangebyscore(key, '-inf', '+inf'))
+
+    def test_claim_due_only(self):
+        timers.schedule('pomodoro', 1, 10, 0)
+        timers.schedule('rest', 2, 20, 5)
+        timers.schedule('pomodoro', 3, 30, -5)
+
+        self.assertEqual(timers.claim(10), [('pomodoro:3:30', 995.0), ('pomodoro:1:10', 1000.0)])
+        self.assertEqual(self.pending(), ['rest:2:20'])
+        self.assertEqual(self.pending(timers.PROCESSING_KEY), ['pomodoro:1:10', 'pomodoro:3:30'])
+        self.assertEqual(timers.claim(10), [])
+
+    def test_claim_batch(self):
+        for activity_id in range(5):
+            timers.schedule('pomodoro', 1, activity_id, -activity_id)
+
+        self.assertEqual(len(timers.claim(2)), 2)
+        self.assertEqual(len(self.pending()), 3)
+
+    def test_process_due(self):
+        timers.schedule('pomodoro', 1, 10, 0)
+        timers.schedule('rest', 2, 20, 0)
+        timers.schedule('rest', 3, 30, 5)
+
+        self.assertEqual(timers.process_due(), 2)
+        self.assertEqual(self.finished, [['pomodoro:1:10', 'rest:2:20']])
+        self.assertEqual(self.pending(timers.PROCESSING_KEY), [])
+        self.assertEqual(timers.process_due(), 0)
+
+    def test_failed_batch_is_requeued_after_lease(self):
+        timers.schedule('pomodoro', 1, 10, 0)
+        with mock.patch('app.finishing.finish_batch', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                timers.process_due()
+        self.assertEqual(self.pending(timers.PROCESSING_KEY), ['pomodoro:1:10'])
+
+        self.now += 30
+        self.assertEqual(timers.requeue_expired(), 0)
+
+        self.now += 31
+        self.assertEqual(timers.requeue_expired(), 1)
+        self.assertEqual(self.pending(timers.PROCESSING_KEY), [])
+        self.assertEqual(timers.process_due(), 1)
+        self.assertEqual(self.finished, [['pomodoro:1:10']])
+
+
+@mock.patch('app.timers.metrics', mock.Mock())
+@override_settings(SERVER='prod', TIMER_BACKEND='celery')
+class TombstoneTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        patcher = mock.patch('app.timers.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def activity(self, activity_id=10, minutes=25, started=5):
+        return mock.Mock(id=activity_id, duration=datetime.timedelta(minutes=minutes),
+                         start_date=timezone.now() - datetime.timedelta(minutes=started))
+
+    def test_cancel(self):
+        with mock.patch.object(self.redis, 'setex', wraps=self.redis.setex) as setex:
+            timers.cancel('pomodoro', 1, self.activity())
+
+        key, ttl, _ = setex.call_args[0]
+        self.assertEqual(key, timers.tombstone_key('pomodoro', 10))
+        self.assertAlmostEqual(ttl, 20 * 60 + timers.TOMBSTONE_SLACK, delta=2)
+        self.assertTrue(timers.is_cancelled('pomodoro', 10))
+        self.assertFalse(timers.is_cancelled('rest', 10))
+        self.assertFalse(timers.is_cancelled('pomodoro', 11))
+
+    def test_overdue_keeps_slack(self):
+        with mock.patch.object(self.redis, 'setex', wraps=self.redis.setex) as setex:
+            timers.cancel('rest', 1, self.activity(minutes=5, started=10))
+
+        self.assertEqual(setex.call_args[0][1], timers.TOMBSTONE_SLACK)
+
+    @override_settings(TIMER_BACKEND='redis')
+    def test_redis_timer_is_removed(self):
+        timers.schedule('pomodoro', 1, 10, 60)
+        timers.schedule('pomodoro', 1, 11, 60)
+        timers.cancel('pomodoro', 1, self.activity())
+
+        self.assertEqual(list(self.redis.zsets[timers.TIMERS_KEY]), [b'pomodoro:1:11'])
+
+    @override_settings(TIMER_BACKEND='wheel')
+    def test_wheel_timer_is_cancelled(self):
+        timers.cancel('pomodoro', 1, self.activity())
+
+        self.assertEqual(json.loads(self.redis.lists[wheel.INBOX_KEY][0].decode('utf8')), ['cancel', 'pomodoro:1:10'])
+
+    @mock.patch('app.tasks.TelegramUser.objects.get')
+    def test_cancelled_task_does_nothing(self, get):
+        timers.cancel('pomodoro', 1, self.activity())
+
+        tasks.finish_pomodoro(1, 10)
+        self.assertFalse(get.called)
+
+
+@mock.patch('bot.transport.metrics', mock.MagicMock())
+class TransportTest(SimpleTestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.barrier = None
+        self.bot = mock.Mock()
+        self.bot.sendMessage.side_effect = self.send_message
+        patcher = mock.patch('bot.transport.get_bot', return_value=self.bot)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        if self.barrier:
+            self.barrier.wait()
+        if text == 'fail':
+            raise telepot.exception.BotWasBlockedError('blocked', 403, {})
+        self.sent.append((chat_id, text))
+        return text
+
+    def calls(self, *items):
+        return [('sendMessage', item, {}) for item in items]
+
+    def test_calls_are_concurrent(self):
+        self.barrier = threading.Barrier(3, timeout=5)
+
+        results = send_concurrently(self.calls((1, 'a'), (2, 'b'), (3, 'c')), concurrency=3)
+        self.assertEqual(results, ['a', 'b', 'c'])
+
+    def test_errors_are_returned(self):
+        results = send_concurrently(self.calls((1, 'a'), (2, 'fail'), (3, 'c')))
+
+        self.assertEqual(results[::2], ['a', 'c'])
+        self.assertIsInstance(results[1], telepot.exception.BotWasBlockedError)
+
+    def test_same_key_keeps_order(self):
+        calls = self.calls((1, 'a'), (2, 'x'), (1, 'b'), (1, 'fail'), (1, 'c'))
+        results = send_concurrently(calls, concurrency=5, keys=[1, 2, 1, 1, 1])
+
+        self.assertEqual([text for chat_id, text in self.sent if chat_id == 1], ['a', 'b'])
+        self.assertEqual(results[:3], ['a', 'x', 'b'])
+        self.assertIs(results[3], results[4])
+
+    def test_sender_outbox(self):
+        sender = Sender('telegram', 1)
+        with sender.outbox():
+            sender.sendMessage('a')
+            sender.sendMessage('b', reply_markup=Markup(inline_buttons=[[Button('b', url='https://t.me')]]))
+            sender.sendMessage('c')
+        sender.sendMessage('d')
+
+        self.assertEqual(self.sent, [(1, 'a\nb'), (1, 'c'), (1, 'd')])
+
+    def test_direct_send_flushes_outbox(self):
+        sender = Sender('telegram', 1, query_id='q')
+        with sender.outbox():
+            sender.sendMessage('a')
+            sender.answer('ok')
+            sender.sendMessage('b')
+
+        self.assertEqual([name for name, _, _ in self.bot.method_calls],
+                         ['sendMessage', 'answerCallbackQuery', 'sendMessage'])
+        self.assertEqual(self.sent, [(1, 'a'), (1, 'b')])
+
+    def test_sender_raises(self):
+        with self.assertRaises(telepot.exception.BotWasBlockedError):
+            Sender('telegram', 1).sendMessage('fail')
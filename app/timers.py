@@ -0,0 +1,175 @@
+# common
+import datetime
+import logging
+import time
+
+# django
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+# my
+from app import metrics
+from app.common import get_redis
+
+
+TIMERS_KEY = 'timers'
+PROCESSING_KEY = 'timers:processing'
+
+KINDS = ('pomodoro', 'rest')
+
+# tombstone outlives due time a bit, so late timer of cancelled activity is still recognized
+TOMBSTONE_SLACK = 60
+
+# move up to ARGV[2] timers due at ARGV[1] to processing set scored by claim time, returns member, due pairs
+_claim_script = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #due, 2 do
+    redis.call('ZREM', KEYS[1], due[i])
+    redis.call('ZADD', KEYS[2], ARGV[1], due[i])
+end
+return due
+"""
+
+# return timers claimed before ARGV[2] (lease is over: poller crashed or batch failed) back as due at ARGV[1]
+_requeue_script = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[2])
+for i = 1, #expired do
+    redis.call('ZREM', KEYS[2], expired[i])
+    redis.call('ZADD', KEYS[1], ARGV[1], expired[i])
+end
+return #expired
+"""
+
+
+def get_countdown(duration):
+    return 10 if settings.SERVER == 'dev' else duration.seconds
+
+
+def timer_member(kind, user_id, activity_id):
+    return '{}:{}:{}'.format(kind, user_id, activity_id)
+
+
+def parse_member(member):
+    kind, user_id, activity_id = member.split(':')
+    return kind, int(user_id), int(activity_id)
+
+
+def schedule(kind, user_id, activity_id, countdown):
+    """
+    Schedule finish of pomodoro or rest after countdown seconds, returns celery task id for 'celery' backend.
+    """
+    assert kind in KINDS
+
+    if settings.TIMER_BACKEND == 'redis':
+        get_redis().zadd(TIMERS_KEY, time.time() + countdown, timer_member(kind, user_id, activity_id))
+        return None
+
+    if settings.TIMER_BACKEND == 'wheel':
+        from app import wheel
+        wheel.push(kind, user_id, activity_id, countdown)
+        return None
+
+    from app.tasks import finish_pomodoro, finish_rest
+    task = finish_pomodoro if kind == 'pomodoro' else finish_rest
+    eta = timezone.now() + datetime.timedelta(seconds=countdown)
+    return task.apply_async(args=(user_id, activity_id), eta=eta).id
+
+
+def tombstone_key(kind, activity_id):
+    return 'timer:cancelled:{}:{}'.format(kind, activity_id)
+
+
+def cancel(kind, user_id, activity):
+    """
+    Cancel timer of stopped pomodoro or rest. Tombstone lives until the timer is due and is checked by finish
+    tasks in O(1), so there is no need to broadcast celery revoke to every worker.
+    """
+    due = activity.start_date + datetime.timedelta(seconds=get_countdown(activity.duration))
+    ttl = max(int((due - timezone.now()).total_seconds()), 0) + TOMBSTONE_SLACK
+    member = timer_member(kind, user_id, activity.id)
+
+    pipe = get_redis().pipeline()
+    pipe.setex(tombstone_key(kind, activity.id), ttl, 1)
+    if settings.TIMER_BACKEND == 'redis':
+        pipe.zrem(TIMERS_KEY, member)
+    elif settings.TIMER_BACKEND == 'wheel':
+        from app import wheel
+        wheel.push_cancel(pipe, member)
+    pipe.execute()
+
+    metrics.incr('timers.cancelled.' + kind)
+
+
+def is_cancelled(kind, activity_id):
+    if get_redis().exists(tombstone_key(kind, activity_id)):
+        metrics.incr('timers.tombstone_hits.' + kind)
+        return True
+    return False
+
+
+def claim(batch):
+    due = get_redis().eval(_claim_script, 2, TIMERS_KEY, PROCESSING_KEY, time.time(), batch)
+    return [(due[i].decode('utf8'), float(due[i + 1])) for i in range(0, len(due), 2)]
+
+
+def requeue_expired():
+    now = time.time()
+    requeued = get_redis().eval(_requeue_script, 2, TIMERS_KEY, PROCESSING_KEY, now,
+                                now - settings.TIMER_CLAIM_LEASE)
+    if requeued:
+        metrics.incr('timers.requeued', requeued)
+    return requeued
+
+
+def process_due(batch=100):
+    """
+    Finish activities of one claimed batch of due timers, returns number of claimed timers. Failed batch stays
+    in processing set and is claimed again after TIMER_CLAIM_LEASE.
+    """
+    from app.finishing import finish_batch
+
+    claimed = claim(batch)
+    if not claimed:
+        return 0
+
+    now = time.time()
+    for member, due in claimed:
+        metrics.timing('timers.lateness', max(now - due, 0))
+
+    members = [member for member, _ in claimed]
+    finish_batch(members)
+    get_redis().zrem(PROCESSING_KEY, *members)
+
+    metrics.incr('timers.fired', len(claimed))
+    return len(claimed)
+
+
+def run(batch=100, interval=0.5):
+    """
+    Poll due timers. Claims are atomic so several pollers can run, timers claimed longer than TIMER_CLAIM_LEASE
+    ago (crashed poller or failed batch) are returned back (finishing ignores activities which are already
+    finished).
+    """
+    client = get_redis()
+
+    last_depth = 0
+    errors = 0
+    while True:
+        close_old_connections()
+        try:
+            requeue_expired()
+            fired = process_due(batch)
+
+            if time.time() - last_depth >= settings.METRICS_FLUSH_INTERVAL:
+                metrics.gauge('timers.pending', client.zcard(TIMERS_KEY), track_max=True)
+                last_depth = time.time()
+            errors = 0
+        except Exception:
+            logging.exception('Can not process due timers')
+            errors += 1
+            time.sleep(min(interval * 2 ** errors, 30))
+            continue
+
+        if fired < batch:
+            time.sleep(interval)
@@ -0,0 +1,180 @@
+# common
+import json
+import logging
+import math
+import time
+
+# django
+from django.conf import settings
+from django.db import close_old_connections
+
+# my
+from app import common
+from app import metrics
+from app import timers
+from app.common import get_redis
+from app.finishing import finish_batch
+
+
+INBOX_KEY = 'timers:inbox'
+
+# timers fired in the same second are finished in batches of this size
+FINISH_BATCH = 500
+
+RETRY_DELAY = 5
+
+
+class TimingWheel(object):
+    """
+    Hierarchical timing wheel with one second tick: 60 second slots, 60 minute slots and 24 hour slots, later
+    timers wait in overflow set. Timers are cascaded to lower level when their slot comes, insert and cancel are O(1)
+    and tick cost does not depend on number of pending timers.
+    """
+
+    def __init__(self, now=None):
+        self.tick = int(now if now is not None else time.time())
+        self.seconds = [set() for _ in range(60)]
+        self.minutes = [set() for _ in range(60)]
+        self.hours = [set() for _ in range(24)]
+        self.overflow = set()
+        self.due = {}
+        self.slots = {}
+
+    def __len__(self):
+        return len(self.due)
+
+    def _slot(self, due):
+        if due - self.tick < 60:
+            return self.seconds[due % 60]
+        if due // 60 - self.tick // 60 < 60:
+            return self.minutes[due // 60 % 60]
+        if due // 3600 - self.tick // 3600 < 24:
+            return self.hours[due // 3600 % 24]
+        return self.overflow
+
+    def insert(self, member, due):
+        self.cancel(member)
+        self.due[member] = due
+        slot = self._slot(max(math.ceil(due), self.tick))
+        slot.add(member)
+        self.slots[member] = slot
+
+    def cancel(self, member):
+        slot = self.slots.pop(member, None)
+        if slot is not None:
+            slot.discard(member)
+            del self.due[member]
+
+    def _cascade(self, slot):
+        members = list(slot)
+        slot.clear()
+        for member in members:
+            self.insert(member, self.due[member])
+
+    def advance(self, now):
+        """
+        Process all ticks up to now, returns list of (member, due) of fired timers.
+        """
+        fired = []
+        while self.tick <= now:
+            if self.tick % 3600 == 0:
+                self._cascade(self.overflow)
+                self._cascade(self.hours[self.tick // 3600 % 24])
+            if self.tick % 60 == 0:
+                self._cascade(self.minutes[self.tick // 60 % 60])
+
+            slot = self.seconds[self.tick % 60]
+            for member in list(slot):
+                fired.append((member, self.due[member]))
+                self.cancel(member)
+
+            self.tick += 1
+        return fired
+
+
+def push(kind, user_id, activity_id, countdown):
+    member = timers.timer_member(kind, user_id, activity_id)
+    get_redis().lpush(INBOX_KEY, json.dumps(['insert', member, time.time() + countdown]))
+
+
+def push_cancel(client, member):
+    client.lpush(INBOX_KEY, json.dumps(['cancel', member]))
+
+
+def rebuild(wheel):
+    """
+    Load timers of all started pomodoros and rests, so timers lost by restart or redis flush still fire.
+    """
+    from app.models import Pomodoro, Rest
+
+    for kind, model in (('pomodoro', Pomodoro), ('rest', Rest)):
+        rows = model.objects.filter(status='started').values_list('id', 'telegram_user_id', 'start_date', 'duration')
+        for activity_id, user_id, start_date, duration in rows.iterator():
+            due = start_date.timestamp() + timers.get_countdown(duration)
+            wheel.insert(timers.timer_member(kind, user_id, activity_id), due)
+
+    metrics.gauge('timers.pending', len(wheel))
+    logging.info('Timing wheel is rebuilt with %s timers', len(wheel))
+
+
+def _apply(wheel, raw):
+    op, member, *due = json.loads(raw.decode('utf8'))
+    if op == 'insert':
+        wheel.insert(member, due[0])
+    else:
+        wheel.cancel(member)
+
+
+def _receive(client, wheel):
+    """
+    Apply all waiting inbox items, waits up to a second for the first one.
+    """
+    item = client.brpop(INBOX_KEY, 1)
+    if item is None:
+        return
+    _apply(wheel, item[1])
+
+    raw = client.rpop(INBOX_KEY)
+    while raw is not None:
+        _apply(wheel, raw)
+        raw = client.rpop(INBOX_KEY)
+
+
+def run():
+    """
+    Standalone scheduler process (TIMER_BACKEND = 'wheel'), new timers come through redis inbox list.
+    Timers of failed batch are fired again after RETRY_DELAY seconds.
+    """
+    client = get_redis()
+    wheel = TimingWheel()
+    rebuild(wheel)
+
+    last_depth = time.time()
+    while True:
+        try:
+            _receive(client, wheel)
+        except Exception:
+            logging.exception('Can not receive timers from inbox')
+            time.sleep(1)
+
+        fired = wheel.advance(time.time())
+        if fired:
+            now = time.time()
+            for _, due in fired:
+                metrics.timing('timers.lateness', max(now - due, 0))
+            metrics.incr('timers.fired', len(fired))
+
+            close_old_connections()
+            for batch in common.chunker([member for member, _ in fired], FINISH_BATCH):
+                try:
+                    finish_batch(batch)
+                except Exception:
+                    logging.exception('Can not finish batch of %s timers, retry in %s seconds', len(batch),
+                                      RETRY_DELAY)
+                    metrics.incr('timers.retried', len(batch))
+                    for member in batch:
+                        wheel.insert(member, time.time() + RETRY_DELAY)
+
+        if time.time() - last_depth >= settings.METRICS_FLUSH_INTERVAL:
+            metrics.gauge('timers.pending', len(wheel), track_max=True)
+            last_depth = time.time()
@@ -0,0 +1,258 @@
+# common
+import random
+import threading
+import time
+from collections import deque
+
+# django
+from django.conf import settings
+
+# other
+import telepot
+import telepot.api
+import telepot.exception
+import urllib3
+
+# my
+from app import metrics
+
+
+_bots = {}
+_lock = threading.Lock()
+_last_pool_stats = 0
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__('Circuit {} is open, retry after {:.1f}s'.format(name, retry_after))
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    closed: calls pass, opens when failure rate within `window` seconds exceeds `failure_rate` (at least `min_calls`)
+            or after `consecutive_failures` failures in a row, e.g. slow timeouts of a single threaded worker
+    open: calls fail immediately with CircuitOpenError until jittered cooldown passes
+    half open: `probes` calls pass, success closes circuit, failure opens it again with doubled cooldown
+    Results of calls started before circuit was opened last time are ignored.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_rate, min_calls, window, cooldown, max_cooldown, consecutive_failures,
+                 probes=1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.consecutive_failures = consecutive_failures
+        self.probes = probes
+
+        self.state = self.CLOSED
+        self.cooldown = cooldown
+        self.opened_until = 0
+        self.probes_left = 0
+        self.calls = deque()
+        self.failures_in_row = 0
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_until = now + self.cooldown * random.uniform(1, 1.5)
+        self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+        self.calls.clear()
+        self.failures_in_row = 0
+        self.generation += 1
+        metrics.incr('breaker.opened')
+
+    def before_call(self):
+        now = time.time()
+        with self._lock:
+            if self.state == self.OPEN and now >= self.opened_until:
+                self.state = self.HALF_OPEN
+                self.probes_left = self.probes
+
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probes_left <= 0):
+                metrics.incr('breaker.rejected')
+                raise CircuitOpenError(self.name, max(self.opened_until - now, 0))
+
+            if self.state == self.HALF_OPEN:
+                self.probes_left -= 1
+            return self.generation
+
+    def record(self, success, generation=None):
+        now = time.time()
+        with self._lock:
+            if self.state == self.OPEN or generation is not None and generation != self.generation:
+                return
+
+            if self.state == self.HALF_OPEN:
+                if success:
+                    self.state = self.CLOSED
+                    self.cooldown = self.base_cooldown
+                    metrics.incr('breaker.closed')
+                else:
+                    self._open(now)
+                return
+
+            self.failures_in_row = 0 if success else self.failures_in_row + 1
+            self.calls.append((now, success))
+            while self.calls and self.calls[0][0] < now - self.window:
+                self.calls.popleft()
+
+            failures = len([c for c in self.calls if not c[1]])
+            if self.failures_in_row >= self.consecutive_failures or \
+                    len(self.calls) >= self.min_calls and failures / len(self.calls) > self.failure_rate:
+                self._open(now)
+
+
+def is_outage(error):
+    """
+    Network errors and 5xx mean Bot API is unavailable, other telegram errors (blocked bot, bad request, 429)
+    are answers of healthy API.
+    """
+    if isinstance(error, (urllib3.exceptions.HTTPError, telepot.exception.BadHTTPResponse)):
+        return True
+    if isinstance(error, telepot.exception.TelegramError):
+        return (error.error_code or 0) >= 500
+    return False
+
+
+class ProtectedBot(object):
+    """
+    telepot client with every Bot API call going through circuit breaker of the token.
+    """
+
+    def __init__(self, bot, breaker):
+        self.bot = bot
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        method = getattr(self.bot, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            generation = self.breaker.before_call()
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                self.breaker.record(not is_outage(e), generation)
+                raise
+            self.breaker.record(True, generation)
+            return result
+        return call
+
+
+def configure_api_url(url):
+    """
+    Point telepot to other Bot API server, e.g. local fake one (manage.py fake_bot_api) for offline runs.
+    """
+    url = url.rstrip('/')
+
+    def methodurl(req, **user_kw):
+        token, method, params, files = req
+        return '%s/bot%s/%s' % (url, token, method)
+
+    def fileurl(req):
+        token, path = req
+        return '%s/file/bot%s/%s' % (url, token, path)
+
+    telepot.api._methodurl = methodurl
+    telepot.api._fileurl = fileurl
+
+
+def configure_pool():
+    """
+    telepot sends every request without files through module level urllib3 pool, replace it with bounded
+    keep-alive pool: at most TELEGRAM_API_POOL_SIZE connections per host, callers wait for free connection
+    instead of opening new ones.
+    """
+    # only connect errors are retried, request was not sent then. After read error telegram usually has
+    # delivered the message already and retry would send it twice
+    retries = urllib3.Retry(
+        total=settings.TELEGRAM_API_RETRIES,
+        connect=settings.TELEGRAM_API_RETRIES,
+        read=0,
+        redirect=0,
+        method_whitelist=frozenset(['POST']),
+    )
+    telepot.api._pools['default'] = urllib3.PoolManager(
+        num_pools=settings.TELEGRAM_API_NUM_POOLS,
+        maxsize=settings.TELEGRAM_API_POOL_SIZE,
+        block=True,
+        retries=retries,
+        timeout=urllib3.Timeout(connect=settings.TELEGRAM_API_CONNECT_TIMEOUT,
+                                read=settings.TELEGRAM_API_READ_TIMEOUT),
+    )
+
+    # telepot adds default timeout of the pool to getUpdates long poll timeout, it has to be a number
+    telepot.api._default_timeout = lambda req, **user_kw: settings.TELEGRAM_API_READ_TIMEOUT
+
+
+def _create_bot(token):
+    breaker = CircuitBreaker(
+        token.split(':')[0],
+        failure_rate=settings.TELEGRAM_BREAKER_FAILURE_RATE,
+        min_calls=settings.TELEGRAM_BREAKER_MIN_CALLS,
+        window=settings.TELEGRAM_BREAKER_WINDOW,
+        cooldown=settings.TELEGRAM_BREAKER_COOLDOWN,
+        max_cooldown=settings.TELEGRAM_BREAKER_MAX_COOLDOWN,
+        consecutive_failures=settings.TELEGRAM_BREAKER_CONSECUTIVE_FAILURES,
+    )
+    return ProtectedBot(telepot.Bot(token), breaker)
+
+
+def get_bot(token=None):
+    """
+    Process wide telepot client by token, all of them share warm connections of the pool. Calls are protected
+    by circuit breaker of the token and raise CircuitOpenError while Bot API is down.
+    Only clients of TELEGRAM_BOT_TOKEN and TELEGRAM_LEGACY_BOT_TOKENS are kept, token comes from webhook url.
+    """
+    token = token or settings.TELEGRAM_BOT_TOKEN
+    if token != settings.TELEGRAM_BOT_TOKEN and token not in settings.TELEGRAM_LEGACY_BOT_TOKENS:
+        return _create_bot(token)
+
+    bot = _bots.get(token)
+    if bot is None:
+        with _lock:
+            bot = _bots.get(token)
+            if bot is None:
+                bot = _bots[token] = _create_bot(token)
+
+    _maybe_record_pool_stats()
+    return bot
+
+
+def get_pool_stats():
+    stats = {'pools': 0, 'connections': 0, 'idle': 0, 'in_use': 0, 'requests': 0}
+
+    manager = telepot.api._pools['default']
+    for key in manager.pools.keys():
+        pool = manager.pools.get(key)
+        if pool is None:
+            continue
+
+        idle = len([c for c in list(pool.pool.queue) if c is not None]) if pool.pool else 0
+        stats['pools'] += 1
+        stats['connections'] += pool.num_connections
+        stats['idle'] += idle
+        stats['in_use'] += pool.pool.maxsize - pool.pool.qsize() if pool.pool else 0
+        stats['requests'] += pool.num_requests
+    return stats
+
+
+def _maybe_record_pool_stats():
+    global _last_pool_stats
+
+    now = time.time()
+    if now - _last_pool_stats < settings.METRICS_FLUSH_INTERVAL:
+        return
+    _last_pool_stats = now
+
+    for name, value in get_pool_stats().items():
+        metrics.gauge('api.pool.' + name, value, track_max=name == 'in_use')
@@ -6,23 +6,35 @@ import logging
 from django.conf import settings
 from django.utils import timezone
 
-# other
-from www.celery import app
-
 # my
 from bot import messages
 from bot import helper
+from bot.router import Router, ANY_STATE
 from app import common
+from app import metrics
+from app import timers
 from app.models import TelegramUser, Pomodoro, Project, Rest, Contact, Audio
-from app.tasks import finish_rest, finish_pomodoro
+from app.cache import user_cache
+from app.audio import audio_index
+
+
+router = Router()
+router.add_hook(lambda name, seconds: metrics.timing('router.' + name, seconds))
+
+
+def minutes_to_duration(minutes):
+    return datetime.timedelta(seconds=minutes * 60)
 
 
 class Bot(object):
 
-    def __init__(self, current_user, sender, page_size=10):
+    def __init__(self, current_user, sender, page_size=helper.PROJECTS_PAGE_SIZE):
         self.current_user = current_user
         self.sender = sender
         self.page_size = page_size
+        self._menu = None
+        self._menu_kind = None
+        self._menu_snapshot = None
 
         if not self.current_user.current_project:
             project = Project(name='default', telegram_user=self.current_user)
@@ -32,7 +44,23 @@ class Bot(object):
             self.current_user.save()
 
     def get_menu(self):
-        return helper.get_menu(self.current_user)
+        """
+        Keyboard is computed once per update and again only after state, current project or settings change.
+        """
+        user = self.current_user
+        snapshot = (id(user), user.state_revision, user.current_project_id, user.pomodoro_duration,
+                    user.pomodoro_rest, user.pomodoro_big_rest, user.pomodoro_session_count)
+        if snapshot == self._menu_snapshot:
+            metrics.incr('menu_snapshot.reused')
+            if self._menu_kind == 'projects':
+                metrics.incr('menu_snapshot.project_queries_saved')
+            return self._menu
+
+        key = helper.get_menu_key(user, self.page_size)
+        self._menu = helper.menu_cache.get(key)
+        self._menu_kind = key[0]
+        self._menu_snapshot = snapshot
+        return self._menu
 
     def handle_stats(self, period):
         if period == 'day':
@@ -97,11 +125,10 @@ class Bot(object):
                 current_pomodoro.end_date = timezone.now()
                 current_pomodoro.save()
 
-                if current_pomodoro.task_id:
-                    try:
-                        app.control.revoke(current_pomodoro.task_id)
-                    except Exception as e:
-                        logging.exception('Revoking current pomodoro task faield {}'.format(str(e)))
+                try:
+                    timers.cancel('pomodoro', self.current_user.id, current_pomodoro)
+                except Exception as e:
+                    logging.exception('Cancelling current pomodoro timer failed {}'.format(str(e)))
 
                 stop_pomodoro = True
             except Pomodoro.DoesNotExist:
@@ -117,11 +144,10 @@ class Bot(object):
                 current_rest.end_date = timezone.now()
                 current_rest.save()
 
-                if current_rest.task_id:
-                    try:
-                        app.control.revoke(current_rest.task_id)
-                    except Exception as e:
-                        logging.exception('Revoking current pomodoro task faield {}'.format(str(e)))
+                try:
+                    timers.cancel('rest', self.current_user.id, current_rest)
+                except Exception as e:
+                    logging.exception('Cancelling current rest timer failed {}'.format(str(e)))
 
                 stop_rest = True
             except Pomodoro.DoesNotExist:
@@ -146,20 +172,20 @@ class Bot(object):
         pomodoro.duration = self.current_user.pomodoro_duration
         pomodoro.save()
 
-        countdown = 10 if settings.SERVER == 'dev' else self.current_user.pomodoro_duration.seconds
-        eta = timezone.now() + datetime.timedelta(seconds=countdown)
-        result = finish_pomodoro.apply_async(args=(self.current_user.id, pomodoro.id), eta=eta)
-
-        pomodoro.task_id = result.id
-        pomodoro.save()
+        countdown = timers.get_countdown(self.current_user.pomodoro_duration)
+        task_id = timers.schedule('pomodoro', self.current_user.id, pomodoro.id, countdown)
+        if task_id:
+            pomodoro.task_id = task_id
+            pomodoro.save()
 
         self.current_user.set_state('current_pomodoro_id', pomodoro.id)
 
         self.sender.sendMessage(messages.pomodoro_started_message, reply_markup=self.get_menu())
 
-        audio = Audio.objects.exclude(audio_id__isnull=True).order_by('?').first()
+        audio = audio_index.pick(self.current_user.user_id)
         if audio:
-            self.sender.sendAudio(audio.audio_id, audio.get_category_display())
+            category, audio_id = audio
+            self.sender.sendAudio(audio_id, dict(Audio.CATEGORIES)[category])
 
     def handle_start_rest(self):
         stop_pomodoro, _ = self.stop_activities()
@@ -174,12 +200,11 @@ class Bot(object):
         rest.duration = self.current_user.pomodoro_rest
         rest.save()
 
-        countdown = 10 if settings.SERVER == 'dev' else self.current_user.pomodoro_rest.seconds
-        eta = timezone.now() + datetime.timedelta(seconds=countdown)
-        result = finish_rest.apply_async(args=(self.current_user.id, rest.id), eta=eta)
-
-        rest.task_id = result.id
-        rest.save()
+        countdown = timers.get_countdown(self.current_user.pomodoro_rest)
+        task_id = timers.schedule('rest', self.current_user.id, rest.id, countdown)
+        if task_id:
+            rest.task_id = task_id
+            rest.save()
 
         self.current_user.set_state('current_rest_id', rest.id)
 
@@ -209,201 +234,22 @@ class Bot(object):
         if not message:
             return
 
-        self.current_user = TelegramUser.objects.get(id=self.current_user.id)
+        self.current_user = user_cache.get(self.current_user.user_id) or \
+            TelegramUser.objects.get(id=self.current_user.id)
 
+        # all user changes made while handling message are written with one UPDATE, then replies are sent
+        # merged into as few messages as possible
+        with self.sender.outbox():
+            with self.current_user.unit_of_work():
+                self.handle_chat_message(message)
+
+    def handle_chat_message(self, message):
         if self.current_user.status != 'active':
             self.current_user.status = 'active'
             self.current_user.save()
 
         try:
-            current_state = self.current_user.get_state_machine()
-
-            if message == helper.BACK_TEXT and current_state:
-                self.current_user.pop_state_machine()
-                self.sender.sendMessage(messages.empty_command_message, reply_markup=self.get_menu())
-            elif current_state:
-                if message == helper.ADMIN_STATS_TEXT:
-                    parts = []
-
-                    data = {
-                        'count': TelegramUser.objects.count(),
-                        'model': 'users',
-                    }
-                    parts.append(messages.admin_count_message.format(**data))
-
-                    data = {
-                        'count': Pomodoro.objects.count(),
-                        'model': 'pomodoros',
-                    }
-                    parts.append(messages.admin_count_message.format(**data))
-
-                    data = {
-                        'count': Rest.objects.count(),
-                        'model': 'rest',
-                    }
-                    parts.append(messages.admin_count_message.format(**data))
-
-                    self.sender.sendMessage('\n'.join(parts), reply_markup=self.get_menu())
-                elif message == helper.ADMIN_ACTIVE_TEXT:
-                    data = {
-                        'active_pomodoros': Pomodoro.objects.filter(status='started').count(),
-                        'active_rests': Rest.objects.filter(status='started').count(),
-                    }
-                    self.sender.sendMessage(messages.admin_count_active.format(**data),
-                                                  reply_markup=self.get_menu())
-                elif message == helper.STATS_DAY_TEXT:
-                    self.handle_stats('day')
-                elif message == helper.STATS_WEEK_TEXT:
-                    self.handle_stats('week')
-                elif message == helper.STATS_MONTH_TEXT:
-                    self.handle_stats('month')
-                elif current_state == 'projects':
-                    if message.startswith(helper.SET_PROJECT_TEXT):
-                        name = message[len(helper.SET_PROJECT_TEXT):].strip(' ☑')
-                        project, created = Project.objects.get_or_create(telegram_user=self.current_user, name=name)
-                        self.current_user.current_project = project
-                        self.current_user.save()
-
-                        self.current_user.pop_state_machine()
-
-                        self.sender.sendMessage(messages.project_set_message.format(project=project),
-                                                      reply_markup=self.get_menu())
-                    elif message == helper.NEW_PROJECT_TEXT:
-                        self.current_user.push_state_machine('new_project')
-                        self.sender.sendMessage(messages.new_project_message, reply_markup=self.get_menu())
-                    else:
-                        self.sender.sendMessage(messages.bad_command_message, reply_markup=self.get_menu())
-                elif current_state == 'new_project':
-                    project, created = Project.objects.get_or_create(telegram_user=self.current_user, name=message)
-                    self.current_user.current_project = project
-                    self.current_user.save()
-
-                    self.current_user.clear_state_machine()
-
-                    self.sender.sendMessage(messages.project_set_message.format(project=project),
-                                                  reply_markup=self.get_menu())
-                elif current_state == 'contact':
-                    contact = Contact()
-                    contact.message = message
-                    contact.telegram_user = self.current_user
-                    contact.save()
-
-                    self.current_user.pop_state_machine()
-                    self.sender.sendMessage(messages.contact_us_sent, reply_markup=self.get_menu())
-                elif current_state == 'settings':
-                    if message.startswith(helper.SETTINGS_POMODORO_LENGTH):
-                        self.current_user.push_state_machine('settings_pomodoro_length')
-                        self.sender.sendMessage(messages.settings_pomodoro_message.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                    elif message.startswith(helper.SETTINGS_REST_LENGTH):
-                        self.current_user.push_state_machine('settings_rest_length')
-                        self.sender.sendMessage(messages.settings_rest_message.format(u=self.current_user),
-                            reply_markup=self.get_menu())
-                    elif message.startswith(helper.SETTINGS_BIG_REST_LENGTH):
-                        self.current_user.push_state_machine('settings_big_rest_length')
-                        self.sender.sendMessage(messages.settings_big_rest_message.format(u=self.current_user),
-                            reply_markup=self.get_menu())
-                    elif message.startswith(helper.SETTINGS_SET_POMODORO_COUNT):
-                        self.current_user.push_state_machine('settings_session_count')
-                        self.sender.sendMessage(messages.settings_session_count_message.format(u=self.current_user),
-                            reply_markup=self.get_menu())
-                    else:
-                        self.sender.sendMessage(messages.bad_command_message, reply_markup=self.get_menu())
-                elif current_state == 'settings_pomodoro_length':
-                    try:
-                        minutes = int(message)
-                        if minutes < 1 or minutes > 60:
-                            raise ValueError('Not in range')
-
-                        self.current_user.pop_state_machine()
-
-                        self.current_user.pomodoro_duration = datetime.timedelta(seconds=minutes * 60)
-                        self.current_user.save()
-
-                        self.sender.sendMessage(messages.settings_pomodoro_set_message.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                    except (TypeError, ValueError):
-                        self.sender.sendMessage(messages.settings_error_minutes.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                elif current_state == 'settings_rest_length':
-                    try:
-                        minutes = int(message)
-                        if minutes < 1 or minutes > 60:
-                            raise ValueError('Not in range')
-
-                        self.current_user.pop_state_machine()
-
-                        self.current_user.pomodoro_rest = datetime.timedelta(seconds=minutes * 60)
-                        self.current_user.save()
-
-                        self.sender.sendMessage(messages.settings_rest_set_message.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                    except (TypeError, ValueError):
-                        self.sender.sendMessage(messages.settings_error_minutes.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                elif current_state == 'settings_big_rest_length':
-                    try:
-                        minutes = int(message)
-                        if minutes < 1 or minutes > 60:
-                            raise ValueError('Not in range')
-
-                        self.current_user.pop_state_machine()
-
-                        self.current_user.pomodoro_big_rest = datetime.timedelta(seconds=minutes * 60)
-                        self.current_user.save()
-
-                        self.sender.sendMessage(messages.settings_big_rest_set_message.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                    except (TypeError, ValueError):
-                        self.sender.sendMessage(messages.settings_error_minutes.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                elif current_state == 'settings_session_count':
-                    try:
-                        count = int(message)
-                        if count < 1 or count > 60:
-                            raise ValueError('Not in range')
-
-                        self.current_user.pop_state_machine()
-
-                        self.current_user.pomodoro_session_count = count
-                        self.current_user.save()
-
-                        self.sender.sendMessage(messages.settings_session_count_set_message.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                    except (TypeError, ValueError):
-                        self.sender.sendMessage(messages.settings_error_session.format(u=self.current_user),
-                                                      reply_markup=self.get_menu())
-                else:
-                    self.current_user.clear_state_machine()
-                    self.sender.sendMessage(messages.bad_command_message, reply_markup=self.get_menu())
-            else:
-                if message in ('/start', '/help', helper.HELP_TEXT):
-                    self.sender.sendMessage(messages.start_message, reply_markup=self.get_menu())
-                elif message == helper.START_REST_TEXT:
-                    self.handle_start_rest()
-                elif message == helper.STOP_REST_TEXT:
-                    self.handle_rest_stop()
-                elif message == helper.START_TEXT:
-                    self.handle_pomodoro_run()
-                elif message == helper.STOP_TEXT:
-                    self.handle_pomodoro_stop()
-                elif message == helper.STATS_TEXT:
-                    self.current_user.push_state_machine('stats')
-                    self.sender.sendMessage(messages.stats_select_message, reply_markup=self.get_menu())
-                elif message in [helper.CONTACT_US_TEXT, '/contact']:
-                    self.current_user.push_state_machine('contact')
-                    self.sender.sendMessage(messages.contact_us_message, reply_markup=self.get_menu())
-                elif message == helper.ADMIN_TEXT and self.current_user.is_admin:
-                    self.current_user.push_state_machine('admin')
-                    self.sender.sendMessage(messages.admin_message, reply_markup=self.get_menu())
-                elif message.startswith(helper.PROJECTS_TEXT):
-                    self.current_user.push_state_machine('projects')
-                    self.sender.sendMessage(messages.list_projects_message, reply_markup=self.get_menu())
-                elif message == helper.SETTINGS_TEXT:
-                    self.current_user.push_state_machine('settings')
-                    self.sender.sendMessage(messages.settings_message, reply_markup=self.get_menu())
-                else:
-                    self.sender.sendMessage(messages.bad_command_message, reply_markup=self.get_menu())
+            router.dispatch(self, self.current_user.get_state_machine(), message)
         except Exception as e:
             try:
                 self.sender.sendMessage('Internal error', reply_markup=self.get_menu())
@@ -413,5 +259,260 @@ class Bot(object):
             except Exception as e:
                 logging.exception('Unexpected exception while other exception')
 
+    # any state
+
+    @router.route(ANY_STATE, texts=[helper.BACK_TEXT])
+    def handle_back(self, message):
+        self.current_user.pop_state_machine()
+        self.sender.sendMessage(messages.empty_command_message, reply_markup=self.get_menu())
+
+    @router.route(ANY_STATE, texts=[helper.ADMIN_STATS_TEXT])
+    def handle_admin_stats(self, message):
+        parts = []
+
+        data = {
+            'count': TelegramUser.objects.count(),
+            'model': 'users',
+        }
+        parts.append(messages.admin_count_message.format(**data))
+
+        data = {
+            'count': Pomodoro.objects.count(),
+            'model': 'pomodoros',
+        }
+        parts.append(messages.admin_count_message.format(**data))
+
+        data = {
+            'count': Rest.objects.count(),
+            'model': 'rest',
+        }
+        parts.append(messages.admin_count_message.format(**data))
+
+        self.sender.sendMessage('\n'.join(parts), reply_markup=self.get_menu())
+
+    @router.route(ANY_STATE, texts=[helper.ADMIN_ACTIVE_TEXT])
+    def handle_admin_active(self, message):
+        data = {
+            'active_pomodoros': Pomodoro.objects.filter(status='started').count(),
+            'active_rests': Rest.objects.filter(status='started').count(),
+        }
+        self.sender.sendMessage(messages.admin_count_active.format(**data), reply_markup=self.get_menu())
+
+    @router.route(ANY_STATE, texts=[helper.STATS_DAY_TEXT, helper.STATS_WEEK_TEXT, helper.STATS_MONTH_TEXT])
+    def handle_stats_period(self, message):
+        periods = {
+            helper.STATS_DAY_TEXT: 'day',
+            helper.STATS_WEEK_TEXT: 'week',
+            helper.STATS_MONTH_TEXT: 'month',
+        }
+        self.handle_stats(periods[message])
+
+    @router.fallback(ANY_STATE)
+    def handle_unknown_state(self, message):
+        self.current_user.clear_state_machine()
+        self.sender.sendMessage(messages.bad_command_message, reply_markup=self.get_menu())
+
+    # projects
+
+    @router.route('projects', prefixes=[helper.SET_PROJECT_TEXT])
+    def handle_set_project(self, message):
+        name = message[len(helper.SET_PROJECT_TEXT):].strip(' ☑')
+        project, created = Project.objects.get_or_create(telegram_user=self.current_user, name=name)
+        self.current_user.current_project = project
+        self.current_user.save()
+
+        self.current_user.pop_state_machine()
+
+        self.sender.sendMessage(messages.project_set_message.format(project=project), reply_markup=self.get_menu())
+
+    @router.route('projects', texts=[helper.NEXT_PAGE_TEXT])
+    def handle_projects_next_page(self, message):
+        cursor = helper.get_projects_cursor(self.current_user)
+        prefix = self.current_user.get_state('projects_prefix')
+        projects = helper.get_projects_page(self.current_user, cursor, prefix, self.page_size)
+        if len(projects) > self.page_size:
+            last_id, _, last_total = projects[self.page_size - 1]
+            cursors = self.current_user.get_state('projects_cursors') or []
+            self.current_user.set_state('projects_cursors', cursors + [[last_total, last_id]])
+        self.sender.sendMessage(messages.list_projects_message, reply_markup=self.get_menu())
+
+    @router.route('projects', texts=[helper.PREV_PAGE_TEXT])
+    def handle_projects_prev_page(self, message):
+        cursors = self.current_user.get_state('projects_cursors') or []
+        self.current_user.set_state('projects_cursors', cursors[:-1])
+        self.sender.sendMessage(messages.list_projects_message, reply_markup=self.get_menu())
+
+    @router.route('projects', texts=[helper.SEARCH_PROJECT_TEXT])
+    def handle_projects_search(self, message):
+        self.current_user.push_state_machine('projects_search')
+        self.sender.sendMessage(messages.search_project_message, reply_markup=self.get_menu())
+
+    @router.route('projects', texts=[helper.RESET_SEARCH_TEXT])
+    def handle_projects_reset_search(self, message):
+        self.reset_projects_page()
+        self.sender.sendMessage(messages.list_projects_message, reply_markup=self.get_menu())
+
+    @router.fallback('projects_search')
+    def handle_projects_search_prefix(self, message):
+        self.reset_projects_page(prefix=message)
+        self.current_user.pop_state_machine()
+        self.sender.sendMessage(messages.list_projects_message, reply_markup=self.get_menu())
+
+    def reset_projects_page(self, prefix=None):
+        self.current_user.set_state('projects_cursors', [])
+        if prefix:
+            self.current_user.set_state('projects_prefix', prefix)
+        else:
+            self.current_user.remove_state('projects_prefix')
+
+    @router.route('projects', texts=[helper.NEW_PROJECT_TEXT])
+    def handle_new_project(self, message):
+        self.current_user.push_state_machine('new_project')
+        self.sender.sendMessage(messages.new_project_message, reply_markup=self.get_menu())
+
+    @router.fallback('new_project')
+    def handle_new_project_name(self, message):
+        project, created = Project.objects.get_or_create(telegram_user=self.current_user, name=message)
+        self.current_user.current_project = project
+        self.current_user.save()
+
+        self.current_user.clear_state_machine()
+
+        self.sender.sendMessage(messages.project_set_message.format(project=project), reply_markup=self.get_menu())
+
+    # contact
+
+    @router.fallback('contact')
+    def handle_contact_message(self, message):
+        contact = Contact()
+        contact.message = message
+        contact.telegram_user = self.current_user
+        contact.save()
+
+        self.current_user.pop_state_machine()
+        self.sender.sendMessage(messages.contact_us_sent, reply_markup=self.get_menu())
+
+    # settings
+
+    @router.route('settings', prefixes=[helper.SETTINGS_POMODORO_LENGTH])
+    def handle_settings_pomodoro_length(self, message):
+        self.current_user.push_state_machine('settings_pomodoro_length')
+        self.sender.sendMessage(messages.settings_pomodoro_message.format(u=self.current_user),
+                                reply_markup=self.get_menu())
+
+    @router.route('settings', prefixes=[helper.SETTINGS_REST_LENGTH])
+    def handle_settings_rest_length(self, message):
+        self.current_user.push_state_machine('settings_rest_length')
+        self.sender.sendMessage(messages.settings_rest_message.format(u=self.current_user),
+                                reply_markup=self.get_menu())
+
+    @router.route('settings', prefixes=[helper.SETTINGS_BIG_REST_LENGTH])
+    def handle_settings_big_rest_length(self, message):
+        self.current_user.push_state_machine('settings_big_rest_length')
+        self.sender.sendMessage(messages.settings_big_rest_message.format(u=self.current_user),
+                                reply_markup=self.get_menu())
+
+    @router.route('settings', prefixes=[helper.SETTINGS_SET_POMODORO_COUNT])
+    def handle_settings_session_count(self, message):
+        self.current_user.push_state_machine('settings_session_count')
+        self.sender.sendMessage(messages.settings_session_count_message.format(u=self.current_user),
+                                reply_markup=self.get_menu())
+
+    def set_setting(self, message, field, to_value, set_message, error_message):
+        try:
+            count = int(message)
+            if count < 1 or count > 60:
+                raise ValueError('Not in range')
+
+            self.current_user.pop_state_machine()
+
+            setattr(self.current_user, field, to_value(count))
+            self.current_user.save()
+
+            self.sender.sendMessage(set_message.format(u=self.current_user), reply_markup=self.get_menu())
+        except (TypeError, ValueError):
+            self.sender.sendMessage(error_message.format(u=self.current_user), reply_markup=self.get_menu())
+
+    @router.fallback('settings_pomodoro_length')
+    def handle_set_pomodoro_length(self, message):
+        self.set_setting(message, 'pomodoro_duration', minutes_to_duration,
+                         messages.settings_pomodoro_set_message, messages.settings_error_minutes)
+
+    @router.fallback('settings_rest_length')
+    def handle_set_rest_length(self, message):
+        self.set_setting(message, 'pomodoro_rest', minutes_to_duration,
+                         messages.settings_rest_set_message, messages.settings_error_minutes)
+
+    @router.fallback('settings_big_rest_length')
+    def handle_set_big_rest_length(self, message):
+        self.set_setting(message, 'pomodoro_big_rest', minutes_to_duration,
+                         messages.settings_big_rest_set_message, messages.settings_error_minutes)
+
+    @router.fallback('settings_session_count')
+    def handle_set_session_count(self, message):
+        self.set_setting(message, 'pomodoro_session_count', int,
+                         messages.settings_session_count_set_message, messages.settings_error_session)
+
+    @router.fallback('projects', 'settings')
+    def handle_bad_command(self, message):
+        self.sender.sendMessage(messages.bad_command_message, reply_markup=self.get_menu())
+
+    # main menu
+
+    @router.route(None, texts=['/start', '/help', helper.HELP_TEXT])
+    def handle_help(self, message):
+        self.sender.sendMessage(messages.start_message, reply_markup=self.get_menu())
+
+    @router.route(None, texts=[helper.START_REST_TEXT])
+    def handle_start_rest_command(self, message):
+        self.handle_start_rest()
+
+    @router.route(None, texts=[helper.STOP_REST_TEXT])
+    def handle_rest_stop_command(self, message):
+        self.handle_rest_stop()
+
+    @router.route(None, texts=[helper.START_TEXT])
+    def handle_pomodoro_run_command(self, message):
+        self.handle_pomodoro_run()
+
+    @router.route(None, texts=[helper.STOP_TEXT])
+    def handle_pomodoro_stop_command(self, message):
+        self.handle_pomodoro_stop()
+
+    @router.route(None, texts=[helper.STATS_TEXT])
+    def handle_stats_menu(self, message):
+        self.current_user.push_state_machine('stats')
+        self.sender.sendMessage(messages.stats_select_message, reply_markup=self.get_menu())
+
+    @router.route(None, texts=[helper.CONTACT_US_TEXT, '/contact'])
+    def handle_contact_menu(self, message):
+        self.current_user.push_state_machine('contact')
+        self.sender.sendMessage(messages.contact_us_message, reply_markup=self.get_menu())
+
+    @router.route(None, texts=[helper.ADMIN_TEXT])
+    def handle_admin_menu(self, message):
+        if not self.current_user.is_admin:
+            self.handle_main_bad_command(message)
+            return
+
+        self.current_user.push_state_machine('admin')
+        self.sender.sendMessage(messages.admin_message, reply_markup=self.get_menu())
+
+    @router.route(None, prefixes=[helper.PROJECTS_TEXT])
+    def handle_projects_menu(self, message):
+        self.reset_projects_page()
+        self.current_user.push_state_machine('projects')
+        self.sender.sendMessage(messages.list_projects_message, reply_markup=self.get_menu())
+
+    @router.route(None, texts=[helper.SETTINGS_TEXT])
+    def handle_settings_menu(self, message):
+        self.current_user.push_state_machine('settings')
+        self.sender.sendMessage(messages.settings_message, reply_markup=self.get_menu())
+
+    @router.fallback(None)
+    def handle_main_bad_command(self, message):
+        self.sender.sendMessage(messages.bad_command_message, reply_markup=self.get_menu())
+
     def on_callback(self, data):
+        # data is decoded (action, payload), see bot.callback
         pass
\ No newline at end of file
@@ -0,0 +1,155 @@
+# common
+import base64
+import hashlib
+import json
+import logging
+from functools import lru_cache
+
+# django
+from django.conf import settings
+
+# other
+import redis
+
+# my
+from app import metrics
+from app.common import get_redis
+
+
+# telegram limit of callback_data is 64 bytes, base64 of 48 bytes is exactly 64 chars
+MAX_RAW_LENGTH = 48
+
+KIND_EMPTY = 0
+KIND_INTS = 1
+# 2 was short inline json, retired: client controlled data is never parsed as json
+KIND_REFERENCE = 3
+
+# action name by id and back, ids are part of sent keyboards so never reuse them
+ACTIONS = {}
+ACTION_IDS = {}
+
+
+def register_action(action_id, name):
+    assert 0 <= action_id < 256 and action_id not in ACTIONS
+    ACTIONS[action_id] = name
+    ACTION_IDS[name] = action_id
+
+
+def _write_varint(value, out):
+    value = (value << 1) ^ (value >> 63)  # zigzag, negative numbers stay short
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varints(data):
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append((value >> 1) ^ -(value & 1))
+            value = shift = 0
+    return values
+
+
+def _is_ints(payload):
+    return isinstance(payload, (list, tuple)) and all(isinstance(v, int) and -2 ** 63 <= v < 2 ** 63
+                                                      for v in payload)
+
+
+def _store(encoded):
+    digest = hashlib.sha1(encoded).digest()[:12]
+    get_redis().set('callback:{}'.format(digest.hex()), encoded, ex=settings.CALLBACK_PAYLOAD_TTL)
+    metrics.incr('callback.stored')
+    return digest
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(bytes(raw)).rstrip(b'=').decode('ascii')
+
+
+@lru_cache(maxsize=4096)
+def _encode_inline(action, payload):
+    """
+    Callback data with payload inside or None if payload has to be kept on server side.
+    """
+    raw = bytearray([ACTION_IDS[action]])
+    if payload is None:
+        raw.append(KIND_EMPTY)
+    elif _is_ints(payload):
+        raw.append(KIND_INTS)
+        for value in payload:
+            _write_varint(value, raw)
+    else:
+        return None
+
+    return _b64(raw) if len(raw) <= MAX_RAW_LENGTH else None
+
+
+def encode(action, payload=None):
+    """
+    Compact callback_data: action id byte, payload kind byte and varint packed ints or reference to json payload
+    stored in redis, all in base64url. Fits 64 bytes for any payload. Reference is stored again on every encode,
+    so keyboards being sent never point to expired payload.
+    """
+    if isinstance(payload, list):
+        payload = tuple(payload)
+
+    try:
+        encoded = _encode_inline(action, payload)
+    except TypeError:
+        # unhashable payload, e.g. dict
+        encoded = None
+
+    if encoded is None:
+        digest = _store(json.dumps(payload, separators=(',', ':')).encode('utf8'))
+        encoded = _b64(bytearray([ACTION_IDS[action], KIND_REFERENCE]) + digest)
+    return encoded
+
+
+def decode(data):
+    """
+    Returns (action, payload) or None for unknown action or expired payload.
+    """
+    if not isinstance(data, str) or len(data) > 64:
+        metrics.incr('callback.invalid')
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        action = ACTIONS.get(raw[0])
+        kind = raw[1]
+    except (ValueError, IndexError, TypeError):
+        metrics.incr('callback.invalid')
+        return None
+
+    if action is None:
+        metrics.incr('callback.invalid')
+        return None
+
+    body = raw[2:]
+    if kind == KIND_EMPTY and not body:
+        return action, None
+    elif kind == KIND_INTS:
+        return action, _read_varints(body)
+    elif kind == KIND_REFERENCE and len(body) == 12:
+        try:
+            stored = get_redis().get('callback:{}'.format(body.hex()))
+        except redis.RedisError:
+            logging.exception('Can not load callback payload')
+            stored = None
+
+        if stored is None:
+            metrics.incr('callback.expired')
+            return None
+        return action, json.loads(stored.decode('utf8'))
+
+    metrics.incr('callback.invalid')
+    return None
@@ -0,0 +1,101 @@
+# common
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# django
+from django.conf import settings
+
+# other
+import redis
+
+# my
+from app import metrics
+from app.common import get_redis
+
+
+class UpdateDeduplicator(object):
+    """
+    Bounded expiring index of recently seen telegram update_id.
+
+    First tier is in process LRU (retries often hit the same worker), second one is redis SET NX with TTL shared
+    between all workers. Both checks are O(1). Update is claimed for a short lease while it is processed and is
+    marked done for the full TTL only after success, so redelivery of failed or lost update is processed again.
+    """
+    PROCESSING = b'processing'
+    DONE = b'done'
+
+    def __init__(self, ttl=None, local_size=None, lease=None):
+        self.ttl = ttl or settings.TELEGRAM_UPDATE_DEDUP_TTL
+        self.local_size = local_size or settings.TELEGRAM_UPDATE_DEDUP_LOCAL_SIZE
+        self.lease = lease or settings.TELEGRAM_UPDATE_DEDUP_LEASE
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(bot_id, update_id):
+        return 'update_seen:{}:{}'.format(bot_id, update_id)
+
+    def _set_local(self, key, expire):
+        self._local[key] = expire
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    def _seen_local(self, key, now):
+        with self._lock:
+            expire = self._local.get(key)
+            if expire is not None and expire > now:
+                return True
+
+            self._set_local(key, now + self.lease)
+            return False
+
+    def seen(self, bot_id, update_id):
+        """
+        Claim update for processing, returns True if it was already claimed or processed before.
+        """
+        key = self._key(bot_id, update_id)
+
+        if self._seen_local(key, time.time()):
+            metrics.incr('dedup.hit')
+            return True
+
+        try:
+            is_new = get_redis().set(key, self.PROCESSING, ex=self.lease, nx=True)
+        except redis.RedisError:
+            # better to process update twice than lose it
+            logging.exception('Can not check update %s in dedup index', update_id)
+            is_new = True
+
+        metrics.incr('dedup.miss' if is_new else 'dedup.hit')
+        return not is_new
+
+    def is_done(self, bot_id, update_id):
+        try:
+            return get_redis().get(self._key(bot_id, update_id)) == self.DONE
+        except redis.RedisError:
+            logging.exception('Can not check update %s in dedup index', update_id)
+            return False
+
+    def done(self, bot_id, update_id):
+        key = self._key(bot_id, update_id)
+        with self._lock:
+            self._set_local(key, time.time() + self.ttl)
+        try:
+            get_redis().set(key, self.DONE, ex=self.ttl)
+        except redis.RedisError:
+            logging.exception('Can not mark update %s as processed', update_id)
+
+    def forget(self, bot_id, update_id):
+        key = self._key(bot_id, update_id)
+        with self._lock:
+            self._local.pop(key, None)
+        try:
+            get_redis().delete(key)
+        except redis.RedisError:
+            logging.exception('Can not forget update %s', update_id)
+
+
+deduplicator = UpdateDeduplicator()
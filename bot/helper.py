@@ -1,12 +1,22 @@
+# common
+import logging
+import threading
+from collections import OrderedDict
+
 # django
 from django.conf import settings
+from django.db.models import Q
 
 # other
 import telepot
+from bot.api import CircuitOpenError
 from bot.sender import Button, Markup, Sender
+from bot.transport import send_concurrently
+from bot import outbound
 
 # my
 from app import common
+from app import metrics
 
 
 START_TEXT = '⏲Start pomodoro'
@@ -24,6 +34,10 @@ CONTACT_US_TEXT = '📞Contact us'
 PROJECTS_TEXT = '☰Projects'
 NEW_PROJECT_TEXT = '🆕New project'
 SET_PROJECT_TEXT = 'Set project:'
+NEXT_PAGE_TEXT = '▶Next'
+PREV_PAGE_TEXT = '◀Prev'
+SEARCH_PROJECT_TEXT = '🔍Search'
+RESET_SEARCH_TEXT = '✖Reset search'
 BACK_TEXT = '🔙Back'
 
 ADMIN_TEXT = '☢Admin'
@@ -39,14 +53,63 @@ BACK_ROW = [
     Button(text=BACK_TEXT),
 ]
 
+PROJECTS_PAGE_SIZE = 10
 
-def get_menu(telegram_user):
-    keyboard = []
+
+def get_projects_page(telegram_user, cursor=None, prefix=None, page_size=PROJECTS_PAGE_SIZE):
+    """
+    Keyset page of projects ordered by (total_pomodoros, id) desc, cursor is (total_pomodoros, id) of last project
+    of previous page. Returns up to page_size + 1 (id, name, total_pomodoros) rows, extra one means next page exists.
+    """
+    projects = telegram_user.project_set.order_by('-total_pomodoros', '-id')
+    if prefix:
+        projects = projects.filter(name__startswith=prefix)
+    if cursor:
+        total, project_id = cursor
+        projects = projects.filter(Q(total_pomodoros__lt=total) | Q(total_pomodoros=total, id__lt=project_id))
+    return list(projects.values_list('id', 'name', 'total_pomodoros')[:page_size + 1])
+
+
+def get_projects_cursor(telegram_user):
+    cursors = telegram_user.get_state('projects_cursors') or []
+    return cursors[-1] if cursors else None
+
+
+def get_menu_key(telegram_user, page_size=PROJECTS_PAGE_SIZE):
+    """
+    Everything keyboard depends on. Only projects menu needs a query.
+    """
     current_state = telegram_user.get_state_machine()
-    current_pomodoro = telegram_user.get_state('current_pomodoro_id')
-    current_rest = telegram_user.get_state('current_rest_id')
 
     if telegram_user.is_admin and current_state == 'admin':
+        return ('admin', )
+    elif current_state == 'stats':
+        return ('stats', )
+    elif current_state in ('contact', 'new_project', 'settings_pomodoro_length', 'settings_rest_length',
+                           'settings_big_rest_length', 'settings_session_count'):
+        return ('back', )
+    elif current_state == 'projects':
+        cursor = get_projects_cursor(telegram_user)
+        prefix = telegram_user.get_state('projects_prefix')
+        projects = get_projects_page(telegram_user, cursor, prefix, page_size)
+        return ('projects', telegram_user.current_project_id, tuple((p[0], p[1]) for p in projects[:page_size]),
+                cursor is not None, len(projects) > page_size, bool(prefix))
+    elif current_state == 'projects_search':
+        return ('back', )
+    elif current_state == 'settings':
+        return ('settings', telegram_user.pomodoro_minutes, telegram_user.rest_minutes,
+                telegram_user.big_rest_minutes, telegram_user.pomodoro_session_count)
+    else:
+        return ('main', bool(telegram_user.get_state('current_pomodoro_id')),
+                bool(telegram_user.get_state('current_rest_id')), telegram_user.current_project.name,
+                telegram_user.is_admin)
+
+
+def build_menu(key):
+    keyboard = []
+    kind = key[0]
+
+    if kind == 'admin':
         admin_row = [
             Button(text=ADMIN_STATS_TEXT),
             Button(text=ADMIN_ACTIVE_TEXT),
@@ -55,7 +118,7 @@ def get_menu(telegram_user):
             admin_row,
             BACK_ROW,
         ]
-    elif current_state == 'stats':
+    elif kind == 'stats':
         stats_row = [
             Button(text=STATS_DAY_TEXT),
             Button(text=STATS_WEEK_TEXT),
@@ -66,51 +129,52 @@ def get_menu(telegram_user):
             stats_row,
             BACK_ROW,
         ]
-    elif current_state == 'contact':
-        keyboard = [
-            BACK_ROW,
-        ]
-    elif current_state == 'projects':
-        projects = telegram_user.project_set.order_by('-total_pomodoros')
+    elif kind == 'back':
+        keyboard.append(BACK_ROW)
+    elif kind == 'projects':
+        _, current_project_id, projects, has_prev, has_next, has_prefix = key
 
         for chunk in common.chunker(projects, 2):
             projects_row = []
-            for project in chunk:
-                text = SET_PROJECT_TEXT + ' ' + project.name
-                if project.id == telegram_user.current_project.id:
+            for project_id, name in chunk:
+                text = SET_PROJECT_TEXT + ' ' + name
+                if project_id == current_project_id:
                     text += ' ☑'
                 projects_row.append(Button(text=text))
             keyboard.append(projects_row)
 
+        pages_row = []
+        if has_prev:
+            pages_row.append(Button(text=PREV_PAGE_TEXT))
+        if has_next:
+            pages_row.append(Button(text=NEXT_PAGE_TEXT))
+        if pages_row:
+            keyboard.append(pages_row)
+
         keyboard.append([
+            Button(text=RESET_SEARCH_TEXT if has_prefix else SEARCH_PROJECT_TEXT),
             Button(text=NEW_PROJECT_TEXT),
             Button(text=BACK_TEXT),
         ])
-    elif current_state == 'new_project':
-        keyboard.append(BACK_ROW)
-    elif current_state == 'settings':
+    elif kind == 'settings':
+        _, pomodoro_minutes, rest_minutes, big_rest_minutes, session_count = key
+
         keyboard.append([
-            Button(text=SETTINGS_POMODORO_LENGTH + str(telegram_user.pomodoro_minutes)),
+            Button(text=SETTINGS_POMODORO_LENGTH + str(pomodoro_minutes)),
         ])
         keyboard.append([
-            Button(text=SETTINGS_REST_LENGTH + str(telegram_user.rest_minutes)),
+            Button(text=SETTINGS_REST_LENGTH + str(rest_minutes)),
         ])
         keyboard.append([
-            Button(text=SETTINGS_BIG_REST_LENGTH + str(telegram_user.big_rest_minutes)),
+            Button(text=SETTINGS_BIG_REST_LENGTH + str(big_rest_minutes)),
         ])
         keyboard.append([
-            Button(text=SETTINGS_SET_POMODORO_COUNT + str(telegram_user.pomodoro_session_count)),
+            Button(text=SETTINGS_SET_POMODORO_COUNT + str(session_count)),
         ])
         keyboard.append(BACK_ROW)
-    elif current_state == 'settings_pomodoro_length':
-        keyboard.append(BACK_ROW)
-    elif current_state == 'settings_rest_length':
-        keyboard.append(BACK_ROW)
-    elif current_state == 'settings_big_rest_length':
-        keyboard.append(BACK_ROW)
-    elif current_state == 'settings_session_count':
-        keyboard.append(BACK_ROW)
     else:
+        _, current_pomodoro, current_rest, project_name, is_admin = key
+
         first_row = []
         if current_pomodoro:
             first_row.append(Button(text=STOP_TEXT))
@@ -124,7 +188,7 @@ def get_menu(telegram_user):
                 first_row.append(Button(text=START_REST_TEXT))
 
         second_row = [
-            Button(text=PROJECTS_TEXT + ': ' + telegram_user.current_project.name),
+            Button(text=PROJECTS_TEXT + ': ' + project_name),
             Button(text=STATS_TEXT),
         ]
 
@@ -137,18 +201,99 @@ def get_menu(telegram_user):
         keyboard.append(second_row)
         keyboard.append(third_row)
 
-        if telegram_user.is_admin:
+        if is_admin:
             admin_row = []
             admin_row.append(Button(text=ADMIN_TEXT))
             keyboard.append(admin_row)
 
-    return Markup(buttons=keyboard) if keyboard else None
+    if not keyboard:
+        return None
+
+    markup = Markup(buttons=keyboard)
+    # serialize once, cached markup is shared by all users with the same key
+    markup.to_telegram_json()
+    return markup
+
+
+class MenuCache(object):
+    """
+    LRU of built and serialized keyboards by get_menu_key.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                metrics.incr('menu_cache.hit')
+                return self._items[key]
+
+        markup = build_menu(key)
+        metrics.incr('menu_cache.miss')
 
+        with self._lock:
+            self._items[key] = markup
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return markup
+
+
+menu_cache = MenuCache(settings.MENU_CACHE_SIZE)
+
+
+def get_menu(telegram_user, page_size=PROJECTS_PAGE_SIZE):
+    return menu_cache.get(get_menu_key(telegram_user, page_size))
+
+
+def send_message_to_user(telegram_user, message, priority='timer'):
+    """
+    With outbound queue message is delivered by run_outbound, also after Bot API outage. Sent directly it is
+    dropped while circuit is open.
+    """
+    if settings.TELEGRAM_OUTBOUND_QUEUE:
+        outbound.enqueue(telegram_user.user_id, message, get_menu(telegram_user), priority)
+        return
 
-def send_message_to_user(telegram_user, message):
     try:
         sender = Sender('telegram', telegram_user.user_id)
         sender.sendMessage(message, reply_markup=get_menu(telegram_user))
     except (telepot.exception.BotWasBlockedError, telepot.exception.BotWasBlockedError):
         telegram_user.status = 'banned'
         telegram_user.save()
+    except CircuitOpenError as e:
+        # without outbound queue there is nobody to deliver it later
+        logging.warning('Message for user %s is dropped: %s', telegram_user.id, e)
+        metrics.incr('breaker.dropped')
+
+
+def send_message_to_users(telegram_users, message):
+    """
+    Send the same message to many users concurrently (bot.transport), blocked users are marked as banned,
+    messages rejected by open circuit are dropped.
+    """
+    if settings.TELEGRAM_OUTBOUND_QUEUE:
+        for telegram_user in telegram_users:
+            outbound.enqueue(telegram_user.user_id, message, get_menu(telegram_user), 'broadcast')
+        return
+
+    calls = []
+    for telegram_user in telegram_users:
+        reply_markup = get_menu(telegram_user)
+        calls.append(('sendMessage', (telegram_user.user_id, message),
+                      {'reply_markup': reply_markup.to_telegram_json() if reply_markup else None}))
+
+    results = send_concurrently(calls)
+
+    for telegram_user, result in zip(telegram_users, results):
+        if isinstance(result, telepot.exception.BotWasBlockedError):
+            telegram_user.status = 'banned'
+            telegram_user.save()
+        elif isinstance(result, CircuitOpenError):
+            logging.warning("Message for user %s is dropped: %s", telegram_user.id, result)
+            metrics.incr('breaker.dropped')
+        elif isinstance(result, Exception):
+            logging.error("Can not send message for user %s: %s", telegram_user.id, result)
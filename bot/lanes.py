@@ -0,0 +1,126 @@
+# common
+import bisect
+import hashlib
+import json
+import logging
+import time
+
+# django
+from django.conf import settings
+from django.db import close_old_connections
+
+# my
+from app import metrics
+from app.common import get_redis
+
+
+class HashRing(object):
+    """
+    Consistent hashing of chat ids over lanes, changing lanes count moves only ~1/N of chats.
+    """
+
+    def __init__(self, lanes, replicas=100):
+        self.lanes = lanes
+        points = []
+        for lane in range(lanes):
+            for replica in range(replicas):
+                points.append((self._hash('lane-{}-{}'.format(lane, replica)), lane))
+        points.sort()
+        self._keys = [p[0] for p in points]
+        self._lanes = [p[1] for p in points]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(str(value).encode('utf8')).hexdigest()[:16], 16)
+
+    def get_lane(self, chat_id):
+        index = bisect.bisect(self._keys, self._hash(chat_id)) % len(self._keys)
+        return self._lanes[index]
+
+
+_ring = None
+
+
+def get_ring():
+    global _ring
+    if _ring is None or _ring.lanes != settings.TELEGRAM_UPDATE_LANES:
+        _ring = HashRing(settings.TELEGRAM_UPDATE_LANES)
+    return _ring
+
+
+def lane_key(lane):
+    return 'telegram:lane:{}'.format(lane)
+
+
+def processing_key(lane):
+    return 'telegram:lane:{}:processing'.format(lane)
+
+
+def dead_key(lane):
+    return 'telegram:lane:{}:dead'.format(lane)
+
+
+def get_update_chat_id(update):
+    if 'message' in update:
+        return update['message']['chat']['id']
+    elif 'callback_query' in update:
+        return update['callback_query']['message']['chat']['id']
+    raise TypeError('Not supported')
+
+
+def push_update(update, raw, token):
+    lane = get_ring().get_lane(get_update_chat_id(update))
+    get_redis().lpush(lane_key(lane), json.dumps([token, raw]))
+    return lane
+
+
+def _process(client, lane, item, handler, replay=False):
+    """
+    Handle one item, failed one is retried in place so later updates of the lane wait for it. Item is removed
+    from processing list only after success or when it is moved to dead letter list after
+    TELEGRAM_LANE_MAX_ATTEMPTS failures.
+    """
+    try:
+        token, raw = json.loads(item.decode('utf8'))
+    except ValueError:
+        logging.exception('Drop broken item of lane %s', lane)
+        client.lrem(processing_key(lane), 1, item)
+        return
+
+    for attempt in range(1, settings.TELEGRAM_LANE_MAX_ATTEMPTS + 1):
+        close_old_connections()
+        try:
+            handler(raw, token, replay=replay)
+            break
+        except Exception:
+            logging.exception('Can not process update of lane %s, attempt %s', lane, attempt)
+            metrics.incr('lanes.failed')
+
+        if attempt < settings.TELEGRAM_LANE_MAX_ATTEMPTS:
+            time.sleep(min(settings.TELEGRAM_LANE_RETRY_DELAY * 2 ** (attempt - 1), 30))
+    else:
+        logging.error('Update of lane %s failed %s times, moved to %s', lane, attempt, dead_key(lane))
+        metrics.incr('lanes.dead')
+        pipe = client.pipeline()
+        pipe.lpush(dead_key(lane), item)
+        pipe.lrem(processing_key(lane), 1, item)
+        pipe.execute()
+        return
+
+    client.lrem(processing_key(lane), 1, item)
+
+
+def consume_lane(lane, handler, timeout=5):
+    """
+    Process updates of one lane in order, one consumer per lane. Item stays in processing list until it is
+    handled, leftovers of crashed consumer are processed again on start (finished ones are dropped by dedup).
+    """
+    client = get_redis()
+
+    for item in reversed(client.lrange(processing_key(lane), 0, -1)):
+        _process(client, lane, item, handler, replay=True)
+
+    while True:
+        item = client.brpoplpush(lane_key(lane), processing_key(lane), timeout)
+        if item is not None:
+            _process(client, lane, item, handler)
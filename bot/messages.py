@@ -107,6 +107,10 @@ new_project_message = """
 Enter new project name
 """
 
+search_project_message = """
+Enter beginning of project name
+"""
+
 not_implemented_message = """
 Not implemented yet
 """
@@ -0,0 +1,287 @@
+# common
+import json
+import logging
+import random
+import time
+import uuid
+
+# django
+from django.conf import settings
+from django.db import close_old_connections
+
+# other
+import telepot
+
+# my
+from app import metrics
+from app.common import get_redis
+from bot.api import CircuitOpenError, get_bot
+
+
+# consumed in this order
+PRIORITIES = ('timer', 'reply', 'broadcast')
+
+# chats with held messages scored by time their first held message is released
+DELAYED_KEY = 'outbound:delayed'
+
+# take one token from global and one from chat bucket or none, returns seconds to wait for global and chat bucket.
+# New message of a chat with held messages (KEYS[3]) has to wait behind them, chat wait is -1 then.
+_acquire_script = """
+local function refill(key, rate, burst, now)
+    local data = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or burst
+    local ts = tonumber(data[2]) or now
+    return math.min(burst, tokens + math.max(0, now - ts) * rate)
+end
+
+local now = tonumber(ARGV[1])
+local global_rate, global_burst = tonumber(ARGV[2]), tonumber(ARGV[3])
+local chat_rate, chat_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+
+if ARGV[6] == '0' and redis.call('LLEN', KEYS[3]) > 0 then
+    return {'0', '-1'}
+end
+
+local global_tokens = refill(KEYS[1], global_rate, global_burst, now)
+local chat_tokens = refill(KEYS[2], chat_rate, chat_burst, now)
+
+if global_tokens >= 1 and chat_tokens >= 1 then
+    redis.call('HMSET', KEYS[1], 'tokens', global_tokens - 1, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], 60)
+    redis.call('HMSET', KEYS[2], 'tokens', chat_tokens - 1, 'ts', now)
+    redis.call('EXPIRE', KEYS[2], 60)
+    return {'0', '0'}
+end
+
+local global_wait, chat_wait = 0, 0
+if global_tokens < 1 then
+    global_wait = (1 - global_tokens) / global_rate
+end
+if chat_tokens < 1 then
+    chat_wait = (1 - chat_tokens) / chat_rate
+end
+return {tostring(global_wait), tostring(chat_wait)}
+"""
+
+# hold message ARGV[2] of chat ARGV[4] in chat list KEYS[2] (at the front if ARGV[3] is 1, it was held already)
+# and schedule the chat in KEYS[1] at ARGV[1]; chat which already waits keeps its time unless its head is delayed
+_defer_script = """
+local front = ARGV[3] == '1'
+if front then
+    redis.call('LPUSH', KEYS[2], ARGV[2])
+else
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+end
+
+local due = tonumber(ARGV[1])
+local current = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[4]))
+if not current or front and due > current then
+    redis.call('ZADD', KEYS[1], due, ARGV[4])
+end
+"""
+
+# move the first held message of chat ARGV[2] (list KEYS[2]) to the head of its priority queue (KEYS[3..] are
+# queues of priorities ARGV[4..]) if chat is due at ARGV[1], next held message is due ARGV[3] seconds later
+_release_script = """
+local now = tonumber(ARGV[1])
+local due = tonumber(redis.call('ZSCORE', KEYS[1], ARGV[2]))
+if not due or due > now then
+    return 0
+end
+
+local item = redis.call('LPOP', KEYS[2])
+if redis.call('LLEN', KEYS[2]) > 0 then
+    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[2])
+else
+    redis.call('ZREM', KEYS[1], ARGV[2])
+end
+if not item then
+    return 0
+end
+
+local message = cjson.decode(item)
+for i = 4, #ARGV do
+    if ARGV[i] == message['priority'] then
+        redis.call('RPUSH', KEYS[i - 1], item)
+    end
+end
+return 1
+"""
+
+
+def queue_key(priority):
+    return 'outbound:queue:{}'.format(priority)
+
+
+def _message(chat_id, text, reply_markup, priority):
+    assert priority in PRIORITIES
+    if reply_markup is not None and not isinstance(reply_markup, str):
+        reply_markup = reply_markup.to_telegram_json()
+
+    return {
+        'id': uuid.uuid4().hex,
+        'priority': priority,
+        'chat_id': chat_id,
+        'text': text,
+        'reply_markup': reply_markup,
+        'enqueued': time.time(),
+        'attempts': 0,
+    }
+
+
+def enqueue(chat_id, text, reply_markup=None, priority='reply'):
+    """
+    Put sendMessage to shared outbound queue, it is sent by manage.py run_outbound within telegram limits.
+    reply_markup is Markup or already serialized json.
+    """
+    message = _message(chat_id, text, reply_markup, priority)
+    get_redis().lpush(queue_key(priority), json.dumps(message))
+    metrics.incr('outbound.enqueued.' + priority)
+
+
+def enqueue_many(items):
+    """
+    Enqueue (chat_id, text, reply_markup, priority) items in one round trip.
+    """
+    pipe = get_redis().pipeline(transaction=False)
+    for chat_id, text, reply_markup, priority in items:
+        pipe.lpush(queue_key(priority), json.dumps(_message(chat_id, text, reply_markup, priority)))
+        metrics.incr('outbound.enqueued.' + priority)
+    pipe.execute()
+
+
+def held_key(chat_id):
+    return 'outbound:held:{}'.format(chat_id)
+
+
+def defer(message, seconds, reason, attempt=True):
+    """
+    Hold message in its chat list, messages of one chat are released one by one in order.
+    """
+    if attempt:
+        message['attempts'] += 1
+    front = message.get('held', False)
+    message['held'] = True
+    get_redis().eval(_defer_script, 2, DELAYED_KEY, held_key(message['chat_id']), time.time() + seconds,
+                     json.dumps(message), int(front), message['chat_id'])
+    metrics.incr('outbound.deferred.' + reason)
+
+
+def acquire(message):
+    """
+    Returns seconds to wait for global and for chat rate limit, (0, 0) if message can be sent now. Chat wait is
+    -1 if message has to wait behind held messages of its chat.
+    """
+    chat_id = message['chat_id']
+    global_wait, chat_wait = get_redis().eval(
+        _acquire_script, 3, 'outbound:bucket:global', 'outbound:bucket:{}'.format(chat_id), held_key(chat_id),
+        time.time(), settings.TELEGRAM_GLOBAL_RATE, settings.TELEGRAM_GLOBAL_BURST,
+        settings.TELEGRAM_CHAT_RATE, settings.TELEGRAM_CHAT_BURST, int(message.get('held', False)))
+    return float(global_wait), float(chat_wait)
+
+
+def release(limit=100):
+    client = get_redis()
+    now = time.time()
+    for chat_id in client.zrangebyscore(DELAYED_KEY, '-inf', now, start=0, num=limit):
+        chat_id = chat_id.decode('utf8')
+        client.eval(_release_script, 2 + len(PRIORITIES), DELAYED_KEY, held_key(chat_id),
+                    *[queue_key(p) for p in PRIORITIES],
+                    now, chat_id, 1 / settings.TELEGRAM_CHAT_RATE, *PRIORITIES)
+
+
+def send(message):
+    get_bot().sendMessage(message['chat_id'], message['text'], reply_markup=message['reply_markup'])
+
+
+def mark_banned(chat_id):
+    from app.models import TelegramUser
+
+    telegram_user = TelegramUser.objects.filter(user_id=str(chat_id)).first()
+    if telegram_user:
+        telegram_user.status = 'banned'
+        telegram_user.save(update_fields=['status'])
+
+
+def record_queue_depth():
+    pipe = get_redis().pipeline(transaction=False)
+    for priority in PRIORITIES:
+        pipe.llen(queue_key(priority))
+    pipe.zcard(DELAYED_KEY)
+    depths = pipe.execute()
+
+    for priority, depth in zip(PRIORITIES + ('delayed', ), depths):
+        metrics.gauge('outbound.depth.' + priority, depth, track_max=True)
+
+
+def process_next(timeout=1):
+    client = get_redis()
+    release()
+
+    item = client.brpop([queue_key(p) for p in PRIORITIES], timeout)
+    if item is None:
+        return False
+
+    message = json.loads(item[1].decode('utf8'))
+
+    global_wait, chat_wait = acquire(message)
+    if chat_wait < 0:
+        defer(message, 0, 'held', False)
+        return True
+    if chat_wait > 0:
+        # waiting for one chat would hold up messages of all others
+        defer(message, chat_wait, 'chat_rate_limit', False)
+        return True
+
+    if global_wait > 0:
+        if global_wait <= settings.TELEGRAM_OUTBOUND_MAX_SLEEP:
+            time.sleep(global_wait)
+            global_wait, chat_wait = acquire(message)
+        if global_wait != 0 or chat_wait != 0:
+            defer(message, max(global_wait, chat_wait, 0), 'rate_limit', False)
+            return True
+
+    try:
+        send(message)
+    except CircuitOpenError as e:
+        # spread retries of the whole queue over the cooldown instead of a burst when API comes back
+        defer(message, e.retry_after + random.uniform(0, settings.TELEGRAM_BREAKER_COOLDOWN), 'circuit_open', False)
+        return True
+    except telepot.exception.TooManyRequestsError as e:
+        retry_after = (e.json or {}).get('parameters', {}).get('retry_after', 1)
+        defer(message, retry_after, 'too_many_requests')
+        return True
+    except telepot.exception.BotWasBlockedError:
+        mark_banned(message['chat_id'])
+        metrics.incr('outbound.blocked')
+        return True
+    except Exception:
+        logging.exception('Can not send outbound message to %s', message['chat_id'])
+        if message['attempts'] < settings.TELEGRAM_OUTBOUND_MAX_ATTEMPTS:
+            defer(message, 2 ** message['attempts'] * random.uniform(0.5, 1.5), 'error')
+        else:
+            metrics.incr('outbound.dropped')
+        return True
+
+    metrics.incr('outbound.sent.' + message['priority'])
+    metrics.timing('outbound.wait.' + message['priority'], time.time() - message['enqueued'])
+    return True
+
+
+def run(timeout=1):
+    last_depth = 0
+    errors = 0
+    while True:
+        close_old_connections()
+        try:
+            process_next(timeout)
+            errors = 0
+        except Exception:
+            logging.exception('Can not process outbound queue')
+            errors += 1
+            time.sleep(min(2 ** errors, 30))
+            continue
+
+        if time.time() - last_depth >= settings.METRICS_FLUSH_INTERVAL:
+            record_queue_depth()
+            last_depth = time.time()
@@ -0,0 +1,99 @@
+# common
+import time
+from collections import defaultdict
+
+
+ANY_STATE = '*'
+
+
+class PrefixTrie(object):
+    """
+    Character trie of command prefixes, lookup walks the message once regardless of number of prefixes.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = value
+
+    def longest_match(self, text):
+        node = self.root
+        result = node.get(None)
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            result = node.get(None, result)
+        return result
+
+
+class Router(object):
+    """
+    Registry of message handlers by conversational state (None is main menu).
+
+    Resolution order mirrors the old if/elif chain: handlers registered for ANY_STATE (only when some state is
+    active), then exact text of the state, then prefix of the state, then fallback of the state and finally
+    fallback of ANY_STATE. Every step is a dict lookup or a trie walk over the message.
+    """
+
+    def __init__(self):
+        self._exact = defaultdict(dict)
+        self._prefixes = defaultdict(PrefixTrie)
+        self._fallbacks = {}
+        self.hooks = []
+
+    def route(self, state=None, texts=(), prefixes=()):
+        def decorator(handler):
+            for text in texts:
+                self._exact[state][text] = handler
+            for prefix in prefixes:
+                self._prefixes[state].add(prefix, handler)
+            return handler
+        return decorator
+
+    def fallback(self, *states):
+        def decorator(handler):
+            for state in states:
+                self._fallbacks[state] = handler
+            return handler
+        return decorator
+
+    def add_hook(self, hook):
+        """
+        hook(handler_name, seconds) is called after every dispatched handler.
+        """
+        self.hooks.append(hook)
+
+    def resolve(self, state, message):
+        if state is not None:
+            handler = self._exact.get(ANY_STATE, {}).get(message)
+            if handler:
+                return handler
+
+        handler = self._exact.get(state, {}).get(message)
+        if handler is None and state in self._prefixes:
+            handler = self._prefixes[state].longest_match(message)
+        if handler:
+            return handler
+
+        handler = self._fallbacks.get(state)
+        if handler is None and state is not None:
+            handler = self._fallbacks.get(ANY_STATE)
+        return handler
+
+    def dispatch(self, bot, state, message):
+        handler = self.resolve(state, message)
+        if handler is None:
+            raise LookupError('No handler for {!r} in state {!r}'.format(message, state))
+
+        start = time.perf_counter()
+        try:
+            return handler(bot, message)
+        finally:
+            duration = time.perf_counter() - start
+            for hook in self.hooks:
+                hook(handler.__name__, duration)
@@ -1,5 +1,6 @@
 # common
 import json
+from contextlib import contextmanager
 import time
 import pprint
 
@@ -8,9 +9,11 @@ from django.conf import settings
 
 # other
 from pymessenger.bot import Bot
-import telepot
-from telepot.namedtuple import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup, \
-    ReplyKeyboardRemove
+
+# my
+from app import metrics
+from bot import callback
+from bot.transport import send_concurrently
 
 
 class Button(object):
@@ -56,51 +59,153 @@ class Markup(object):
         self.buttons = buttons
         self.inline_buttons = inline_buttons
         self.remove_menu = remove_menu
+        self._telegram_json = None
+
+    def to_telegram_json(self):
+        """
+        reply_markup serialized for Bot API, computed once per Markup. telepot passes strings as is.
+        """
+        if self._telegram_json is not None:
+            return self._telegram_json
 
-    def to_telegram_markup(self):
         result = None
         if self.remove_menu:
-            result = ReplyKeyboardRemove(remove_keyboard=True)
+            result = {'remove_keyboard': True}
         elif self.buttons:
             keyboard = []
             for markup_row in self.buttons:
                 row = []
                 for markup_button in markup_row:
-                    row.append(KeyboardButton(text=markup_button.text,
-                                              request_contact=markup_button.request_contact))
+                    button = {'text': markup_button.text}
+                    if markup_button.request_contact:
+                        button['request_contact'] = True
+                    row.append(button)
                 keyboard.append(row)
-            result = ReplyKeyboardMarkup(keyboard=keyboard)
+            result = {'keyboard': keyboard}
         elif self.inline_buttons:
             keyboard = []
             for markup_row in self.inline_buttons:
                 row = []
                 for markup_button in markup_row:
                     if markup_button.url:
-                        row.append(InlineKeyboardButton(text=markup_button.text, url=markup_button.url))
+                        row.append({'text': markup_button.text, 'url': markup_button.url})
                     elif markup_button.data:
-                        callback = json.dumps(markup_button.data)
-                        row.append(InlineKeyboardButton(text=markup_button.text, callback_data=callback))
-
+                        # data is (action, payload), see bot.callback
+                        row.append({'text': markup_button.text,
+                                    'callback_data': callback.encode(*markup_button.data)})
                 keyboard.append(row)
-            result = InlineKeyboardMarkup(inline_keyboard=keyboard)
-        return result
+            result = {'inline_keyboard': keyboard}
+
+        if result is not None:
+            self._telegram_json = json.dumps(result, separators=(',', ':'))
+        return self._telegram_json
+
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def merge_messages(items, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Merge consecutive (text, reply_markup) into as few texts as possible within limit. Message with inline
+    keyboard ends the merged text, so the keyboard stays under its own text. Reply keyboard is replaced by the
+    next one telegram gets, merged text carries the last of them.
+    """
+    merged = []
+    for text, reply_markup in items:
+        text = text.strip('\n')
+        if merged:
+            last_text, last_markup = merged[-1]
+            if not getattr(last_markup, 'inline_buttons', None) and len(last_text) + 1 + len(text) <= limit:
+                merged[-1] = (last_text + '\n' + text, reply_markup if reply_markup is not None else last_markup)
+                continue
+        merged.append((text, reply_markup))
+    return merged
 
 
 class Sender(object):
 
-    def __init__(self, social_platform, chat_id, msg_id=None, query_id=None):
+    def __init__(self, social_platform, chat_id, msg_id=None, query_id=None, inline_reply=False):
         assert social_platform in ('telegram', 'facebook')
         self.social_platform = social_platform
         self.chat_id = chat_id
         self.msg_id = msg_id
         self.query_id = query_id
+        self._outbox = None
+
+        # last message of outbox is not sent but kept here to be returned as webhook response
+        self.inline_reply_enabled = inline_reply
+        self.inline_reply = None
+
+    @contextmanager
+    def outbox(self):
+        """
+        Messages sent inside the block are merged (merge_messages) and sent on exit.
+        """
+        if self._outbox is not None or self.social_platform != 'telegram':
+            yield self
+            return
+
+        self._outbox = []
+        try:
+            yield self
+        finally:
+            self.flush_outbox(final=True)
+            self._outbox = None
+
+    def flush_outbox(self, final=False):
+        if not self._outbox:
+            return
+
+        items, self._outbox = self._outbox, []
+        merged = merge_messages(items)
+        metrics.incr('outbox.messages', len(items))
+        metrics.incr('outbox.sent', len(merged))
+
+        # only at the end of update, otherwise later sends would overtake it
+        if final and self.inline_reply_enabled:
+            text, reply_markup = merged.pop()
+            self.inline_reply = {
+                'method': 'sendMessage',
+                'chat_id': self.chat_id,
+                'text': text,
+            }
+            if reply_markup:
+                self.inline_reply['reply_markup'] = json.loads(reply_markup.to_telegram_json())
+            metrics.incr('outbox.inline_reply')
+
+        self._call_many([('sendMessage', (self.chat_id, text),
+                          {'reply_markup': reply_markup.to_telegram_json() if reply_markup else None})
+                         for text, reply_markup in merged])
+
+    def _call_many(self, calls, token=None):
+        """
+        Bot API calls (method, args, kwargs) through bot.transport, calls of one chat keep their order.
+        First error is raised as from plain telepot call.
+        """
+        if not calls:
+            return []
+
+        results = send_concurrently(calls, token=token, keys=[self.chat_id] * len(calls))
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def _send_direct(self, method, *args, token=None, **kwargs):
+        """
+        Bot API call bypassing outbox, messages waiting in outbox are sent first to keep order.
+        """
+        self.flush_outbox()
+        return self._call_many([(method, args, kwargs)], token)[0]
 
     def sendMessage(self, message, reply_markup=None, token=None):
-        if self.social_platform == 'telegram':
-            bot = telepot.Bot(token or settings.TELEGRAM_BOT_TOKEN)
+        if self._outbox is not None and token is None:
+            self._outbox.append((message, reply_markup))
+            return
 
-            telegram_reply_markup = reply_markup.to_telegram_markup() if reply_markup else None
-            bot.sendMessage(self.chat_id, message, reply_markup=telegram_reply_markup)
+        if self.social_platform == 'telegram':
+            telegram_reply_markup = reply_markup.to_telegram_json() if reply_markup else None
+            self._send_direct('sendMessage', self.chat_id, message, token=token, reply_markup=telegram_reply_markup)
         elif self.social_platform == 'facebook':
             bot = Bot(settings.FACEBOOK_MESSENGER_ACCESS_TOKEN)
 
@@ -211,23 +316,19 @@ class Sender(object):
 
     def editMessage(self, message, reply_markup=None, msg_id=None, token=None):
         if self.social_platform == 'telegram':
-            bot = telepot.Bot(token or settings.TELEGRAM_BOT_TOKEN)
-            telegram_reply_markup = reply_markup.to_telegram_markup() if reply_markup else None
+            telegram_reply_markup = reply_markup.to_telegram_json() if reply_markup else None
             msg_id = tuple(msg_id or self.msg_id)   # should be tuple, telegram or telepot does not accept list
-            bot.editMessageText(msg_id, message, reply_markup=telegram_reply_markup)
+            self._send_direct('editMessageText', msg_id, message, token=token, reply_markup=telegram_reply_markup)
 
     def answer(self, message, token=None):
         if self.social_platform == 'telegram':
-            bot = telepot.Bot(token or settings.TELEGRAM_BOT_TOKEN)
-            bot.answerCallbackQuery(self.query_id, text=message)
+            self._send_direct('answerCallbackQuery', self.query_id, token=token, text=message)
 
     def sendPhoto(self, photo, caption=None, filename=None, token=None):
         if self.social_platform == 'telegram':
-            bot = telepot.Bot(token or settings.TELEGRAM_BOT_TOKEN)
             filename = filename or f'unnamed{time.time()}.png'
-            bot.sendPhoto(self.chat_id, (filename, photo), caption=caption)
+            self._send_direct('sendPhoto', self.chat_id, (filename, photo), token=token, caption=caption)
 
     def sendAudio(self, audio, caption=None, token=None):
         if self.social_platform == 'telegram':
-            bot = telepot.Bot(token or settings.TELEGRAM_BOT_TOKEN)
-            bot.sendAudio(self.chat_id, audio, caption=caption)
\ No newline at end of file
+            self._send_direct('sendAudio', self.chat_id, audio, token=token, caption=caption)
\ No newline at end of file
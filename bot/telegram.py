@@ -5,7 +5,7 @@ import logging
 # django
 from django.conf import settings
 from django.views import generic
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.urls import reverse
 
@@ -14,28 +14,24 @@ import telepot
 
 # my
 from bot.sender import Sender
+from bot.api import CircuitOpenError, get_bot
+from bot import callback
 from bot.bot import Bot
+from bot.dedup import deduplicator
+from bot.lanes import push_update
 from app.models import TelegramUser
+from app.cache import user_cache
 
 
 def get_telegram_from_seed(message):
     chat = message['chat']
-    current_user, _ = TelegramUser.objects.get_or_create(user_id=chat['id'])
-
-    need_save = False
     first_name = chat.get('first_name')
     last_name = chat.get('last_name')
 
-    if first_name != current_user.first_name:
-        current_user.first_name = first_name
-        need_save = True
-
-    if last_name != current_user.last_name:
-        current_user.last_name = last_name
-        need_save = True
-
-    if need_save:
-        current_user.save()
+    current_user = user_cache.get(chat['id'])
+    if current_user is None or current_user.first_name != first_name or current_user.last_name != last_name:
+        current_user = TelegramUser.objects.upsert(chat['id'], first_name, last_name)
+        user_cache.store(current_user)
 
     return current_user
 
@@ -51,68 +47,144 @@ class TelegramWebhook(generic.View):
         setup_telegram_webhook()
 
     def post(self, request, token):
+        raw = request.body.decode('utf8')
 
-        try:
-            raw = request.body.decode('utf8')
-            logging.debug('Telegram raw data %s' % raw)
-            update = json.loads(raw)
-            if 'message' in update:
-                data = message = update['message']
-            elif 'callback_query' in update:
-                data = update['callback_query']
-                message = data['message']
-            else:
-                logging.error('Can not recognize update {}', update)
-                raise TypeError('Not supported')
-
-            current_user = get_telegram_from_seed(message)
-            sender = Sender('telegram', current_user.user_id)
-            bot = Bot(current_user, sender)
-        except (TypeError, ValueError) as e:
-            logging.exception("Can not decode message")
+        result = submit_update(raw, token, inline_reply=settings.TELEGRAM_WEBHOOK_INLINE_REPLY)
+        if not result:
             return HttpResponse('Error')
 
-        if token != settings.TELEGRAM_BOT_TOKEN:
-            sender = Sender('telegram', current_user.user_id)
-            sender.sendMessage('Our bot migrated to @{}'.format(settings.TELEGRAM_BOT_NAME), token=token)
-            return HttpResponse('ok')
+        if isinstance(result, dict):
+            # telegram executes Bot API method from webhook response body, saves one outbound request
+            return JsonResponse(result)
 
+        return HttpResponse('ok')
+
+
+def submit_update(raw, token, inline_reply=False):
+    """
+    Hand raw update over to configured processing mode. Returns False if update can not be decoded.
+    With inline_reply and inline processing last reply of the update is returned as dict of Bot API method call
+    instead of being sent.
+    """
+    if settings.TELEGRAM_UPDATE_MODE == 'celery':
+        from app.tasks import process_telegram_update_task
+        process_telegram_update_task.apply_async(args=(raw, token))
+        return True
+    elif settings.TELEGRAM_UPDATE_MODE == 'lanes':
         try:
-            flavor = telepot.flavor(data)
-            if flavor == 'chat':
-                text = message.get('text', '') or message.get('contact', {}).get('phone_number')
-                if not text:
-                    return HttpResponse('ok')
-
-                bot.on_chat_message(text)
-            elif flavor == 'callback_query':
-                msg_id = (data['from']['id'], data['message']['message_id'])
-                query_id, from_id, query_data = telepot.glance(data, flavor='callback_query')
-                sender.msg_id = msg_id
-                sender.query_id = query_id
-
-                data = json.loads(query_data) if query_data else None
-                if not data:
-                    return HttpResponse('ok')
-
-                bot.on_callback(data)
+            push_update(json.loads(raw), raw, token)
+        except (TypeError, ValueError, KeyError):
+            logging.exception("Can not decode message")
+            return False
+        return True
+
+    return process_update(raw, token, inline_reply)
+
+
+def process_update(raw, token, inline_reply=False, replay=False):
+    logging.debug('Telegram raw data %s' % raw)
+    try:
+        update = json.loads(raw)
+    except ValueError:
+        logging.exception("Can not decode message")
+        return False
+
+    return handle_update(update, token, inline_reply, replay)
+
+
+def handle_update(update, token, inline_reply=False, replay=False):
+    """
+    Run bot dispatch for decoded telegram update once. Update is marked as processed only after dispatch, failed
+    one is processed again on redelivery. With replay (leftover of crashed consumer) update is skipped only if it
+    was finished.
+    """
+    bot_id = token.split(':')[0]
+    update_id = update.get('update_id') if isinstance(update, dict) else None
+
+    if update_id is not None:
+        duplicated = deduplicator.is_done(bot_id, update_id) if replay else deduplicator.seen(bot_id, update_id)
+        if duplicated:
+            logging.debug('Skip duplicated update %s', update_id)
+            return True
+
+    try:
+        result = dispatch_update(update, token, inline_reply)
+    except BaseException:
+        if update_id is not None:
+            deduplicator.forget(bot_id, update_id)
+        raise
+
+    if update_id is not None:
+        deduplicator.done(bot_id, update_id)
+    return result
+
+
+def dispatch_update(update, token, inline_reply=False):
+    """
+    Returns False if update is not supported, with inline_reply returns dict of captured reply if there is one.
+    """
+    try:
+        update_id = update.get('update_id')
+        if 'message' in update:
+            data = message = update['message']
+        elif 'callback_query' in update:
+            data = update['callback_query']
+            message = data['message']
+        else:
+            logging.error('Can not recognize update {}', update)
+            raise TypeError('Not supported')
+
+        current_user = get_telegram_from_seed(message)
+        sender = Sender('telegram', current_user.user_id, inline_reply=inline_reply)
+        bot = Bot(current_user, sender)
+    except (TypeError, ValueError) as e:
+        logging.exception("Can not decode message")
+        return False
+
+    if token != settings.TELEGRAM_BOT_TOKEN:
+        sender = Sender('telegram', current_user.user_id)
+        sender.sendMessage('Our bot migrated to @{}'.format(settings.TELEGRAM_BOT_NAME), token=token)
+        return True
+
+    try:
+        flavor = telepot.flavor(data)
+        if flavor == 'chat':
+            text = message.get('text', '') or message.get('contact', {}).get('phone_number')
+            if not text:
+                return True
+
+            bot.on_chat_message(text)
+        elif flavor == 'callback_query':
+            msg_id = (data['from']['id'], data['message']['message_id'])
+            query_id, from_id, query_data = telepot.glance(data, flavor='callback_query')
+            sender.msg_id = msg_id
+            sender.query_id = query_id
+
+            data = callback.decode(query_data) if query_data else None
+            if not data:
+                return True
+
+            bot.on_callback(data)
+    except CircuitOpenError as e:
+        # Bot API is down, there is no way to tell user about it
+        logging.warning('Update %s is not answered: %s', update_id, e)
+    except Exception:
+        logging.exception('Error on handling bot message')
+        try:
+            sender.sendMessage('❌❌❌❌❌ Internal error', reply_markup=bot.get_menu())
         except Exception:
-            logging.exception('Error on handling bot message')
-            try:
-                sender.sendMessage('❌❌❌❌❌ Internal error', reply_markup=bot.get_menu())
-            except Exception:
-                logging.exception('Error on handling bot message error')
+            logging.exception('Error on handling bot message error')
 
-        return HttpResponse('ok')
+    return sender.inline_reply or True
 
 
 def setup_telegram_webhook():
-    bot = telepot.Bot(settings.TELEGRAM_BOT_TOKEN)
+    bot = get_bot()
     url = settings.TUNNEL_URL + reverse('telegram_webhook', kwargs={'token': settings.TELEGRAM_BOT_TOKEN})
     bot.setWebhook(url)
 
 
-def create_bot_from_user(bot_user, request=None):
+def create_bot_from_user(bot_user):
     sender = Sender('telegram', bot_user.user_id)
-    bot = Bot(bot_user, sender, request)
+    bot = Bot(bot_user, sender)
     return bot
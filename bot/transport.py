@@ -0,0 +1,84 @@
+# common
+import asyncio
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# django
+from django.conf import settings
+
+# my
+from app import metrics
+from bot.api import get_bot
+
+
+class AsyncTransport(object):
+    """
+    asyncio transport for Bot API calls. telepot is blocking, so calls run in thread pool over shared keep-alive
+    connections of bot.api and asyncio only schedules them, at most `concurrency` calls are in flight.
+    """
+
+    def __init__(self, concurrency=None, token=None):
+        self.concurrency = concurrency or settings.TELEGRAM_SEND_CONCURRENCY
+        self.token = token
+
+    async def call(self, loop, executor, semaphore, method, args, kwargs):
+        async with semaphore:
+            bot = get_bot(self.token)
+            return await loop.run_in_executor(executor, functools.partial(getattr(bot, method), *args, **kwargs))
+
+    async def call_chain(self, loop, executor, semaphore, chain):
+        """
+        Calls of one chain are sent one after another, the ones after failed call are not sent and get its error.
+        """
+        results = []
+        error = None
+        for method, args, kwargs in chain:
+            if error is None:
+                try:
+                    results.append(await self.call(loop, executor, semaphore, method, args, kwargs))
+                    continue
+                except Exception as e:
+                    error = e
+            results.append(error)
+        return results
+
+    async def send_many(self, calls, keys=None):
+        """
+        calls are (method, args, kwargs), results or raised exceptions are returned in the same order.
+        Calls with the same key (e.g. chat id) keep their order, calls without keys are independent.
+        """
+        chains = OrderedDict()
+        for i, call in enumerate(calls):
+            chains.setdefault(keys[i] if keys else ('call', i), []).append((i, call))
+
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(chains)) or 1) as executor:
+            tasks = [self.call_chain(loop, executor, semaphore, [call for _, call in chain])
+                     for chain in chains.values()]
+            chain_results = await asyncio.gather(*tasks)
+
+        results = [None] * len(calls)
+        for chain, chain_result in zip(chains.values(), chain_results):
+            for (i, _), result in zip(chain, chain_result):
+                results[i] = result
+        return results
+
+
+def send_concurrently(calls, concurrency=None, token=None, keys=None):
+    """
+    Sync facade of AsyncTransport for current blocking callers, see AsyncTransport.send_many.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        with metrics.timer('transport.batch'):
+            results = loop.run_until_complete(AsyncTransport(concurrency, token).send_many(calls, keys))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    metrics.incr('transport.calls', len(calls))
+    metrics.incr('transport.errors', len([r for r in results if isinstance(r, Exception)]))
+    return results
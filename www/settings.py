@@ -155,10 +155,103 @@ else:
     TELEGRAM_BOT_NAME = 'devpomidoro_bot'
     TUNNEL_URL = 'https://85865308.ngrok.io'
 
+# tokens of previous bots still answered with "migrated" message, their Bot API clients are kept (bot.api.get_bot)
+TELEGRAM_LEGACY_BOT_TOKENS = []
+
 TELEGRAM_ADMIN_USERS = [
     '242433650',   # Anton Pomieschenko
 ]
 
+# 'inline' - process update inside webhook request
+# 'celery' - enqueue raw update and answer webhook immediately, updates are processed by
+#            workers of `telegram_updates` queue: celery -A www worker -Q telegram_updates
+# 'lanes'  - partition updates by chat id over TELEGRAM_UPDATE_LANES redis lists, updates of one chat are
+#            processed in order by single consumer: manage.py consume_lane <n>
+TELEGRAM_UPDATE_MODE = os.environ.get('TELEGRAM_UPDATE_MODE', 'inline')
+TELEGRAM_UPDATE_LANES = int(os.environ.get('TELEGRAM_UPDATE_LANES', 8))
+# failed update blocks its lane and is retried with backoff, then it is moved to dead letter list
+TELEGRAM_LANE_MAX_ATTEMPTS = 5
+TELEGRAM_LANE_RETRY_DELAY = 1
+
+# telegram redelivers updates for up to 24 hours
+TELEGRAM_UPDATE_DEDUP_TTL = 60 * 60 * 24
+TELEGRAM_UPDATE_DEDUP_LOCAL_SIZE = 10000
+# update is claimed for this long while processed, redelivery after crashed worker is processed again
+TELEGRAM_UPDATE_DEDUP_LEASE = 60
+
+# write-through cache of TelegramUser rows, see app.cache
+TELEGRAM_USER_CACHE_TTL = 60 * 60
+TELEGRAM_USER_CACHE_LOCAL_SIZE = 10000
+
+# where conversational state of users lives: app.mixins.state.JSONFieldStateStore (row of TelegramUser) or
+# app.mixins.state.RedisStateStore, move existing state with manage.py migrate_state json redis
+STATE_STORE_BACKEND = os.environ.get('STATE_STORE_BACKEND', 'app.mixins.state.JSONFieldStateStore')
+# json store only, retries of compare-and-set state update on concurrent change
+STATE_CAS_RETRIES = 5
+# redis store only, seconds of inactivity after which menu stack is dropped
+STATE_MACHINE_TTL = 60 * 60 * 24 * 7
+
+# LRU of serialized keyboards, see bot.helper.MenuCache
+MENU_CACHE_SIZE = 1024
+
+# keep-alive pool of Bot API connections shared by all senders of the process, see bot.api
+TELEGRAM_API_NUM_POOLS = 4
+TELEGRAM_API_POOL_SIZE = 10
+TELEGRAM_API_CONNECT_TIMEOUT = 5
+TELEGRAM_API_READ_TIMEOUT = 30
+TELEGRAM_API_RETRIES = 2
+
+# circuit breaker of Bot API calls: opens when more than FAILURE_RATE of calls within WINDOW seconds (at least
+# MIN_CALLS) or CONSECUTIVE_FAILURES calls in a row fail because of network errors or 5xx, probes API again after
+# COOLDOWN doubling up to MAX_COOLDOWN. State is per process, a single threaded worker makes one call per read
+# timeout when API hangs, so it relies on the consecutive failures
+TELEGRAM_BREAKER_FAILURE_RATE = 0.5
+TELEGRAM_BREAKER_MIN_CALLS = 10
+TELEGRAM_BREAKER_WINDOW = 30
+TELEGRAM_BREAKER_CONSECUTIVE_FAILURES = 3
+TELEGRAM_BREAKER_COOLDOWN = 5
+TELEGRAM_BREAKER_MAX_COOLDOWN = 120
+
+# Bot API calls in flight for concurrent sends (bot.transport), users in one broadcast batch
+TELEGRAM_SEND_CONCURRENCY = TELEGRAM_API_POOL_SIZE
+TELEGRAM_BROADCAST_BATCH = 200
+
+# send timer notifications and broadcasts through shared redis queue (bot.outbound, manage.py run_outbound)
+# which respects telegram limits: ~30 messages per second overall and ~1 per second per chat
+TELEGRAM_OUTBOUND_QUEUE = os.environ.get('TELEGRAM_OUTBOUND_QUEUE') == '1'
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_GLOBAL_BURST = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+# wait for token in place if it is sooner than this (seconds), otherwise message is deferred
+TELEGRAM_OUTBOUND_MAX_SLEEP = 0.1
+TELEGRAM_OUTBOUND_MAX_ATTEMPTS = 5
+
+# inline mode only, return last reply of update in webhook response body instead of separate sendMessage request
+TELEGRAM_WEBHOOK_INLINE_REPLY = os.environ.get('TELEGRAM_WEBHOOK_INLINE_REPLY') == '1'
+
+# inline button payloads which do not fit telegram 64 bytes callback_data are kept in redis this long
+CALLBACK_PAYLOAD_TTL = 60 * 60 * 24 * 30
+
+# pomodoro audio is not repeated within last N tracks of the user
+AUDIO_NO_REPEAT = 5
+
+# how pomodoro and rest finish is scheduled:
+# 'celery' - ETA task per timer, held in worker memory until due
+# 'redis'  - sorted set of due times fired in batches by manage.py run_timers
+# 'wheel'  - in memory timing wheel of manage.py run_timer_wheel (single process), rebuilt from started
+#            pomodoros and rests on start
+TIMER_BACKEND = os.environ.get('TIMER_BACKEND', 'celery')
+# redis backend, timers claimed longer ago (crashed poller, failed batch) are fired again
+TIMER_CLAIM_LEASE = 60
+
+# alternative Bot API server, e.g. http://127.0.0.1:8081 for manage.py fake_bot_api
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+
+# manage.py poll_telegram, getUpdates ingestion instead of webhook
+TELEGRAM_POLL_LIMIT = 100
+TELEGRAM_POLL_TIMEOUT = 30
+
 
 ########################################################################################################################
 # Raven
@@ -189,6 +282,9 @@ ADMIN_LOGS_BACKEND = 'admin_logs.backends.database.DatabaseBackend'
 ########################################################################################################################
 REDIS_LOCATION = "pomodoro-redis:6379"
 
+# bot data (dedup index, metrics, queues), kept apart from broker and cache db
+REDIS_APP_URL = 'redis://%s/1' % REDIS_LOCATION
+
 CELERY_DISABLE_RATE_LIMITS = True
 
 CELERY_ACCEPT_CONTENT = ['pickle']
@@ -203,6 +299,10 @@ CELERY_TASK_RESULT_EXPIRES = 18000  # 5 hours.
 CELERY_TIMEZONE = 'Europe/Kiev'
 CELERY_ALWAYS_EAGER = False
 
+CELERY_TASK_ROUTES = {
+    'app.tasks.process_telegram_update_task': {'queue': 'telegram_updates'},
+}
+
 from celery.schedules import crontab
 
 CELERY_BEAT_SCHEDULE = {
@@ -231,6 +331,13 @@ CACHES = {
 SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
 
 
+########################################################################################################################
+# Metrics
+########################################################################################################################
+# counters are accumulated in process and flushed to redis not more often than this (seconds)
+METRICS_FLUSH_INTERVAL = 10
+
+
 ########################################################################################################################
 # EMAILS
 ########################################################################################################################